@@ -31,7 +31,10 @@ import gui_support
 import serial.tools.list_ports
 from api.wave_visualizer import *
 from api.manipulator import *
+from api.path_compiler import compile_path
+from api.trajectory import TrajectoryStreamer
 from api.power_supply import *
+from api.relay import Relay
 from threading import *
 
 
@@ -100,7 +103,6 @@ class GUI:
         '''
         -MANUAL COM PORT SELECTION, VARIABLE COM PORTS, AUTO DETECT COM PORTS?
         -STOP/INTERRUPT BUTTONS
-        -MAKE PATHING FUNCTION
         -Be able to save and load 2 position
         '''
         # INSTANCE INITIALIZATION FOR MANIPULATOR, POWER SUPPLY, AND DEMAG
@@ -117,7 +119,7 @@ class GUI:
                 supply = PowerSupply("/dev/ttyUSB0", relay_1, relay_2)
                 demagnetizer = Demagnetizer(supply, relay_1, relay_2)
             if "/dev/ttyUSB1" in p:
-                mm = Manipulator("/dev/ttyUSB1")
+                mm = Manipulator("/dev/ttyUSB1", max_state_age=1.0)
 
         # BEGINNING OF FUNCTIONALITY
 
@@ -155,14 +157,13 @@ class GUI:
             Polls the manipulator and the power supply for updates on various parameters.
             """
             if mm != None:
-                mm.set_mode(Mode.ABSOLUTE)
                 x, y, z = mm.get_current_position()
                 gui_support.status_abspos_v.set(str(x) + " x,  " + str(y) + " y,  " + str(z) + " z")
-                mm_status_dict = mm.get_status()
-                vel = mm_status_dict['XSPEED']
+                mm_status = mm.get_status()
+                vel = mm_status.xspeed
                 gui_support.velocity.set(str(vel))
                 gui_support.status_vel_v.set(str(vel))
-                res = mm_status_dict['XSPEED_RES']
+                res = mm_status['XSPEED_RES']
                 gui_support.status_res_v.set(str(res))
                 mm.refresh_display()
 
@@ -215,7 +216,6 @@ class GUI:
             """
             Saves the position currently entered into the 3 entry fields. This does not save the current position.
             """
-            mm.set_mode(Mode.ABSOLUTE)
             x, y, z = mm.get_current_position()
             self.Listbox_pos.insert(0, str(x) + "x, " + str(y) + "y, " + str(z) + "z")
             self.console_output.insert(1.0, "Position saved to list\n")
@@ -252,37 +252,33 @@ class GUI:
 
         def step_x():
             """
-            Calls the manipulator api function get_position to get parameters for the manipulator api function go_to_position.
+            Calls the manipulator api function move_relative to jog the manipulator by the entered offset.
             """
             xmove = gui_support.step_x.get()
             if (is_okay(xmove)):
                 self.console_output.insert(1.0, "Only numbers, '-', and '.' are allowed. Please check format\n")
             else:
                 self.console_output.insert(1.0, "Moving by " + str(xmove) + "x\n")
-                mm.set_mode(Mode.ABSOLUTE)
-                x, y, z = mm.get_current_position()
-                mm.go_to_position(float(xmove) + x, y, z)
+                mm.move_relative(float(xmove), 0, 0)
                 self.console_output.insert(1.0, "Moving complete\n")
                 status_refresh()
 
         def step_y():
             """
-            Calls the manipulator api function get_position to get parameters for the manipulator api function go_to_position.
+            Calls the manipulator api function move_relative to jog the manipulator by the entered offset.
             """
             ymove = gui_support.step_y.get()
             if is_okay(ymove):
                 self.console_output.insert(1.0, "Only numbers, '-', and '.' are allowed. Please check format\n")
             else:
                 self.console_output.insert(1.0, "Moving by " + str(ymove) + "y\n")
-                mm.set_mode(Mode.ABSOLUTE)
-                x, y, z = mm.get_current_position()
-                mm.go_to_position(x, float(ymove) + y, z)
+                mm.move_relative(0, float(ymove), 0)
                 self.console_output.insert(1.0, "Move complete\n")
                 status_refresh()
 
         def step_z():
             """
-            Calls the manipulator api function get_position to get parameters for the manipulator api function go_to_position.
+            Calls the manipulator api function move_relative to jog the manipulator by the entered offset.
             :return:
             """
             zmove = gui_support.step_z.get()
@@ -290,9 +286,7 @@ class GUI:
                 self.console_output.insert(1.0, "Only numbers, '-', and '.' are allowed. Please check format\n")
             else:
                 self.console_output.insert(1.0, "Moving by " + str(zmove) + "z\n")
-                mm.set_mode(Mode.ABSOLUTE)
-                x, y, z = mm.get_current_position()
-                mm.go_to_position(x, y, float(zmove) + z)
+                mm.move_relative(0, 0, float(zmove))
                 self.console_output.insert(1.0, "Move complete\n")
                 status_refresh()
 
@@ -320,8 +314,7 @@ class GUI:
             but the velocity is kept the same as what is programmed to the device.
 
             """
-            mm_status_dict = mm.get_status()
-            vel = mm_status_dict['XSPEED']
+            vel = mm.get_status().xspeed
             if gui_support.radio_resolution.get() == "low":
                 mm.set_velocity(float(vel), Resolution.LOW)
             else:
@@ -332,7 +325,33 @@ class GUI:
         def path():
             """
             Pathing function takes a parametric each equation for x y and z direction. Last two field are for the upper and lower bound.
+            The path is compiled into the fewest moves that stay within one step (0.04 um) of the equations in t.
             """
+            x = gui_support.path_x.get()
+            y = gui_support.path_y.get()
+            z = gui_support.path_z.get()
+            t_min = gui_support.path_min.get()
+            t_max = gui_support.path_max.get()
+
+            if is_okay(t_min) or is_okay(t_max):
+                self.console_output.insert(1.0, "Only numbers, '-', and '.' are allowed. Please check format\n")
+            elif not (x and y and z):
+                self.console_output.insert(1.0, "Please enter an equation for x, y and z\n")
+            else:
+                try:
+                    moves = compile_path(x, y, z, 't', (float(t_min), float(t_max)))
+                except ValueError as e:
+                    self.console_output.insert(1.0, str(e) + "\n")
+                    return
+
+                self.console_output.insert(1.0, "Running path of " + str(len(moves)) + " moves\n")
+                mm.set_mode(Mode.ABSOLUTE)
+                if len(moves) <= MAX_PROGRAM_MOVES:
+                    mm.send_and_execute_moves(moves)
+                else:
+                    TrajectoryStreamer(mm).stream(moves)
+                self.console_output.insert(1.0, "Path complete\n")
+                status_refresh()
 
         def master_stop():
             """
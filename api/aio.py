@@ -0,0 +1,541 @@
+"""
+asyncio drivers for the power supply and manipulator, so one event loop can run a whole experiment:
+
+    async def experiment():
+        ps = await AsyncPowerSupply.open('/dev/ttyUSB0', relay_1, relay_2)
+        mm = AsyncManipulator('/dev/ttyUSB1')
+
+        async def wave():
+            async for deadline, current in ps.square_wave(1.0, 2.0):
+                pass
+
+        async def track():
+            async for t, x, y, z in mm.positions(rate=5):
+                print(x, y, z)
+
+        await asyncio.wait_for(asyncio.gather(wave(), track()), 60)
+
+The drivers share the command encoding, state mirror and wave tables of the threaded classes in api.manipulator and
+api.power_supply, which remain separate so the GUI and existing scripts keep working unchanged.
+"""
+import asyncio
+import os
+from typing import Tuple, Union, Callable, Optional, Any, AsyncIterator, TYPE_CHECKING
+
+import numpy as np
+import serial
+
+from api.journal import Opcode
+from api.manipulator import Mode, Resolution, MAX_PROGRAM_MOVES, pack_moves, _DeviceState, _Interrupts, \
+    _move_frame, _execute_frame, _velocity_word, _decode_position, _program_target, _Moves
+from api.wave_table import WaveTable, CURRENT_RESOLUTION, CurrentSetpoint, wave_tables, compile_square, compile_ramp, \
+    compile_sine, validate_square_wave, validate_ramp_wave, validate_sine_wave
+
+if TYPE_CHECKING:
+    from api.relay import Relay
+
+_Num = Union[int, float]
+
+# Timeout for replies that do not wait for a move to finish, matches the threaded Manipulator
+_REPLY_TIMEOUT = 10
+
+
+class AsyncSerial:
+    """
+    Minimal asyncio transport over a serial port. Reads and writes are driven by event loop callbacks on the port's
+    file descriptor, so only POSIX ports (ttys and pseudo terminals) are supported.
+
+    lock serializes transactions of coroutines sharing the port.
+    """
+
+    def __init__(self, port: str, **serial_kwargs):
+        """
+        :param port: Serial port
+        :param serial_kwargs: Keyword arguments for serial.Serial, e.g. baudrate and stopbits
+        """
+        self.serial_conn = serial.Serial(port, timeout=0, **serial_kwargs)
+        self.lock = asyncio.Lock()
+
+        self._fd = self.serial_conn.fileno()
+        os.set_blocking(self._fd, False)
+
+        self._buffer = bytearray()
+        self._waiter = None
+        self._loop = None
+
+    def _start_reading(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            data = b''
+            error = e
+        else:
+            error = ConnectionError('Serial port closed')
+
+        if not data:
+            # Hung up, stop watching so the loop does not spin
+            self._loop.remove_reader(self._fd)
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_exception(error)
+            return
+
+        self._buffer += data
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _fill(self, deadline: Optional[float]):
+        self._waiter = self._loop.create_future()
+        try:
+            timeout = None if deadline is None else max(0.0, deadline - self._loop.time())
+            await asyncio.wait_for(self._waiter, timeout)
+        finally:
+            self._waiter = None
+
+    def _deadline(self, timeout: Optional[_Num]) -> Optional[float]:
+        return None if timeout is None else self._loop.time() + timeout
+
+    async def read_exactly(self, num_bytes: int, timeout: _Num = None) -> bytes:
+        """
+        :param num_bytes: Number of bytes to read
+        :param timeout: Optional timeout in seconds, raises asyncio.TimeoutError when exceeded
+        """
+        self._start_reading()
+        deadline = self._deadline(timeout)
+
+        while len(self._buffer) < num_bytes:
+            await self._fill(deadline)
+
+        data = bytes(self._buffer[:num_bytes])
+        del self._buffer[:num_bytes]
+        return data
+
+    async def readline(self, terminator: bytes = b'\n', timeout: _Num = None) -> bytes:
+        """
+        :param terminator: Line terminator, included in the returned line
+        :param timeout: Optional timeout in seconds, raises asyncio.TimeoutError when exceeded
+        """
+        self._start_reading()
+        deadline = self._deadline(timeout)
+
+        end = self._buffer.find(terminator)
+        while end < 0:
+            await self._fill(deadline)
+            end = self._buffer.find(terminator)
+
+        end += len(terminator)
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return line
+
+    async def write(self, data: bytes):
+        self._start_reading()
+
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                view = view[os.write(self._fd, view):]
+            except BlockingIOError:
+                pass
+
+            if len(view) > 0:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    async def drain(self):
+        """
+        Waits until everything written has been transmitted
+        """
+        self._start_reading()
+        await self._loop.run_in_executor(None, self.serial_conn.flush)
+
+    def close(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._fd)
+        self.serial_conn.close()
+
+
+class AsyncManipulator:
+    """
+    asyncio variant of api.manipulator.Manipulator. Commands are coroutines, concurrent commands are sent one after
+    the other, and positions() samples the position as an async generator
+    """
+
+    def __init__(self, comm_port: str, max_state_age: _Num = 0.0):
+        """
+        :param comm_port: Serial port of the manipulator
+        :param max_state_age: Maximum age in seconds of a mirrored position or status before it is read again
+        """
+        self.port = AsyncSerial(comm_port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+                                stopbits=serial.STOPBITS_ONE)
+
+        self.max_state_age = max_state_age
+        self.saved_round_trips = {'mode': 0, 'velocity': 0, 'position': 0, 'status': 0}
+
+        self._state = _DeviceState()
+        self._interrupts = _Interrupts(lambda: self._state.moved(None, None))
+
+    def close(self):
+        self.port.close()
+
+    def invalidate_state(self):
+        self._state.invalidate()
+
+    async def _read_acknowledgements(self):
+        """
+        Reads the CR of every interrupt sent so far. Must be called with the port lock held
+        """
+        for future in self._interrupts.take():
+            await self.port.read_exactly(1, _REPLY_TIMEOUT)
+            self._interrupts.acknowledged(future)
+
+    async def _transact(self, command: bytes, response_length: int = 1, decode: Callable[[bytes], Any] = None,
+                        timeout: Optional[_Num] = _REPLY_TIMEOUT):
+        async with self.port.lock:
+            try:
+                await self._read_acknowledgements()
+                await self.port.write(command)
+                response = await self.port.read_exactly(response_length, timeout) if response_length > 0 else b''
+            except BaseException:
+                # Cancelled or failed mid command, the device state is unknown
+                self._state.invalidate()
+                raise
+
+        return decode(response) if decode is not None else None
+
+    async def get_current_position(self, max_age: _Num = None) -> Tuple[float, float, float]:
+        max_age = self.max_state_age if max_age is None else max_age
+
+        position = self._state.get_position(max_age) if not self.port.lock.locked() else None
+        if position is not None:
+            self.saved_round_trips['position'] += 1
+            return position
+
+        return await self._transact(b'c\r', 13, self._state.read_position)
+
+    async def positions(self, rate: _Num = 10) -> AsyncIterator[Tuple[float, float, float, float]]:
+        """
+        Samples the position at a fixed rate, skipping samples while another command is using the port
+
+        :param rate: Samples per second
+        :return: Async generator of (time.monotonic(), x, y, z)
+        """
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+
+        loop = asyncio.get_running_loop()
+        period = 1 / rate
+        deadline = loop.time()
+
+        while True:
+            if not self.port.lock.locked():
+                position = await self._transact(b'c\r', 13, self._state.read_position)
+                yield (loop.time(),) + position
+
+            # Schedule against absolute deadlines so slow reads do not lower the rate
+            deadline = max(deadline + period, loop.time())
+            await asyncio.sleep(deadline - loop.time())
+
+    async def go_to_position(self, x: _Num, y: _Num, z: _Num):
+        frame = _move_frame(x, y, z)
+
+        target = _decode_position(frame[1:])
+        mode = self._state.mode
+
+        await self._transact(frame, decode=lambda response: self._state.moved(target, mode), timeout=None)
+
+    async def move_relative(self, dx: _Num, dy: _Num, dz: _Num):
+        await self.set_mode(Mode.RELATIVE)
+        await self.go_to_position(dx, dy, dz)
+
+    async def send_and_execute_moves(self, moves: _Moves, program_num: int = 1):
+        """
+        Sends and executes a program of up to 99 moves
+
+        :param moves: List or (N, 3) array of (x, y, z) coordinates in um
+        :param program_num: Optional program number between 1 and 10
+        """
+        byte_str = pack_moves(moves, program_num)
+
+        mode = self._state.mode
+        target = _program_target(byte_str, mode)
+
+        async with self.port.lock:
+            try:
+                await self._read_acknowledgements()
+                await self.port.write(byte_str)
+                await self.port.read_exactly(1, _REPLY_TIMEOUT)
+
+                await self.port.write(_execute_frame(program_num))
+                await self.port.read_exactly(1)
+            except BaseException:
+                self._state.invalidate()
+                raise
+
+        if target is not None:
+            self._state.moved(target, mode)
+
+    async def move_relative_many(self, moves: _Moves, program_num: int = 1):
+        moves = np.asarray(moves, dtype=np.float64)
+
+        await self.set_mode(Mode.RELATIVE)
+        for i in range(0, len(moves), MAX_PROGRAM_MOVES):
+            await self.send_and_execute_moves(moves[i:i + MAX_PROGRAM_MOVES], program_num)
+
+    async def set_velocity(self, velocity: _Num, resolution: Resolution):
+        steps = _velocity_word(velocity, resolution)
+
+        if steps == self._state.velocity_word:
+            self.saved_round_trips['velocity'] += 1
+            return
+
+        self._state.velocity_word = steps
+        await self._transact(b'V' + steps.to_bytes(2, 'little') + b'\r',
+                             decode=lambda response: self._state.velocity_set(steps))
+
+    async def set_mode(self, mode: Mode):
+        if mode == self._state.mode:
+            self.saved_round_trips['mode'] += 1
+            return
+
+        self._state.mode = mode
+        await self._transact(mode.value + b'\r', decode=lambda response: self._state.mode_set(mode))
+
+    async def set_origin(self):
+        await self._transact(b'o\r', decode=lambda response: self._state.moved((0.0, 0.0, 0.0), Mode.ABSOLUTE))
+
+    async def refresh_display(self):
+        await self._transact(b'n\r')
+
+    async def interrupt(self):
+        """
+        Stops a running move. The interrupt is sent immediately, even while another coroutine waits for the move
+        """
+        self._interrupts.sent()
+        await self.port.write(b'\x03')
+
+        # The move (if any) reads its own CR first, the next one acknowledges the interrupt
+        async with self.port.lock:
+            await self._read_acknowledgements()
+
+    async def continue_operation(self):
+        await self._transact(b'e\r', decode=lambda response: self._state.moved(None, None), timeout=None)
+
+    async def reset(self):
+        self._state.invalidate()
+        await self._transact(b'r\r', 0)
+
+    async def get_status(self, max_age: _Num = None):
+        max_age = self.max_state_age if max_age is None else max_age
+
+        status = self._state.get_status(max_age) if not self.port.lock.locked() else None
+        if status is not None:
+            self.saved_round_trips['status'] += 1
+            return status
+
+        return await self._transact(b's\r', 33, self._state.read_status)
+
+
+class AsyncPowerSupply:
+    """
+    asyncio variant of api.power_supply.PowerSupply. Waves are async generators that play a wave table against
+    absolute deadlines and turn the output off when they are closed or cancelled. Create with
+    'await AsyncPowerSupply.open(...)'
+
+    Unlike PowerSupply it keeps no journal and does not share the port through a SerialBroker. Its lock only orders
+    its own coroutines, so nothing else may use the port, and queries are not held back from wave deadlines.
+    """
+
+    def __init__(self, comm_port: str, relay_1: 'Relay', relay_2: 'Relay',
+                 current_resolution: _Num = CURRENT_RESOLUTION):
+        """
+        :param comm_port: Serial port of the supply
+        :param relay_1: Relay switching the first output terminal
+        :param relay_2: Relay switching the second output terminal
+        :param current_resolution: Current programming resolution of the supply in A
+        """
+        self.port = AsyncSerial(comm_port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+                                stopbits=serial.STOPBITS_TWO)
+
+        self.relay_1 = relay_1
+        self.relay_2 = relay_2
+
+        self.current_resolution = current_resolution
+        self.suppressed_writes = 0
+
+        self._setpoint = CurrentSetpoint()
+
+    @classmethod
+    async def open(cls, comm_port: str, relay_1: 'Relay', relay_2: 'Relay',
+                   current_resolution: _Num = CURRENT_RESOLUTION) -> 'AsyncPowerSupply':
+        power_supply = cls(comm_port, relay_1, relay_2, current_resolution)
+        await power_supply.initialize()
+        return power_supply
+
+    async def initialize(self) -> str:
+        """
+        Turns the output off and sets the 20V range at 0A
+
+        :return: Identification string of the supply
+        """
+        identification = (await self.query(b'*IDN?')).decode('ascii')
+
+        await self.disable_output()
+        await self.write(b'VOLT:RANG HIGH;:APPL MAX, 0.0')  # Sets 20V mode, 20V, 0A
+        self._setpoint.current = 0.0
+
+        return identification
+
+    def close(self):
+        self.port.close()
+
+    async def write(self, command: bytes):
+        """
+        Sends an SCPI command without its terminator
+        """
+        async with self.port.lock:
+            await self.port.write(command + b'\n')
+
+    async def query(self, command: bytes) -> bytes:
+        async with self.port.lock:
+            await self.port.write(command + b'\n')
+            return await self.port.readline(timeout=_REPLY_TIMEOUT)
+
+    async def enable_output(self, relay_forward: bool = True):
+        if relay_forward is not None:
+            if relay_forward:
+                self.relay_1.vcc()
+                self.relay_2.gnd()
+            else:
+                self.relay_1.gnd()
+                self.relay_2.vcc()
+
+        await self.write(b'OUTP ON')
+
+    async def disable_output(self, disable_relay: bool = True):
+        await self.write(b'OUTP OFF')
+
+        if disable_relay:
+            # The output must be off before the relays open
+            await self.port.drain()
+            self.relay_1.gnd()
+            self.relay_2.gnd()
+
+    async def set_voltage(self, voltage: _Num):
+        await self.write(b'VOLT %f' % voltage)
+
+    async def get_voltage(self) -> float:
+        return float(await self.query(b'MEAS:VOLT?'))
+
+    async def get_current(self) -> float:
+        return float(await self.query(b'MEAS:CURR?'))
+
+    async def set_current(self, current: _Num):
+        current = self._setpoint.set(current, self.current_resolution)
+        if current is None:
+            self.suppressed_writes += 1
+            return
+
+        await self.write(b'CURR %f' % current)
+
+    async def set_current_step(self, current_step: _Num):
+        self._setpoint.set_step(current_step, self.current_resolution)
+        await self.write(b'CURR:STEP %f' % current_step)
+
+    async def step_current(self, up: bool):
+        self._setpoint.stepped(up, self.current_resolution)
+        await self.write(b'CURR UP' if up else b'CURR DOWN')
+
+    async def get_error(self) -> bytes:
+        return await self.query(b'SYST:ERR?')
+
+    async def play(self, table: WaveTable, cycles: int = None) -> AsyncIterator[Tuple[float, float]]:
+        """
+        Turns the output on and plays a wave table against absolute deadlines. The output is turned off when the
+        generator finishes, is closed or is cancelled. Breaking out of 'async for' does not close an async generator
+        right away, use contextlib.aclosing or call aclose() to stop at once
+
+        :param table: Compiled wave table. Tables stepping with CURR UP/DOWN expect CURR:STEP to be set
+        :param cycles: Number of cycles to play, None to play until closed
+        :return: Async generator of (deadline as time.monotonic(), setpoint) after each step is sent
+        """
+        loop = asyncio.get_running_loop()
+        # Only absolute settings can be skipped, CURR UP and DOWN move the output whatever the setpoint
+        absolute = [opcode == Opcode.CURR for opcode in table.opcodes]
+        steps = list(zip(table.offsets.tolist(), table.setpoints.tolist(), table.frames, absolute))
+
+        await self.enable_output()
+        try:
+            cycle_start = loop.time()
+            cycle = 0
+            while cycles is None or cycle < cycles:
+                for offset, setpoint, frame, is_absolute in steps:
+                    if is_absolute and setpoint == self._setpoint.current:
+                        self.suppressed_writes += 1
+                        continue
+
+                    deadline = cycle_start + offset
+                    await asyncio.sleep(deadline - loop.time())
+
+                    async with self.port.lock:
+                        await self.port.write(frame)
+                    self._setpoint.current = setpoint
+
+                    yield deadline, setpoint
+
+                cycle_start += table.cycle_time
+                cycle += 1
+                await asyncio.sleep(cycle_start - loop.time())
+        finally:
+            await self.disable_output()
+
+    async def square_wave(self, amplitude: _Num, period: _Num,
+                          duty_cycle: float = 0.5) -> AsyncIterator[Tuple[float, float]]:
+        validate_square_wave(amplitude, period, duty_cycle)
+
+        resolution = self.current_resolution
+        table = wave_tables.get(('square', amplitude, period, duty_cycle, resolution),
+                                lambda: compile_square(amplitude, period, duty_cycle, resolution))
+
+        await self.disable_output()
+        await self.set_current(0)
+
+        async for step in self.play(table):
+            yield step
+
+    async def ramp_wave(self, amplitude: _Num, rise_time: _Num, steady_time: _Num,
+                        rest_time: _Num) -> AsyncIterator[Tuple[float, float]]:
+        num_steps = validate_ramp_wave(amplitude, rise_time)
+        resolution = self.current_resolution
+        table = wave_tables.get(('ramp', amplitude, num_steps, steady_time, rest_time, resolution),
+                                lambda: compile_ramp(amplitude, num_steps, steady_time, rest_time, resolution))
+
+        await self.disable_output()
+        await self.set_current(0)
+
+        async for step in self.play(table):
+            yield step
+
+    async def sine_wave(self, amplitude: _Num, period: _Num, time_offset: _Num = None,
+                        dc_offset: _Num = None) -> AsyncIterator[Tuple[float, float]]:
+        time_offset, dc_offset = validate_sine_wave(amplitude, period, time_offset, dc_offset)
+
+        resolution = self.current_resolution
+        table = wave_tables.get(('sine', amplitude, period, time_offset, dc_offset, resolution),
+                                lambda: compile_sine(amplitude, period, time_offset, dc_offset, resolution))
+
+        await self.disable_output()
+        await self.set_current(table.setpoints[0])
+
+        async for step in self.play(table):
+            yield step
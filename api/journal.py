@@ -0,0 +1,229 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from enum import IntEnum
+from typing import Union
+
+import numpy as np
+
+_Num = Union[int, float]
+
+DEVICE_POWER_SUPPLY = 1
+DEVICE_MANIPULATOR = 2  # Manipulators in a ManipulatorGroup use 2, 3, ...
+
+_MAGIC = b'MMJRNL01'
+_HEADER = struct.Struct('<8sIIQQ')  # magic, version, record size, capacity, records written
+_HEADER_SIZE = 64
+_COUNT = struct.Struct('<Q')
+_COUNT_OFFSET = 24
+_VERSION = 1
+
+_RECORD = struct.Struct('<dddHH4x')  # time, value, latency, device, opcode
+
+# Layout of a record as read back with NumPy
+JOURNAL_DTYPE = np.dtype({'names': ['time', 'value', 'latency', 'device', 'opcode'],
+                          'formats': ['<f8', '<f8', '<f8', '<u2', '<u2'],
+                          'offsets': [0, 8, 16, 24, 26],
+                          'itemsize': _RECORD.size})
+
+NAN = float('nan')
+
+
+class Opcode(IntEnum):
+    """
+    Journal opcodes besides manipulator commands, which are journaled as their command byte, e.g. ord('m')
+    """
+    STREAM = 0x100  # TrajectoryStreamer run
+
+    SCPI = 0x200  # Any other SCPI line, including coalesced batches with the command count as value
+    CURR = 0x201
+    CURR_UP = 0x202
+    CURR_DOWN = 0x203
+    CURR_STEP = 0x204
+    VOLT = 0x205
+    OUTPUT_ON = 0x206
+    OUTPUT_OFF = 0x207
+    TRIGGER = 0x208
+    ARM = 0x209  # CURR:TRIG with INIT
+    MEASURE_CURRENT = 0x20A
+    MEASURE_VOLTAGE = 0x20B
+    QUERY = 0x20C  # Any other query
+
+
+_SCPI_OPCODES = {b'CURR UP': Opcode.CURR_UP, b'CURR DOWN': Opcode.CURR_DOWN, b'OUTP ON': Opcode.OUTPUT_ON,
+                 b'OUTP OFF': Opcode.OUTPUT_OFF, b'*TRG': Opcode.TRIGGER, b'MEAS:CURR?': Opcode.MEASURE_CURRENT,
+                 b'MEAS:VOLT?': Opcode.MEASURE_VOLTAGE}
+_SCPI_HEADER_OPCODES = {b'CURR': Opcode.CURR, b'CURR:STEP': Opcode.CURR_STEP, b'VOLT': Opcode.VOLT,
+                        b'CURR:TRIG': Opcode.ARM}
+
+
+def scpi_opcode(command: bytes) -> int:
+    """
+    :param command: A single SCPI command, with or without its terminator
+    :return: Journal opcode of the command
+    """
+    command = command.rstrip(b'\n')
+
+    opcode = _SCPI_OPCODES.get(command)
+    if opcode is not None:
+        return opcode
+
+    if b';:' in command:
+        return Opcode.SCPI
+
+    opcode = _SCPI_HEADER_OPCODES.get(command.partition(b' ')[0])
+    if opcode is not None:
+        return opcode
+
+    return Opcode.QUERY if command.endswith(b'?') else Opcode.SCPI
+
+
+def label_opcode(label: str) -> int:
+    """
+    :param label: Manipulator response time label, a command character or 'stream'
+    :return: Journal opcode of the label
+    """
+    if len(label) == 1:
+        return ord(label)
+    return Opcode.STREAM if label == 'stream' else 0
+
+
+class Journal:
+    """
+    Fixed size ring of binary command records in a memory mapped file. Each record holds the time.monotonic() the
+    command was sent, the device id, the opcode, a value (e.g. the current set) and the latency until the command was
+    transmitted or answered. Recording packs straight into the mapping, so it is cheap enough for wave threads.
+
+    Opening an existing journal continues appending to it. Read journals with read_journal.
+    """
+
+    def __init__(self, path: str, capacity: int = 1 << 20):
+        """
+        :param path: Journal file, created if it does not exist or is empty
+        :param capacity: Number of records kept before the oldest are overwritten. Ignored for an existing journal
+        :raises ValueError: If path is an existing file that is not a journal
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+
+        header = None
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as journal_file:
+                header = _read_header(journal_file.read(_HEADER_SIZE))
+
+            # Creating the journal would truncate whatever the file holds
+            if header is None:
+                raise ValueError('%s is not a journal' % path)
+
+        if header is not None:
+            self.capacity, self._count = header
+        else:
+            if capacity <= 0:
+                raise ValueError('Capacity must be positive')
+
+            self.capacity, self._count = capacity, 0
+            with open(path, 'wb') as journal_file:
+                journal_file.write(_HEADER.pack(_MAGIC, _VERSION, _RECORD.size, capacity, 0).ljust(_HEADER_SIZE,
+                                                                                                     b'\0'))
+                journal_file.truncate(_HEADER_SIZE + capacity * _RECORD.size)
+
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), _HEADER_SIZE + self.capacity * _RECORD.size)
+
+    def __enter__(self) -> 'Journal':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def records_written(self) -> int:
+        return self._count
+
+    def record(self, device: int, opcode: int, value: float = NAN, latency: float = 0.0, timestamp: float = None):
+        """
+        :param device: Device id, e.g. DEVICE_POWER_SUPPLY
+        :param opcode: Command character code or Opcode
+        :param value: Value sent or read, NaN if none
+        :param latency: Seconds until the command was transmitted or answered
+        :param timestamp: time.monotonic() the command was sent, now if None
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with self._lock:
+            if self._mmap.closed:
+                return
+
+            _RECORD.pack_into(self._mmap, _HEADER_SIZE + (self._count % self.capacity) * _RECORD.size,
+                              timestamp, value, latency, device, opcode)
+            self._count += 1
+            _COUNT.pack_into(self._mmap, _COUNT_OFFSET, self._count)
+
+    def flush(self):
+        with self._lock:
+            if not self._mmap.closed:
+                self._mmap.flush()
+
+    def close(self):
+        mapping = getattr(self, '_mmap', None)
+        if mapping is None:
+            return
+
+        with self._lock:
+            if not mapping.closed:
+                mapping.flush()
+                mapping.close()
+                self._file.close()
+
+
+def read_journal(path: str, ordered: bool = True) -> np.ndarray:
+    """
+    Loads a journal as a structured array with the fields time, value, latency, device and opcode. The array maps the
+    file directly, without copying, unless the ring has wrapped and ordered is True, in which case the two halves are
+    joined into a new array
+
+    :param path: Journal file
+    :param ordered: Return records oldest first. If False a wrapped ring is returned in storage order
+    :return: Structured array of JOURNAL_DTYPE records
+    """
+
+    with open(path, 'rb') as journal_file:
+        header = _read_header(journal_file.read(_HEADER_SIZE))
+    if header is None:
+        raise ValueError('%s is not a journal' % path)
+
+    capacity, count = header
+    records = np.memmap(path, dtype=JOURNAL_DTYPE, mode='r', offset=_HEADER_SIZE, shape=(capacity,))
+
+    if count <= capacity:
+        return records[:count]
+
+    if not ordered:
+        return records
+
+    start = count % capacity
+    return np.concatenate((records[start:], records[:start]))
+
+
+def _read_header(header_bytes: bytes):
+    """
+    :return: (capacity, records written), or None if the bytes are not a journal header
+    """
+    if len(header_bytes) < _HEADER.size:
+        return None
+
+    magic, version, record_size, capacity, count = _HEADER.unpack_from(header_bytes)
+    if magic != _MAGIC or version != _VERSION or record_size != _RECORD.size:
+        return None
+
+    return capacity, count
@@ -1,10 +1,26 @@
-from enum import Enum
-from typing import Tuple, Union, Sequence
-
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from enum import Enum, IntFlag
+from typing import Tuple, Union, Sequence, Callable, Optional, Dict, Any, List
+
+import numpy as np
 import serial
 
+from api.journal import Journal, DEVICE_MANIPULATOR, label_opcode
+
 _USTEPS_PER_UM_ = 25
 
+MAX_PROGRAM_MOVES = 99
+MAX_PROGRAM_NUM = 10
+
+_PROGRAM_HEADER_LENGTH = 3  # 'd', program number, number of moves
+_MOVE_LENGTH = 12  # x, y, z as int32
+_INT32_MIN = -(1 << 31)
+_INT32_MAX = (1 << 31) - 1
+
 
 class Mode(Enum):
     ABSOLUTE = b'a'
@@ -16,34 +32,183 @@ class Resolution(Enum):
     HIGH = 1  # 50 uSteps/step
 
 
+# Velocity ceilings in um/s
+MAX_VELOCITY = {Resolution.HIGH: 1310, Resolution.LOW: 6500}
+RECOMMENDED_MAX_VELOCITY = {Resolution.HIGH: 1310, Resolution.LOW: 3000}
+
+
 _Num = Union[int, float]
+_Moves = Union[np.ndarray, Sequence[Tuple[_Num, _Num, _Num]]]
 
 
 class Manipulator:
 
-    def __init__(self, comm_port: str):
+    def __init__(self, comm_port: str, pipelined: bool = False, max_state_age: _Num = 0.0, journal: Journal = None,
+                 journal_device: int = DEVICE_MANIPULATOR):
+        """
+        Opens a connection to the manipulator.
+
+        In pipelined mode a dedicated I/O thread owns the serial port. Commands are queued and every method
+        returns a concurrent.futures.Future that resolves to the usual return value once the manipulator
+        has responded, so several commands can be queued without blocking on each acknowledgement.
+
+        The manipulator keeps a mirror of the device state. Setting the mode or velocity to its current value
+        does not send anything, and position and status reads younger than max_state_age are answered from
+        the mirror. saved_round_trips counts the commands that were avoided.
+
+        :param comm_port: Serial port of the manipulator
+        :param pipelined: Set to True to queue commands on a dedicated I/O thread
+        :param max_state_age: Maximum age in seconds of a mirrored position or status before it is read again
+        :param journal: Optional journal recording every command sent and its response time
+        :param journal_device: Device id of this manipulator in the journal
+        """
 
         self.serial_conn = serial.Serial(comm_port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
                                          stopbits=serial.STOPBITS_ONE, timeout=10, write_timeout=10)
 
+        self.max_state_age = max_state_age
+        self.saved_round_trips = {'mode': 0, 'velocity': 0, 'position': 0, 'status': 0}
+        self.response_times = _ResponseTimes(journal, journal_device)
+
+        self._state = _DeviceState()
+        self._interrupts = _Interrupts(lambda: self._state.moved(None, None))
+
+        # Held while a command is on the wire when not pipelined
+        self._port_lock = threading.RLock()
+
+        self._pipeline = None
+        if pipelined:
+            self._pipeline = _CommandPipeline(self.serial_conn, self.response_times, self._state.invalidate,
+                                              self._interrupts)
+            self._pipeline.start()
+
     def __del__(self):
-        self.serial_conn.close()
+        self.close()
+
+    def close(self):
+        """
+        Stops the I/O thread (if pipelined) once all queued commands are sent, then closes the serial port
+        """
+        pipeline = getattr(self, '_pipeline', None)
+        if pipeline is not None:
+            pipeline.stop()
+            self._pipeline = None
+
+        if hasattr(self, 'serial_conn'):
+            self.serial_conn.close()
+
+    def wait_all(self, timeout: _Num = None):
+        """
+        Blocks until every queued command has been answered. Does nothing when not pipelined.
+
+        :param timeout: Optional maximum time to wait in seconds
+        """
+        if self._pipeline is not None:
+            self._pipeline.submit(None, lambda serial_conn: None).result(timeout)
+
+    def invalidate_state(self):
+        """
+        Forgets the mirrored device state, e.g. after the keypad or joystick was used
+        """
+        self._state.invalidate()
+
+    def _execute(self, opcode: str, operation: Callable[[serial.Serial], Any]):
+        """
+        Runs an operation against the serial port, either immediately or on the I/O thread if pipelined
+
+        :param opcode: Label used for response time accounting, None to skip accounting
+        :param operation: Callable receiving the serial connection and returning the result of the command
+        :return: The result of the operation, or a Future of it if pipelined
+        """
+        if self._pipeline is not None:
+            return self._pipeline.submit(opcode, operation)
+
+        with self._port_lock:
+            self._interrupts.read_acknowledgements(self.serial_conn)
+
+            start = time.perf_counter()
+            try:
+                result = operation(self.serial_conn)
+            except Exception:
+                self._state.invalidate()
+                raise
+            self.response_times.record(opcode, 0.0, time.perf_counter() - start)
+
+        return result
+
+    def _transact(self, command: bytes, response_length: int = 1, decode: Callable[[bytes], Any] = None):
+        """
+        Writes a command and reads its fixed length response
+
+        :param command: Full command including the terminating CR
+        :param response_length: Number of bytes in the response (including CR)
+        :param decode: Optional callable converting the response into a return value
+        :return: The decoded response, or a Future of it if pipelined
+        """
+
+        def operation(serial_conn: serial.Serial):
+            serial_conn.write(command)
+
+            response = serial_conn.read(response_length) if response_length > 0 else b''
+
+            return decode(response) if decode is not None else None
+
+        return self._execute(chr(command[0]), operation)
+
+    def _skip(self, counter: str, result: Any = None):
+        """
+        Answers a command from the state mirror instead of the manipulator
 
-    def get_current_position(self):
+        :param counter: Key of saved_round_trips to increment
+        :param result: Value to return
+        :return: The result, or a completed Future of it if pipelined
+        """
+        self.saved_round_trips[counter] += 1
+
+        if self._pipeline is None:
+            return result
+
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def _is_idle(self) -> bool:
+        return self._pipeline is None or self._pipeline.pending == 0
+
+    def get_current_position(self, max_age: _Num = None):
         """
         Get the micromanipulator position
+        :param max_age: Optionally override max_state_age for this read
         :return: A tuple of floats (x,y,z) of the position in um accurate to 0.04 um
         """
-        self.serial_conn.write(b'c\r')
+        max_age = self.max_state_age if max_age is None else max_age
+
+        position = self._state.get_position(max_age) if self._is_idle() else None
+        if position is not None:
+            return self._skip('position', position)
 
         # returns 'xxxxyyyyzzzzCR' in uSteps
-        position_bytes = self.serial_conn.read(13)
+        return self._transact(b'c\r', 13, self._state.read_position)
 
-        x = int.from_bytes(position_bytes[0:4], byteorder='little', signed=True)
-        y = int.from_bytes(position_bytes[4:8], byteorder='little', signed=True)
-        z = int.from_bytes(position_bytes[8:12], byteorder='little', signed=True)
+    def poll_position(self) -> Optional[Tuple[float, float, float]]:
+        """
+        Low priority position read for background polling. Always reads the manipulator, but gives up instead of
+        waiting if another command is using the port
+
+        :return: A tuple of floats (x,y,z) of the position in um, or None if the port was busy
+        """
+        if self._pipeline is not None:
+            if self._pipeline.pending > 0:
+                return None
+            return self._transact(b'c\r', 13, self._state.read_position).result()
 
-        return float(x / _USTEPS_PER_UM_), float(y / _USTEPS_PER_UM_), float(z / _USTEPS_PER_UM_)
+        if not self._port_lock.acquire(blocking=False):
+            return None
+
+        try:
+            return self._transact(b'c\r', 13, self._state.read_position)
+        finally:
+            self._port_lock.release()
 
     def go_to_position(self, x: _Num, y: _Num, z: _Num):
         """
@@ -54,53 +219,73 @@ class Manipulator:
         :param z: Z coordinate in um
         """
 
-        x_bytes = int(x * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
-        y_bytes = int(y * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
-        z_bytes = int(z * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
+        frame = _move_frame(x, y, z)
 
-        self.serial_conn.write(b'm' + x_bytes + y_bytes + z_bytes + b'\r')
+        target = _decode_position(frame[1:])
+        mode = self._state.mode
 
         # Wait for response
-        self.serial_conn.read()
+        return self._transact(frame, decode=lambda response: self._state.moved(target, mode))
 
-    def send_and_execute_moves(self, moves: Sequence[Tuple[_Num, _Num, _Num]], program_num: int = 1):
+    def send_and_execute_moves(self, moves: _Moves, program_num: int = 1):
         """
         Sends and executes a sequence of moves on the manipulator. (Max 99 moves at a time)
 
-        :param moves: List of (x, y, z) coordinates in um
+        For longer sequences see api.trajectory.TrajectoryStreamer
+
+        :param moves: List or (N, 3) array of (x, y, z) coordinates in um
         :param program_num: Optional program number between 1 and 10
         """
 
-        if len(moves) > 99:
-            raise ValueError('Maximum number of moves exceed. Limit is 99')
+        byte_str = pack_moves(moves, program_num)
 
-        if not (1 <= program_num <= 10):
-            raise ValueError('Program number must be between 1 and 10')
+        mode = self._state.mode
+        target = _program_target(byte_str, mode)
 
-        # Header information:
-        # Command is 'd' followed by the program number followed by the number of moves
-        byte_str = b'd' + program_num.to_bytes(1, byteorder='little', signed=False) \
-                   + len(moves).to_bytes(1, byteorder='little', signed=False)
+        def operation(serial_conn: serial.Serial):
+            # Send program and wait for confirmation
+            serial_conn.write(byte_str)
+            serial_conn.read()
 
-        for move in moves:
-            x_bytes = int(move[0] * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
-            y_bytes = int(move[1] * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
-            z_bytes = int(move[2] * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
-            byte_str += x_bytes + y_bytes + z_bytes
+            # Execute program (Command 'k') and wait for completion
+            serial_conn.write(_execute_frame(program_num))
+            serial_conn.read()
 
-        byte_str += b'\r'
+            if target is not None:
+                self._state.moved(target, mode)
 
-        # Send program
-        self.serial_conn.write(byte_str)
+        return self._execute('d', operation)
 
-        # Wait for confirmation
-        self.serial_conn.read()
+    def move_relative(self, dx: _Num, dy: _Num, dz: _Num):
+        """
+        Moves the micromanipulator by an offset without reading its position first. Switches to relative mode if
+        needed
+
+        :param dx: X offset in um
+        :param dy: Y offset in um
+        :param dz: Z offset in um
+        """
+        self.set_mode(Mode.RELATIVE)
+        return self.go_to_position(dx, dy, dz)
 
-        # Execute program (Command 'k')
-        self.serial_conn.write(b'k' + program_num.to_bytes(1, byteorder='little', signed=False) + b'\r')
+    def move_relative_many(self, moves: _Moves, program_num: int = 1):
+        """
+        Executes a sequence of offsets as relative programs of up to 99 moves each. Switches to relative mode if
+        needed
 
-        # Wait for completion
-        self.serial_conn.read()
+        :param moves: List or (N, 3) array of (dx, dy, dz) offsets in um
+        :param program_num: Optional program number between 1 and 10
+        :return: Result of the last program (a Future of it if pipelined)
+        """
+        moves = np.asarray(moves, dtype=np.float64)
+
+        self.set_mode(Mode.RELATIVE)
+
+        result = None
+        for i in range(0, len(moves), MAX_PROGRAM_MOVES):
+            result = self.send_and_execute_moves(moves[i:i + MAX_PROGRAM_MOVES], program_num)
+
+        return result
 
     def set_velocity(self, velocity: _Num, resolution: Resolution):
         """
@@ -114,40 +299,30 @@ class Manipulator:
         :param resolution: Resolution either Resolution.HIGH (0.4um/second) or Resolution.LOW (2um/second)
         """
 
-        if velocity <= 0:
-            raise ValueError('Velocity must be positive')
+        steps = _velocity_word(velocity, resolution)
 
-        if resolution == Resolution.HIGH:
-            steps = int((velocity * _USTEPS_PER_UM_) / 50)
-        elif resolution == Resolution.LOW:
-            steps = int((velocity * _USTEPS_PER_UM_) / 10)
-        else:
-            raise ValueError('Use either HIGH_RESOLUTION or LOW_RESOLUTION')
+        if steps == self._state.velocity_word:
+            return self._skip('velocity')
 
-        steps = (resolution.value << 15) | steps
-
-        self.serial_conn.write(b'V' + steps.to_bytes(2, 'little') + b'\r')
+        self._state.velocity_word = steps
 
         # Wait for response
-        self.serial_conn.read()
+        return self._transact(b'V' + steps.to_bytes(2, 'little') + b'\r',
+                              decode=lambda response: self._state.velocity_set(steps))
 
     def set_origin(self):
         """
         Sets the origin of the manipulator
         """
-        self.serial_conn.write(b'o\r')
-
         # Wait for response
-        self.serial_conn.read()
+        return self._transact(b'o\r', decode=lambda response: self._state.moved((0.0, 0.0, 0.0), Mode.ABSOLUTE))
 
     def refresh_display(self):
         """
         Refreshes the display on the manipulator
         """
-        self.serial_conn.write(b'n\r')
-
         # Wait for response
-        self.serial_conn.read()
+        return self._transact(b'n\r')
 
     def set_mode(self, mode: Mode):
         """
@@ -155,49 +330,156 @@ class Manipulator:
         :param mode: options are ABSOLUTE or RELATIVE
         """
 
-        self.serial_conn.write(mode.value + b'\r')
+        if mode == self._state.mode:
+            return self._skip('mode')
+
+        self._state.mode = mode
 
         # Wait for response
-        self.serial_conn.read()
+        return self._transact(mode.value + b'\r', decode=lambda response: self._state.mode_set(mode))
 
     def interrupt(self):
         """
-        Interrupts the manipulator
+        Interrupts the manipulator. The interrupt is written straight to the port, without waiting for the port lock
+        or behind queued commands, so it stops a move another thread is waiting for
+
+        :return: None once acknowledged, or a Future resolving then if pipelined
         """
-        self.serial_conn.write(hex(3))
+        # Interrupt is a lone ETX (Ctrl-C) character
+        acknowledged = self._interrupts.send(self.serial_conn)
 
-        # Wait for response
-        self.serial_conn.read()
+        if self._pipeline is not None:
+            self._pipeline.wake()
+            return acknowledged
+
+        # The move (if any) reads its own CR first, the next one acknowledges the interrupt
+        with self._port_lock:
+            self._interrupts.read_acknowledgements(self.serial_conn)
 
     def continue_operation(self):
         """
         Resumes an operation on the manipulator
         """
-        self.serial_conn.write(b'e\r')
-
         # Wait for response
-        self.serial_conn.read()
+        return self._transact(b'e\r', decode=lambda response: self._state.moved(None, None))
 
     def reset(self):
         """
         Resets the manipulator. No value is returned from the manipulator
         """
-        self.serial_conn.write(b'r\r')
+        self._state.invalidate()
+        return self._transact(b'r\r', 0, decode=lambda response: self._state.invalidate())
 
-    def get_status(self):
+    def get_status(self, max_age: _Num = None):
         """
-        Returns a dict containing all status information from the mainpulator
+        Returns all status information from the mainpulator. Use to_dict() on the result for a dict of all fields
 
-        :return: Dict of all status information
+        :param max_age: Optionally override max_state_age for this read
+        :return: ManipulatorStatus (a Future of it if pipelined)
         """
-        self.serial_conn.write(b's\r')
+        max_age = self.max_state_age if max_age is None else max_age
+
+        status = self._state.get_status(max_age) if self._is_idle() else None
+        if status is not None:
+            return self._skip('status', status)
+
+        return self._transact(b's\r', 33, self._state.read_status)
+
+
+class StatusFlags(IntFlag):
+    """
+    Bits of the first status flag byte. The low nibble holds the SETUP number
+    """
+    ROE_DIR = 1 << 4  # Negative if set
+    REL_ABS_F = 1 << 5  # Absolute if set
+    MODE_F = 1 << 6  # Continuous if set, otherwise pulse
+    STORE_F = 1 << 7  # Stored if set, otherwise erased
+
+
+class StatusFlags2(IntFlag):
+    """
+    Bits of the second status flag byte
+    """
+    LOOP_MODE = 1 << 0  # Loop if set, otherwise execute once
+    LEARN_MODE = 1 << 1
+    STEP_MODE = 1 << 2  # 50 usteps/step if set, otherwise 10 usteps/step
+    JOYSTICK_SIDE = 1 << 3  # SW2_MODE
+    ENABLE_JOYSTICK = 1 << 4  # SW1_MODE, keypad if not set
+    ENABLE_ROE_SWITCH = 1 << 5  # SW3_MODE
+    SWITCHES_4_AND_5 = 1 << 6  # SW4_MODE
+    REVERSE_IT = 1 << 7  # Reversed if set, otherwise normal sequence
+
+
+# flags, udirx, udiry, udirz, roe_vari, uoffset, urange, pulse, uspeed, indevice, flags_2, jumpspd, highspd, dead,
+# watch_dog, step_div, step_mul, xspeed, version
+_STATUS_STRUCT = struct.Struct('<4B5H2B7H2s')
+
+
+class ManipulatorStatus:
+    """
+    Status block of the manipulator decoded from the 33 byte reply to 's'.
+
+    Fields are stored as raw integers; the flag bytes are only converted to StatusFlags/StatusFlags2 when accessed.
+    Indexing with the keys of to_dict (e.g. status['XSPEED']) is supported for backwards compatibility.
+    """
+
+    __slots__ = ('flags_word', 'udirx', 'udiry', 'udirz', 'roe_vari', 'uoffset', 'urange', 'pulse', 'uspeed',
+                 'indevice', 'flags_2_word', 'jumpspd', 'highspd', 'dead', 'watch_dog', 'step_div', 'step_mul',
+                 'xspeed_word', 'version')
+
+    def __init__(self, status_bytes: bytes):
+        (self.flags_word, self.udirx, self.udiry, self.udirz, self.roe_vari, self.uoffset, self.urange, self.pulse,
+         self.uspeed, self.indevice, self.flags_2_word, self.jumpspd, self.highspd, self.dead, self.watch_dog,
+         self.step_div, self.step_mul, self.xspeed_word, self.version) = _STATUS_STRUCT.unpack_from(status_bytes)
+
+    def copy(self) -> 'ManipulatorStatus':
+        status = ManipulatorStatus.__new__(ManipulatorStatus)
+        for name in ManipulatorStatus.__slots__:
+            setattr(status, name, getattr(self, name))
+        return status
 
-        status_bytes = self.serial_conn.read(33)
+    @property
+    def setup(self) -> int:
+        return self.flags_word & 0b00001111
 
-        flag_byte = status_bytes[0]
-        flag_2_byte = status_bytes[15]
+    @property
+    def flags(self) -> StatusFlags:
+        return StatusFlags(self.flags_word & ~0b00001111)
 
-        status = {
+    @property
+    def flags_2(self) -> StatusFlags2:
+        return StatusFlags2(self.flags_2_word)
+
+    @property
+    def mode(self) -> Mode:
+        return Mode.ABSOLUTE if self.flags_word & StatusFlags.REL_ABS_F else Mode.RELATIVE
+
+    @property
+    def xspeed_res(self) -> Resolution:
+        return Resolution.HIGH if self.xspeed_word & (1 << 15) else Resolution.LOW
+
+    @property
+    def xspeed(self) -> float:
+        """
+        Velocity in um/s
+        """
+        return _word_velocity(self.xspeed_word)
+
+    def __getitem__(self, key: str):
+        if key == 'XSPEED':
+            return self.xspeed
+        if key == 'XSPEED_RES':
+            return 'High Resolution' if self.xspeed_res == Resolution.HIGH else 'Low Resolution'
+        return self.to_dict()[key]
+
+    def to_dict(self) -> dict:
+        """
+        :return: The status as the nested dict of strings and numbers returned by earlier versions of get_status
+        """
+        flag_byte = self.flags_word
+        flag_2_byte = self.flags_2_word
+
+        return {
             'FLAGS': {
                 'SETUP': flag_byte & 0b00001111,
                 'ROE_DIR': 'Negative' if (flag_byte & (1 << 4)) == (1 << 4) else 'Positive',
@@ -205,15 +487,15 @@ class Manipulator:
                 'MODE_F': 'Continuous' if (flag_byte & (1 << 6)) == (1 << 6) else 'Pulse',
                 'STORE_F': 'Stored' if (flag_byte & (1 << 7)) == (1 << 7) else 'Erased'
             },
-            'UDIRX': status_bytes[1],
-            'UDIRY': status_bytes[2],
-            'UDIRZ': status_bytes[3],
-            'ROE_VARI': int.from_bytes(status_bytes[4:6], byteorder='little'),
-            'UOFFSET': int.from_bytes(status_bytes[6:8], byteorder='little'),
-            'URANGE': int.from_bytes(status_bytes[8:10], byteorder='little'),
-            'PULSE': int.from_bytes(status_bytes[10:12], byteorder='little'),
-            'USPEED': int.from_bytes(status_bytes[12:14], byteorder='little'),
-            'INDEVICE': status_bytes[14],
+            'UDIRX': self.udirx,
+            'UDIRY': self.udiry,
+            'UDIRZ': self.udirz,
+            'ROE_VARI': self.roe_vari,
+            'UOFFSET': self.uoffset,
+            'URANGE': self.urange,
+            'PULSE': self.pulse,
+            'USPEED': self.uspeed,
+            'INDEVICE': self.indevice,
             'FLAGS_2': {
                 'LOOP_MODE': 'Loop' if (flag_2_byte & (1 << 0)) == (1 << 0) else 'Execute Once',
                 'LEARN_MODE': 'Learning' if (flag_2_byte & (1 << 1)) == (1 << 1) else 'Not Learning',
@@ -224,23 +506,406 @@ class Manipulator:
                 '4_AND_5_SWITCHES': 'Enabled' if (flag_2_byte & (1 << 6)) == (1 << 6) else 'Disabled',  # SW4_MODE
                 'REVERSE_IT': 'Reversed' if (flag_2_byte & (1 << 7)) == (1 << 7) else 'Normal Sequence'
             },
-            'JUMPSPD': int.from_bytes(status_bytes[16:18], byteorder='little'),
-            'HIGHSPD': int.from_bytes(status_bytes[18:20], byteorder='little'),
-            'DEAD': int.from_bytes(status_bytes[20:22], byteorder='little'),
-            'WATCH_DOG': int.from_bytes(status_bytes[22:24], byteorder='little'),
-            'STEP_DIV': int.from_bytes(status_bytes[24:26], byteorder='little'),
-            'STEP_MUL': int.from_bytes(status_bytes[26:28], byteorder='little'),
-            'XSPEED_RES': 'High Resolution' if (int.from_bytes(status_bytes[28:30], byteorder='little') & (1 << 15)) == (
-                    1 << 15) else 'Low Resolution',
-            'XSPEED': int.from_bytes(status_bytes[28:30], byteorder='little') & ~(1 << 15),
-            'VERSION': status_bytes[30:32]  # TODO Bytes 31 and 32 Could be integer or Binary Coded decimal
+            'JUMPSPD': self.jumpspd,
+            'HIGHSPD': self.highspd,
+            'DEAD': self.dead,
+            'WATCH_DOG': self.watch_dog,
+            'STEP_DIV': self.step_div,
+            'STEP_MUL': self.step_mul,
+            'XSPEED_RES': self['XSPEED_RES'],
+            'XSPEED': self.xspeed,
+            'VERSION': self.version  # TODO Bytes 31 and 32 Could be integer or Binary Coded decimal
         }
 
-        # Convert the XSPEED back to an actual velocity value
 
-        if status['XSPEED_RES'] == 'Low Resolution':
-            status['XSPEED'] *= 10 / _USTEPS_PER_UM_
-        else:
-            status['XSPEED'] *= 50 / _USTEPS_PER_UM_
+def pack_moves(moves: _Moves, program_num: int = 1) -> bytearray:
+    """
+    Builds the 'd' command that uploads a sequence of moves as a program.
 
-        return status
+    All coordinates are converted to uSteps in one vectorized operation and written through a little-endian int32
+    view into a single preallocated frame.
+
+    :param moves: (N, 3) array or sequence of (x, y, z) coordinates in um
+    :param program_num: Program number between 1 and 10
+    :return: The complete command frame including the terminating CR
+    """
+
+    moves = np.asarray(moves, dtype=np.float64)
+    if moves.size == 0:
+        moves = moves.reshape(0, 3)
+
+    if moves.ndim != 2 or moves.shape[1] != 3:
+        raise ValueError('Moves must be a sequence of (x, y, z) coordinates')
+
+    if len(moves) > MAX_PROGRAM_MOVES:
+        raise ValueError('Maximum number of moves exceed. Limit is %d' % MAX_PROGRAM_MOVES)
+
+    if not (1 <= program_num <= MAX_PROGRAM_NUM):
+        raise ValueError('Program number must be between 1 and %d' % MAX_PROGRAM_NUM)
+
+    # NaN would slip through the range check below and be written as INT32_MIN
+    if not np.isfinite(moves).all():
+        raise ValueError('Moves must have finite coordinates')
+
+    # Truncate towards zero like int()
+    steps = np.trunc(moves * _USTEPS_PER_UM_)
+    if steps.size > 0 and (steps.min() < _INT32_MIN or steps.max() > _INT32_MAX):
+        raise OverflowError('Move out of range of the manipulator')
+
+    # Header information:
+    # Command is 'd' followed by the program number followed by the number of moves
+    frame = bytearray(_PROGRAM_HEADER_LENGTH + _MOVE_LENGTH * len(moves) + 1)
+    frame[0] = ord('d')
+    frame[1] = program_num
+    frame[2] = len(moves)
+    frame[-1] = ord('\r')
+
+    np.frombuffer(frame, dtype='<i4', count=steps.size, offset=_PROGRAM_HEADER_LENGTH)[:] = steps.ravel()
+
+    return frame
+
+
+def _program_target(frame: Union[bytes, bytearray], mode: Optional[Mode]) -> Optional[Tuple[float, float, float]]:
+    """
+    :param frame: Program frame built by pack_moves
+    :param mode: Mode the program runs in
+    :return: Where the program ends in absolute mode, its total offset in relative mode, None if it has no moves
+    """
+    if frame[2] == 0:
+        return None
+
+    if mode == Mode.RELATIVE:
+        return tuple(unpack_moves(frame)[1].sum(axis=0))
+
+    # The last move followed by the CR has the same layout as a position reply
+    return _decode_position(frame[-13:])
+
+
+def unpack_moves(frame: Union[bytes, bytearray]) -> Tuple[int, np.ndarray]:
+    """
+    Decodes a 'd' command frame built by pack_moves
+
+    :param frame: The complete command frame including the terminating CR
+    :return: The program number and an (N, 3) array of (x, y, z) coordinates in um
+    """
+
+    if len(frame) < _PROGRAM_HEADER_LENGTH + 1 or frame[0] != ord('d'):
+        raise ValueError('Not a program frame')
+
+    count = frame[2]
+    if len(frame) != _PROGRAM_HEADER_LENGTH + _MOVE_LENGTH * count + 1:
+        raise ValueError('Program frame length does not match its number of moves')
+
+    steps = np.frombuffer(frame, dtype='<i4', count=3 * count, offset=_PROGRAM_HEADER_LENGTH)
+
+    return frame[1], steps.reshape(count, 3) / _USTEPS_PER_UM_
+
+
+def _execute_frame(program_num: int) -> bytes:
+    """
+    Builds the 'k' command executing a stored program
+    """
+    return b'k' + program_num.to_bytes(1, byteorder='little', signed=False) + b'\r'
+
+
+def _move_frame(x: _Num, y: _Num, z: _Num) -> bytes:
+    """
+    Encodes an 'm' command to the position in um
+    """
+    x_bytes = int(x * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
+    y_bytes = int(y * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
+    z_bytes = int(z * _USTEPS_PER_UM_).to_bytes(4, byteorder='little', signed=True)
+
+    return b'm' + x_bytes + y_bytes + z_bytes + b'\r'
+
+
+def _velocity_word(velocity: _Num, resolution: Resolution) -> int:
+    """
+    Encodes a velocity in um/s as the 16 bit word of the 'V' command
+    """
+
+    if velocity <= 0:
+        raise ValueError('Velocity must be positive')
+
+    if resolution == Resolution.HIGH:
+        steps = int((velocity * _USTEPS_PER_UM_) / 50)
+    elif resolution == Resolution.LOW:
+        steps = int((velocity * _USTEPS_PER_UM_) / 10)
+    else:
+        raise ValueError('Use either HIGH_RESOLUTION or LOW_RESOLUTION')
+
+    return (resolution.value << 15) | steps
+
+
+def _word_velocity(velocity_word: int) -> float:
+    """
+    Decodes the 16 bit velocity word of the 'V' command into um/s
+    """
+    usteps_per_step = 50 if velocity_word & (1 << 15) else 10
+    return (velocity_word & ~(1 << 15)) * (usteps_per_step / _USTEPS_PER_UM_)
+
+
+def _decode_position(position_bytes: bytes) -> Tuple[float, float, float]:
+    """
+    Converts the 13 byte position reply of the manipulator into um
+    """
+    x = int.from_bytes(position_bytes[0:4], byteorder='little', signed=True)
+    y = int.from_bytes(position_bytes[4:8], byteorder='little', signed=True)
+    z = int.from_bytes(position_bytes[8:12], byteorder='little', signed=True)
+
+    return float(x / _USTEPS_PER_UM_), float(y / _USTEPS_PER_UM_), float(z / _USTEPS_PER_UM_)
+
+
+class _DeviceState:
+    """
+    Mirror of the manipulator state.
+
+    mode and velocity_word hold the last commanded values and are updated as soon as a command is issued. The
+    position and status are updated when the commands affecting them complete.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self.mode = None
+            self.velocity_word = None
+            self._position = None
+            self._position_time = 0.0
+            self._status = None
+            self._status_time = 0.0
+
+    def get_position(self, max_age: _Num) -> Optional[Tuple[float, float, float]]:
+        with self._lock:
+            if self._position is None or time.monotonic() - self._position_time > max_age:
+                return None
+            return self._position
+
+    def read_position(self, position_bytes: bytes) -> Tuple[float, float, float]:
+        position = _decode_position(position_bytes)
+
+        with self._lock:
+            self._position = position
+            self._position_time = time.monotonic()
+
+        return position
+
+    def moved(self, target: Optional[Tuple[float, float, float]], mode: Optional[Mode]):
+        """
+        Records a completed move. The position is forgotten if the target or the mode it was sent in is unknown
+        """
+        with self._lock:
+            if target is None or mode is None:
+                self._position = None
+            elif mode == Mode.RELATIVE:
+                if self._position is not None:
+                    # Add in uSteps to avoid accumulating rounding errors
+                    self._position = tuple((round(p * _USTEPS_PER_UM_) + round(d * _USTEPS_PER_UM_)) / _USTEPS_PER_UM_
+                                           for p, d in zip(self._position, target))
+            else:
+                self._position = target
+
+            self._position_time = time.monotonic()
+
+    def mode_set(self, mode: Mode):
+        with self._lock:
+            if self._status is not None:
+                if mode == Mode.ABSOLUTE:
+                    self._status.flags_word |= StatusFlags.REL_ABS_F
+                else:
+                    self._status.flags_word &= ~StatusFlags.REL_ABS_F
+
+    def velocity_set(self, velocity_word: int):
+        with self._lock:
+            if self._status is not None:
+                self._status.xspeed_word = velocity_word
+
+    def get_status(self, max_age: _Num) -> Optional['ManipulatorStatus']:
+        with self._lock:
+            if self._status is None or time.monotonic() - self._status_time > max_age:
+                return None
+            return self._status.copy()
+
+    def read_status(self, status_bytes: bytes) -> 'ManipulatorStatus':
+        status = ManipulatorStatus(status_bytes)
+
+        with self._lock:
+            self._status = status
+            self._status_time = time.monotonic()
+
+            # Seed the commanded state if nothing was commanded yet
+            if self.mode is None:
+                self.mode = status.mode
+            if self.velocity_word is None:
+                self.velocity_word = status.xspeed_word
+
+            return status.copy()
+
+
+class _ResponseTimes:
+    """
+    Accumulates per command queue wait and response times, and journals every command if given a journal
+    """
+
+    def __init__(self, journal: Journal = None, journal_device: int = DEVICE_MANIPULATOR):
+        self.journal = journal
+        self.journal_device = journal_device
+
+        self._lock = threading.Lock()
+        self._times = {}  # opcode -> [count, total wait, total response, max response]
+
+    def record(self, opcode: Optional[str], wait_time: float, response_time: float):
+        if opcode is None:
+            return
+
+        if self.journal is not None:
+            self.journal.record(self.journal_device, label_opcode(opcode), latency=response_time,
+                                timestamp=time.monotonic() - response_time)
+
+        with self._lock:
+            times = self._times.setdefault(opcode, [0, 0.0, 0.0, 0.0])
+            times[0] += 1
+            times[1] += wait_time
+            times[2] += response_time
+            times[3] = max(times[3], response_time)
+
+    def reset(self):
+        with self._lock:
+            self._times.clear()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: Dict of opcode to count, mean queue wait, mean and max response times in seconds
+        """
+        with self._lock:
+            return {opcode: {'count': count,
+                             'mean_wait': total_wait / count,
+                             'mean_response': total_response / count,
+                             'max_response': max_response}
+                    for opcode, (count, total_wait, total_response, max_response) in self._times.items()}
+
+
+class _Interrupts:
+    """
+    Interrupts written to the port whose acknowledging CR has not been read yet. The CR arrives after the response of
+    the command that was running, so it has to be read before the next command's response
+    """
+
+    def __init__(self, on_acknowledged: Callable[[], None]):
+        self.on_acknowledged = on_acknowledged
+
+        self._unread = []
+        self._lock = threading.Lock()
+
+    def sent(self) -> Future:
+        """
+        Registers an interrupt about to be written to the port, for callers that write it themselves. Registered first,
+        so the port's owner cannot miss the CR
+
+        :return: Future resolving to None once the interrupt's CR was read
+        """
+        future = Future()
+        with self._lock:
+            self._unread.append(future)
+        return future
+
+    def send(self, serial_conn: serial.Serial) -> Future:
+        """
+        Writes an interrupt
+
+        :return: Future resolving to None once the interrupt's CR was read
+        """
+        future = self.sent()
+        serial_conn.write(b'\x03')
+        return future
+
+    def take(self) -> List[Future]:
+        """
+        :return: The interrupts whose CR comes next on the port. Must only be called by whoever owns the port
+        """
+        with self._lock:
+            unread, self._unread = self._unread, []
+        return unread
+
+    def acknowledged(self, future: Future):
+        """
+        Marks an interrupt taken with take() as acknowledged once its CR was read
+        """
+        self.on_acknowledged()
+        future.set_result(None)
+
+    def read_acknowledgements(self, serial_conn: serial.Serial):
+        """
+        Reads the CR of every interrupt sent so far. Must only be called by whoever owns the port
+        """
+        for future in self.take():
+            serial_conn.read(1)
+            self.acknowledged(future)
+
+
+class _CommandPipeline(threading.Thread):
+    """
+    I/O thread that owns the serial port and runs queued operations in order
+    """
+
+    # Queued to have an idle thread read interrupt acknowledgements
+    _WAKE = 'wake'
+
+    def __init__(self, serial_conn: serial.Serial, response_times: _ResponseTimes, on_error: Callable[[], None],
+                 interrupts: _Interrupts):
+        self.serial_conn = serial_conn
+        self.response_times = response_times
+        self.on_error = on_error
+        self.interrupts = interrupts
+        self.commands = queue.Queue()
+
+        # Number of submitted operations that have not completed
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+
+        super().__init__(daemon=True)
+
+    def submit(self, opcode: str, operation: Callable[[serial.Serial], Any]) -> Future:
+        future = Future()
+        with self._pending_lock:
+            self.pending += 1
+        self.commands.put((opcode, operation, future, time.perf_counter()))
+        return future
+
+    def wake(self):
+        self.commands.put(self._WAKE)
+
+    def stop(self, timeout: Optional[_Num] = 10):
+        self.commands.put(None)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            command = self.commands.get()
+
+            # Interrupts sent while the previous command ran are acknowledged before anything else
+            self.interrupts.read_acknowledgements(self.serial_conn)
+
+            if command is None:
+                break
+            if command is self._WAKE:
+                continue
+
+            opcode, operation, future, queued_at = command
+            start = time.perf_counter()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = operation(self.serial_conn)
+                except Exception as e:
+                    self.on_error()
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+                self.response_times.record(opcode, start - queued_at, time.perf_counter() - start)
+
+            with self._pending_lock:
+                self.pending -= 1
@@ -0,0 +1,204 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Sequence, Tuple, Union, Callable, Any, List, Dict
+
+from api.journal import DEVICE_MANIPULATOR
+from api.manipulator import Manipulator, Mode, Resolution, MAX_PROGRAM_MOVES, _Moves
+from api.trajectory import TrajectoryStreamer
+
+_Num = Union[int, float]
+
+
+class ManipulatorGroup:
+    """
+    Drives several manipulators on separate ports concurrently.
+
+    Every group command is issued to all manipulators at once from a thread pool and returns once all of them have
+    finished ("all arrived"), so a coordinated move takes as long as the slowest device rather than the sum.
+    """
+
+    def __init__(self, comm_ports: Sequence[str], **manipulator_kwargs):
+        """
+        :param comm_ports: Serial port of each manipulator
+        :param manipulator_kwargs: Keyword arguments passed on to every Manipulator
+        """
+
+        self.comm_ports = list(comm_ports)
+        # Each manipulator gets its own journal device id
+        journal_device = manipulator_kwargs.pop('journal_device', DEVICE_MANIPULATOR)
+        self.manipulators = [Manipulator(port, journal_device=journal_device + index, **manipulator_kwargs)
+                             for index, port in enumerate(self.comm_ports)]
+
+        self.latencies = _GroupLatencies(self.comm_ports)
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.manipulators)))
+
+    def __len__(self):
+        return len(self.manipulators)
+
+    def __getitem__(self, index: int) -> Manipulator:
+        return self.manipulators[index]
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown()
+            self._executor = None
+
+        for manipulator in getattr(self, 'manipulators', []):
+            manipulator.close()
+
+    def run(self, calls: Sequence[Callable[[Manipulator], Any]], timeout: _Num = None) -> List[Any]:
+        """
+        Runs one call per manipulator concurrently and waits until all of them have completed
+
+        :param calls: One callable per manipulator, receiving that manipulator
+        :param timeout: Optional maximum time to wait for all manipulators in seconds
+        :return: List of results in manipulator order
+        """
+
+        if len(calls) != len(self.manipulators):
+            raise ValueError('Expected %d calls, one per manipulator' % len(self.manipulators))
+
+        start = time.perf_counter()
+        futures = [self._executor.submit(self._timed, index, call) for index, call in enumerate(calls)]
+
+        done, not_done = wait(futures, timeout)
+        if not_done:
+            raise TimeoutError('%d of %d manipulators did not finish in time' % (len(not_done), len(futures)))
+
+        self.latencies.record_cycle(time.perf_counter() - start)
+
+        # Raises the first error if any manipulator failed
+        return [future.result() for future in futures]
+
+    def _timed(self, index: int, call: Callable[[Manipulator], Any]) -> Any:
+        start = time.perf_counter()
+
+        result = call(self.manipulators[index])
+        if isinstance(result, Future):
+            # Pipelined manipulators return futures
+            result = result.result()
+
+        self.latencies.record(index, time.perf_counter() - start)
+        return result
+
+    def run_all(self, call: Callable[[Manipulator], Any], timeout: _Num = None) -> List[Any]:
+        """
+        Runs the same call on every manipulator concurrently and waits until all of them have completed
+        """
+        return self.run([call] * len(self.manipulators), timeout)
+
+    def go_to_positions(self, positions: Sequence[Tuple[_Num, _Num, _Num]], timeout: _Num = None):
+        """
+        Moves every manipulator to its own absolute position
+
+        :param positions: One (x, y, z) position in um per manipulator
+        :param timeout: Optional maximum time to wait for all manipulators in seconds
+        """
+        self.run([lambda manipulator, position=position: _absolute_move(manipulator, position)
+                  for position in positions], timeout)
+
+    def move_relative(self, offsets: Sequence[Tuple[_Num, _Num, _Num]], timeout: _Num = None):
+        """
+        Moves every manipulator by its own offset
+
+        :param offsets: One (dx, dy, dz) offset in um per manipulator
+        :param timeout: Optional maximum time to wait for all manipulators in seconds
+        """
+        self.run([lambda manipulator, offset=offset: manipulator.move_relative(*offset) for offset in offsets],
+                 timeout)
+
+    def send_and_execute_moves(self, moves: Sequence[_Moves], program_num: int = 1, timeout: _Num = None):
+        """
+        Uploads and executes a program of absolute moves on every manipulator. Programs longer than 99 moves are
+        streamed
+
+        :param moves: One move list per manipulator
+        :param program_num: Program number between 1 and 10 used for programs of up to 99 moves
+        :param timeout: Optional maximum time to wait for all manipulators in seconds
+        """
+        self.run([lambda manipulator, device_moves=device_moves: _program(manipulator, device_moves, program_num)
+                  for device_moves in moves], timeout)
+
+    def set_velocity(self, velocity: _Num, resolution: Resolution):
+        self.run_all(lambda manipulator: manipulator.set_velocity(velocity, resolution))
+
+    def set_mode(self, mode: Mode):
+        self.run_all(lambda manipulator: manipulator.set_mode(mode))
+
+    def get_current_positions(self) -> List[Tuple[float, float, float]]:
+        return self.run_all(lambda manipulator: manipulator.get_current_position())
+
+    def interrupt(self):
+        """
+        Interrupts every manipulator from the calling thread rather than the thread pool, where the interrupts would
+        wait behind the group move they are meant to stop
+        """
+        results = [manipulator.interrupt() for manipulator in self.manipulators]
+
+        # Pipelined manipulators send the interrupt at once and acknowledge it later
+        for result in results:
+            if isinstance(result, Future):
+                result.result()
+
+
+def _absolute_move(manipulator: Manipulator, position: Tuple[_Num, _Num, _Num]):
+    manipulator.set_mode(Mode.ABSOLUTE)
+    return manipulator.go_to_position(*position)
+
+
+def _program(manipulator: Manipulator, moves: _Moves, program_num: int):
+    manipulator.set_mode(Mode.ABSOLUTE)
+    if len(moves) <= MAX_PROGRAM_MOVES:
+        return manipulator.send_and_execute_moves(moves, program_num)
+    return TrajectoryStreamer(manipulator).stream(moves)
+
+
+class _GroupLatencies:
+    """
+    Per device command latencies and the time each group command took until all devices arrived
+    """
+
+    def __init__(self, comm_ports: Sequence[str]):
+        self._lock = threading.Lock()
+        self.comm_ports = list(comm_ports)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._devices = [[0, 0.0, 0.0, 0.0] for _ in self.comm_ports]  # count, total, max, last
+            self._cycles = [0, 0.0, 0.0]  # count, total, max
+
+    def record(self, index: int, latency: float):
+        with self._lock:
+            device = self._devices[index]
+            device[0] += 1
+            device[1] += latency
+            device[2] = max(device[2], latency)
+            device[3] = latency
+
+    def record_cycle(self, duration: float):
+        with self._lock:
+            self._cycles[0] += 1
+            self._cycles[1] += duration
+            self._cycles[2] = max(self._cycles[2], duration)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: Dict of port to count, mean, max and last latency in seconds, plus a 'group' entry with the mean and
+                 max time until all devices arrived and the sum of device latencies it replaced
+        """
+        with self._lock:
+            summary = {port: {'count': count, 'mean': total / count if count else 0.0, 'max': maximum, 'last': last}
+                       for port, (count, total, maximum, last) in zip(self.comm_ports, self._devices)}
+
+            count, total, maximum = self._cycles
+            summary['group'] = {'count': count, 'mean': total / count if count else 0.0, 'max': maximum,
+                                'sequential_total': sum(device[1] for device in self._devices), 'total': total}
+
+            return summary
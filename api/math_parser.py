@@ -1,54 +1,351 @@
-from typing import Tuple, List
+import ast
+import math
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Tuple, List, Union, Dict, Iterator, Optional
 
-from asteval import Interpreter
+import numpy as np
+from asteval import Interpreter, make_symbol_table
 
-aeval = Interpreter()
+_Num = Union[int, float]
 
 
-aeval("""
 def step(x):
-    \"\"\"
+    """
     Heaviside step function
     step(x) = 0 if x < 0
             = 1 if x >= 0
 
-    :param x:
-    :return:
-    \"\"\"
-    
-    return int(x >= 0)
-""")
+    :param x: Number or array
+    :return: 0 or 1, as an array if x is one
+    """
+    return np.heaviside(x, 1)
 
-def parse_equation(equation_str: str, variable: str, var_range: Tuple[float, float], var_step: float) -> List[
-    Tuple[float, float]]:
+
+def new_interpreter() -> Interpreter:
     """
-    Transforms a continuous single variable equation string into a list of discrete values.
+    :return: Interpreter with its own symbol table of the functions and constants equations may use
+    """
+    return Interpreter(make_symbol_table(use_numpy=True, step=step))
+
+
+# Names equations may use besides their variable
+_SYMBOLS = frozenset(new_interpreter().symtable)
+
+
+class InterpreterPool:
+    """
+    Interpreters handed out to one caller at a time, so equations can be evaluated from several threads at once
+    without their variables overwriting each other in a shared symbol table
+    """
+
+    def __init__(self, max_idle: int = 8):
+        """
+        :param max_idle: Number of returned interpreters kept for reuse, any more are discarded
+        """
+        self.max_idle = max_idle
+
+        self.created = 0
+        self.borrowed = 0
+
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def borrow(self):
+        """
+        Lends an interpreter for the block, creating one if none is idle
+        """
+        with self._lock:
+            self.borrowed += 1
+            interpreter = self._idle.pop() if self._idle else None
+
+        if interpreter is None:
+            interpreter = new_interpreter()
+            with self._lock:
+                self.created += 1
+
+        try:
+            yield interpreter
+        finally:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(interpreter)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'created': self.created, 'borrowed': self.borrowed, 'idle': len(self._idle),
+                    'max_idle': self.max_idle}
+
+
+# Interpreters used by Equation calls that do not pass their own
+interpreters = InterpreterPool()
+
+
+class Equation:
+    """
+    Single variable equation string parsed and validated once, then evaluated over whole NumPy arrays of the variable.
     For supported operations see http://newville.github.io/asteval/basics.html#built-in-functions
 
     Also supports step(x) for Heaviside step function. (Useful if a piecewise function is needed)
 
+    Expressions that only work on scalars, e.g. conditional expressions on the variable, are evaluated element by
+    element instead, which gives the same values as parse_equation always did, only slower.
+
+    An Equation holds no evaluation state, each call borrows an interpreter from the shared pool or uses the one
+    passed in, so the same Equation can be evaluated from several threads at once. Equations pickle as their string
+    and variable, e.g. to compile waves in a process pool.
+    """
+
+    def __init__(self, equation_str: str, variable: str):
+        """
+        :param equation_str: String that contains variable and operators
+        :param variable: String that represents the variable
+        :raises ValueError: If the string is not a single expression, uses names other than variable and the
+                            supported functions and constants, or variable shadows one of them
+        """
+
+        if variable in _SYMBOLS:
+            raise ValueError('Variable %s shadows a function or constant' % variable)
+
+        self.equation_str = equation_str
+        self.variable = variable
+
+        try:
+            tree = ast.parse(equation_str.strip(), mode='eval')
+        except SyntaxError as error:
+            raise ValueError('Could not parse %s: %s' % (equation_str, error.msg))
+
+        unknown = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+                         - {variable} - _SYMBOLS)
+        if unknown:
+            raise ValueError('Unknown names in %s: %s' % (equation_str, ', '.join(unknown)))
+
+        self._node = ast.Expr(tree.body)
+        ast.copy_location(self._node, tree.body)
+
+    def __repr__(self):
+        return 'Equation(%r, %r)' % (self.equation_str, self.variable)
+
+    def __reduce__(self):
+        return Equation, (self.equation_str, self.variable)
+
+    def __call__(self, values: Union[_Num, np.ndarray], interpreter: Interpreter = None) -> np.ndarray:
+        """
+        :param values: Value or array of values of the variable
+        :param interpreter: Interpreter from new_interpreter to evaluate in, borrowed from the shared pool if None.
+                            Must not be used by another thread at the same time
+        :return: Array of the equation's values, the same shape as values
+        """
+        values = np.asarray(values, dtype=np.float64)
+
+        if interpreter is None:
+            with interpreters.borrow() as interpreter:
+                return self._evaluate(values, interpreter)
+
+        return self._evaluate(values, interpreter)
+
+    def _evaluate(self, values: np.ndarray, interpreter: Interpreter) -> np.ndarray:
+        try:
+            try:
+                result = np.asarray(self._run(values, interpreter), dtype=np.float64)
+                return np.broadcast_to(result, values.shape).copy()
+            except ValueError:
+                # Scalar only expression, e.g. 'a if t < 1 else b'
+                return np.array([float(self._run(value, interpreter)) for value in values.ravel().tolist()],
+                                dtype=np.float64).reshape(values.shape)
+        finally:
+            # Pooled interpreters must not keep large arrays alive
+            interpreter.symtable.pop(self.variable, None)
+
+    def _run(self, values: Union[float, np.ndarray], interpreter: Interpreter):
+        interpreter.symtable[self.variable] = values
+        interpreter.error = []
+
+        try:
+            return interpreter.run(self._node, expr=self.equation_str)
+        except Exception as error:
+            message = interpreter.error[0].get_error()[1].splitlines()[-1] if interpreter.error else repr(error)
+            raise ValueError('Could not evaluate %s: %s' % (self.equation_str, message))
+
+    def sample(self, var_range: Tuple[float, float], var_step: float,
+               interpreter: Interpreter = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param var_range: start <= variable < end
+        :param var_step: Discretization increment for variable
+        :param interpreter: Interpreter to evaluate in, borrowed from the shared pool if None
+        :return: Arrays of the variable and the equation's values. The variable is start + i * var_step, so rounding
+                 errors do not build up along the range
+        """
+        variable_values = sample_range(var_range, var_step)
+        return variable_values, self(variable_values, interpreter)
+
+    def chunks(self, var_range: Tuple[float, float], var_step: float, chunk_size: int = 4096,
+               interpreter: Interpreter = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Samples the equation like sample, but lazily, one chunk at a time, so a long range never has to be held in
+        memory at once
+
+        :param var_range: start <= variable < end. end may be infinite, the chunks then never run out
+        :param var_step: Discretization increment for variable
+        :param chunk_size: Number of samples per chunk
+        :param interpreter: Interpreter to evaluate in, borrowed from the shared pool for each chunk if None
+        :return: Iterator of (variable, values) array pairs
+        """
+        if chunk_size <= 0:
+            raise ValueError('Chunk size must be positive')
+
+        num_samples = _num_samples(var_range, var_step)
+
+        index = 0
+        while num_samples is None or index < num_samples:
+            count = chunk_size if num_samples is None else min(chunk_size, num_samples - index)
+
+            # Indexed from the start of the range like sample, so chunks line up exactly
+            variable_values = var_range[0] + np.arange(index, index + count) * var_step
+            yield variable_values, self(variable_values, interpreter)
+
+            index += count
+
+
+def sample_range(var_range: Tuple[float, float], var_step: float) -> np.ndarray:
+    """
+    :param var_range: start <= variable < end
+    :param var_step: Discretization increment for variable
+    :return: Array of start + i * var_step for every i that stays below end
+    """
+    num_samples = _num_samples(var_range, var_step)
+    if num_samples is None:
+        raise ValueError('Range must be finite')
+
+    return var_range[0] + np.arange(num_samples) * var_step
+
+
+def _num_samples(var_range: Tuple[float, float], var_step: float) -> Optional[int]:
+    """
+    :return: Number of samples start + i * var_step below end, None if end is infinite
+    """
+    start, end = var_range
+    if var_step <= 0:
+        raise ValueError('Step must be positive')
+
+    if math.isinf(end) and end > 0:
+        return None
+
+    num_samples = max(0, int(math.ceil((end - start) / var_step)))
+    # Guard against the division rounding up past the last value below end
+    while num_samples > 0 and start + (num_samples - 1) * var_step >= end:
+        num_samples -= 1
+
+    return num_samples
+
+
+class EquationCache:
+    """
+    Least recently used cache of compiled equations, keyed on the equation string with its whitespace normalized and
+    the variable name. Equations that fail to compile are not cached
+    """
+
+    def __init__(self, max_equations: int = 256):
+        """
+        :param max_equations: Number of equations kept before the least recently used are evicted
+        """
+        self.max_equations = max_equations
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._equations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._equations)
+
+    def get(self, equation_str: str, variable: str) -> Equation:
+        """
+        :param equation_str: String that contains variable and operators
+        :param variable: String that represents the variable
+        :return: The cached or newly compiled equation
+        """
+        key = (' '.join(equation_str.split()), variable)
+
+        with self._lock:
+            equation = self._equations.get(key)
+            if equation is not None:
+                self._equations.move_to_end(key)
+                self.hits += 1
+                return equation
+            self.misses += 1
+
+        equation = Equation(key[0], variable)
+
+        with self._lock:
+            self._equations[key] = equation
+            self._equations.move_to_end(key)
+
+            while len(self._equations) > max(1, self.max_equations):
+                self._equations.popitem(last=False)
+                self.evictions += 1
+
+        return equation
+
+    def clear(self):
+        with self._lock:
+            self._equations.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'equations': len(self._equations), 'max_equations': self.max_equations, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+# Shared by everything evaluating equation strings, e.g. the GUI plotting a wave and then starting it
+equations = EquationCache()
+
+
+def compile_equation(equation_str: str, variable: str) -> Equation:
+    """
+    Parses and validates an equation string once for repeated evaluation. Compiled equations are kept in the shared
+    equations cache
+
+    :param equation_str: String that contains variable and operators
+    :param variable: String that represents the variable
+    :returns: Equation callable on values or arrays of values of variable
+    """
+    return equations.get(equation_str, variable)
+
+
+def evaluate_equation(equation_str: str, variable: str, var_range: Tuple[float, float],
+                      var_step: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Transforms a continuous single variable equation string into arrays of discrete values
+
     :param equation_str: String that contains variable and operators
     :param variable: String that represents the variable
     :param var_range: start <= variable < end
     :param var_step: Discretization increment for variable
-    :returns: A list of tuples representing the (variable, equation_str(variable)) pairs within the range
+    :returns: Arrays of the variable and the equation's values within the range
     """
+    return compile_equation(equation_str, variable).sample(var_range, var_step)
 
-    aeval.symtable['start'] = var_range[0]
-    aeval.symtable['end'] = var_range[1]
-    aeval.symtable['computed_values'] = []
-    aeval.symtable['step'] = var_step
-    aeval.symtable[variable] = aeval.symtable['start']
 
+def parse_equation(equation_str: str, variable: str, var_range: Tuple[float, float], var_step: float) -> List[
+    Tuple[float, float]]:
+    """
+    Transforms a continuous single variable equation string into a list of discrete values.
+    For supported operations see http://newville.github.io/asteval/basics.html#built-in-functions
 
-    aeval(
-"""
-while %(variable)s < end:
-    computed_values.append((%(variable)s, %(expression)s))
-    %(variable)s += step
-"""
-        % {'variable': variable, 'expression': equation_str}
-    )
+    Also supports step(x) for Heaviside step function. (Useful if a piecewise function is needed)
 
+    Kept for existing callers, evaluate_equation returns the same values as arrays and is much faster to consume
 
-    return aeval.symtable['computed_values']
\ No newline at end of file
+    :param equation_str: String that contains variable and operators
+    :param variable: String that represents the variable
+    :param var_range: start <= variable < end
+    :param var_step: Discretization increment for variable
+    :returns: A list of tuples representing the (variable, equation_str(variable)) pairs within the range
+    """
+    variable_values, values = evaluate_equation(equation_str, variable, var_range, var_step)
+    return list(zip(variable_values.tolist(), values.tolist()))
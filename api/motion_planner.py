@@ -0,0 +1,162 @@
+import time
+from typing import Sequence, Tuple, List, NamedTuple, Optional, Union
+
+import numpy as np
+
+from api.manipulator import Manipulator, Mode, Resolution, MAX_PROGRAM_MOVES, RECOMMENDED_MAX_VELOCITY, \
+    _velocity_word, _word_velocity
+from api.trajectory import TrajectoryStreamer
+
+_Num = Union[int, float]
+
+# Time to send a 'V' command and split the program around it
+_SWITCH_TIME = 0.02
+
+
+class Segment(NamedTuple):
+    target: Tuple[_Num, _Num, _Num]  # Absolute (x, y, z) in um
+    resolution: Optional[Resolution] = None  # Required resolution, None if either is acceptable
+    max_velocity: Optional[_Num] = None  # Speed limit for this segment in um/s, None for the resolution ceiling
+
+
+class Run(NamedTuple):
+    velocity: float  # um/s as the manipulator will execute it
+    resolution: Resolution
+    moves: np.ndarray  # (N, 3) absolute coordinates in um
+    duration: float  # Predicted travel time in seconds
+
+
+class VelocityPlan(NamedTuple):
+    runs: List[Run]
+    velocity_changes: int
+    predicted_time: float  # Travel time plus velocity changes in seconds
+
+
+def plan_velocities(start: Tuple[_Num, _Num, _Num], segments: Sequence[Segment],
+                    max_velocity: dict = None, switch_time: _Num = _SWITCH_TIME,
+                    initial: Tuple[_Num, Resolution] = None) -> VelocityPlan:
+    """
+    Chooses the velocity and resolution of each segment to minimize the total time of a move list.
+
+    Each segment runs at the fastest setting its resolution requirement and speed limit allow, unless keeping the
+    previous setting for a short segment is cheaper than paying switch_time for another 'V' command.
+
+    :param start: Absolute (x, y, z) position in um the manipulator starts from
+    :param segments: Segments to travel in order
+    :param max_velocity: Dict of Resolution to velocity ceiling in um/s. Defaults to RECOMMENDED_MAX_VELOCITY
+    :param switch_time: Cost in seconds of changing the velocity between segments
+    :param initial: Optional (velocity, resolution) the manipulator is already set to
+    :return: VelocityPlan with runs of consecutive segments sharing a setting
+    """
+
+    if max_velocity is None:
+        max_velocity = RECOMMENDED_MAX_VELOCITY
+
+    if len(segments) == 0:
+        return VelocityPlan([], 0, 0.0)
+
+    targets = np.array([segment.target for segment in segments], dtype=np.float64)
+    distances = np.linalg.norm(np.diff(np.vstack((np.asarray(start, dtype=np.float64), targets)), axis=0), axis=1)
+
+    # Candidate settings are the fastest setting of every segment for each resolution it accepts
+    settings = set()
+    for segment in segments:
+        for resolution in _allowed_resolutions(segment):
+            settings.add(_quantize(_segment_ceiling(segment, resolution, max_velocity), resolution))
+    if initial is not None:
+        settings.add(_quantize(*initial))
+
+    settings = sorted(settings, key=lambda setting: (setting[1].value, setting[0]))
+    velocities = np.array([velocity for velocity, _ in settings])
+
+    # Dynamic programming over (segment, setting) with a fixed cost per velocity change
+    costs = np.empty((len(segments), len(settings)))
+    previous = np.zeros((len(segments), len(settings)), dtype=int)
+
+    for i, segment in enumerate(segments):
+        feasible = np.array([resolution in _allowed_resolutions(segment)
+                             and velocity <= _segment_ceiling(segment, resolution, max_velocity) + 1e-9
+                             for velocity, resolution in settings])
+        travel = np.where(feasible, distances[i] / velocities, np.inf)
+
+        if i == 0:
+            if initial is not None:
+                entry = np.array([0.0 if setting == _quantize(*initial) else switch_time for setting in settings])
+            else:
+                entry = np.full(len(settings), switch_time)
+            costs[0] = travel + entry
+            continue
+
+        best = int(np.argmin(costs[i - 1]))
+        switch = costs[i - 1][best] + switch_time
+        stay = costs[i - 1]
+
+        previous[i] = np.where(stay <= switch, np.arange(len(settings)), best)
+        costs[i] = np.minimum(stay, switch) + travel
+
+    if not np.isfinite(costs[-1]).any():
+        raise ValueError('No velocity satisfies every segment')
+
+    # Walk back through the chosen settings
+    choice = [0] * len(segments)
+    choice[-1] = int(np.argmin(costs[-1]))
+    for i in range(len(segments) - 1, 0, -1):
+        choice[i - 1] = previous[i][choice[i]]
+
+    runs = []
+    run_start = 0
+    for i in range(1, len(segments) + 1):
+        if i == len(segments) or choice[i] != choice[run_start]:
+            velocity, resolution = settings[choice[run_start]]
+            runs.append(Run(velocity, resolution, targets[run_start:i],
+                            float(distances[run_start:i].sum() / velocity)))
+            run_start = i
+
+    velocity_changes = len(runs) - (1 if initial is not None and settings[choice[0]] == _quantize(*initial) else 0)
+
+    return VelocityPlan(runs, velocity_changes, float(costs[-1].min()))
+
+
+def execute_plan(manipulator: Manipulator, plan: VelocityPlan) -> float:
+    """
+    Runs a velocity plan in absolute mode. 'V' commands are only sent where the velocity changes
+
+    :param manipulator: Manipulator to move
+    :param plan: Plan returned by plan_velocities
+    :return: Elapsed time in seconds, to compare with plan.predicted_time
+    """
+
+    start = time.perf_counter()
+
+    manipulator.set_mode(Mode.ABSOLUTE)
+    for run in plan.runs:
+        manipulator.set_velocity(run.velocity, run.resolution)
+
+        if len(run.moves) <= MAX_PROGRAM_MOVES:
+            manipulator.send_and_execute_moves(run.moves)
+        else:
+            TrajectoryStreamer(manipulator).stream(run.moves)
+
+    manipulator.wait_all()
+
+    return time.perf_counter() - start
+
+
+def _allowed_resolutions(segment: Segment) -> Tuple[Resolution, ...]:
+    return (segment.resolution,) if segment.resolution is not None else (Resolution.HIGH, Resolution.LOW)
+
+
+def _segment_ceiling(segment: Segment, resolution: Resolution, max_velocity: dict) -> float:
+    ceiling = max_velocity[resolution]
+    return ceiling if segment.max_velocity is None else min(ceiling, segment.max_velocity)
+
+
+def _quantize(velocity: _Num, resolution: Resolution) -> Tuple[float, Resolution]:
+    """
+    Rounds a velocity down to what the manipulator executes for the given resolution
+    """
+    quantized = _word_velocity(_velocity_word(velocity, resolution))
+    if quantized <= 0:
+        raise ValueError('Velocity %f is below the smallest increment for %s' % (velocity, resolution))
+
+    return quantized, resolution
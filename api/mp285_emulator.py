@@ -0,0 +1,281 @@
+import math
+import os
+import select
+import threading
+import time
+import tty
+from typing import Tuple, List, Optional, Union
+
+from api.manipulator import Mode, unpack_moves, _STATUS_STRUCT, _USTEPS_PER_UM_
+
+_Num = Union[int, float]
+
+# Velocity after power up: 200 um/s at high resolution
+_DEFAULT_VELOCITY_WORD = (1 << 15) | 100
+
+_BITS_PER_BYTE = 10  # 8N1: start bit, 8 data bits, stop bit
+
+# Length of each fixed size command including the terminating CR
+_COMMAND_LENGTHS = {b'c': 2, b'm': 14, b'k': 3, b'V': 4, b'o': 2, b'n': 2, b'a': 2, b'b': 2, b's': 2, b'e': 2, b'r': 2,
+                    b'\x03': 1}
+
+
+class MP285Emulator(threading.Thread):
+    """
+    Emulates an MP-285 controller behind a pseudo terminal so a Manipulator can be opened on it unmodified:
+
+        with MP285Emulator() as emulator:
+            mm = Manipulator(emulator.port)
+
+    Every command is delayed by the time its bytes take at the configured baud rate, and so is every response.
+    Moves take the straight line distance divided by the current velocity and can be stopped with an interrupt.
+    time_scale multiplies all simulated delays, e.g. 0 for instant responses in regression runs.
+    """
+
+    def __init__(self, baudrate: int = 9600, time_scale: _Num = 1.0):
+        """
+        :param baudrate: Simulated baud rate used for byte timing
+        :param time_scale: Factor applied to all simulated delays
+        """
+
+        self.baudrate = baudrate
+        self.time_scale = time_scale
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self.command_counts = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        self._stopped = threading.Event()
+        self._buffer = b''
+        self._pending = []  # Complete commands received during a move
+        self._reset_state()
+
+        super().__init__(daemon=True)
+
+    def __enter__(self) -> 'MP285Emulator':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+        os.close(self._master)
+        os.close(self._slave)
+
+    @property
+    def position(self) -> Tuple[float, float, float]:
+        """
+        Current position in um
+        """
+        return tuple(usteps / _USTEPS_PER_UM_ for usteps in self._position)
+
+    def _reset_state(self):
+        self.mode = Mode.ABSOLUTE
+        self.velocity_word = _DEFAULT_VELOCITY_WORD
+        self.programs = {}
+
+        self._position = [0, 0, 0]
+        self._remaining_moves = []  # Absolute targets left over from an interrupted move or program
+
+    def run(self):
+        while not self._stopped.is_set():
+            command = self._next_command()
+            if command is not None:
+                self._handle(command)
+
+    def _byte_time(self, num_bytes: int) -> float:
+        return num_bytes * _BITS_PER_BYTE / self.baudrate * self.time_scale
+
+    def _next_command(self) -> Optional[bytes]:
+        """
+        Reads until a complete command is buffered, or None once stopped
+        """
+        while not self._stopped.is_set():
+            command = self._pending.pop(0) if self._pending else self._split_command()
+            if command is not None:
+                # Account for the time the command takes on the wire
+                time.sleep(self._byte_time(len(command)))
+                return command
+
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if readable:
+                data = os.read(self._master, 4096)
+                self.bytes_received += len(data)
+                self._buffer += data
+
+        return None
+
+    def _split_command(self) -> Optional[bytes]:
+        while len(self._buffer) > 0:
+            opcode = self._buffer[:1]
+
+            if opcode == b'd':
+                if len(self._buffer) < 3:
+                    return None
+                length = 3 + 12 * self._buffer[2] + 1
+            elif opcode in _COMMAND_LENGTHS:
+                length = _COMMAND_LENGTHS[opcode]
+            else:
+                # Unknown command, discard up to the next CR
+                end = self._buffer.find(b'\r')
+                if end < 0:
+                    return None
+                self._buffer = self._buffer[end + 1:]
+                continue
+
+            if len(self._buffer) < length:
+                return None
+
+            command = self._buffer[:length]
+            self._buffer = self._buffer[length:]
+            return command
+
+        return None
+
+    def _respond(self, response: bytes):
+        time.sleep(self._byte_time(len(response)))
+        os.write(self._master, response)
+        self.bytes_sent += len(response)
+
+    def _handle(self, command: bytes):
+        opcode = command[:1]
+        self.command_counts[opcode] = self.command_counts.get(opcode, 0) + 1
+
+        if opcode == b'c':
+            self._respond(b''.join(usteps.to_bytes(4, byteorder='little', signed=True) for usteps in self._position)
+                          + b'\r')
+        elif opcode == b'm':
+            target = [int.from_bytes(command[i:i + 4], byteorder='little', signed=True) for i in (1, 5, 9)]
+            self._remaining_moves = [self._absolute(target)]
+            self._run_moves()
+        elif opcode == b'd':
+            program_num, moves = unpack_moves(command)
+            self.programs[program_num] = [[int(round(coordinate * _USTEPS_PER_UM_)) for coordinate in move]
+                                          for move in moves]
+            self._respond(b'\r')
+        elif opcode == b'k':
+            self._remaining_moves = []
+            for move in self.programs.get(command[1], []):
+                if self.mode == Mode.RELATIVE:
+                    # Relative program moves accumulate from the previous target
+                    previous = self._remaining_moves[-1] if self._remaining_moves else self._position
+                    move = [p + d for p, d in zip(previous, move)]
+                self._remaining_moves.append(move)
+            self._run_moves()
+        elif opcode == b'V':
+            self.velocity_word = int.from_bytes(command[1:3], byteorder='little')
+            self._respond(b'\r')
+        elif opcode == b'o':
+            self._position = [0, 0, 0]
+            self._respond(b'\r')
+        elif opcode in (b'a', b'b'):
+            self.mode = Mode(opcode)
+            self._respond(b'\r')
+        elif opcode == b's':
+            self._respond(self._status_bytes() + b'\r')
+        elif opcode == b'e':
+            self._run_moves()
+        elif opcode == b'r':
+            self._reset_state()
+        else:
+            # Interrupt or refresh display
+            self._respond(b'\r')
+
+    def _absolute(self, move: List[int]) -> List[int]:
+        if self.mode == Mode.RELATIVE:
+            return [p + d for p, d in zip(self._position, move)]
+        return move
+
+    def _velocity(self) -> float:
+        """
+        Current velocity in uSteps/second
+        """
+        usteps_per_step = 50 if self.velocity_word & (1 << 15) else 10
+        return max(1, self.velocity_word & ~(1 << 15)) * usteps_per_step
+
+    def _run_moves(self):
+        """
+        Moves through the remaining absolute targets, stopping early if an interrupt arrives. Responds with CR once done
+        """
+
+        while self._remaining_moves:
+            target = self._remaining_moves.pop(0)
+            start = list(self._position)
+
+            duration = math.sqrt(sum((t - s) ** 2 for s, t in zip(start, target))) / self._velocity()
+            started_at = time.monotonic()
+
+            interrupted = self._wait_for_interrupt(duration * self.time_scale)
+            if interrupted:
+                elapsed = (time.monotonic() - started_at) / self.time_scale if self.time_scale > 0 else duration
+                fraction = min(1.0, elapsed / duration) if duration > 0 else 1.0
+                self._position = [int(s + (t - s) * fraction) for s, t in zip(start, target)]
+
+                # Keep the rest of the move so continue_operation can finish it
+                self._remaining_moves.insert(0, target)
+                self._respond(b'\r')  # End of the interrupted move
+                self._respond(b'\r')  # Acknowledge the interrupt
+                return
+
+            self._position = target
+
+        self._respond(b'\r')
+
+    def _wait_for_interrupt(self, duration: float) -> bool:
+        """
+        Waits for a move to finish. Only an interrupt is acted on during a move, other commands are queued
+        """
+        deadline = time.monotonic() + duration
+
+        while not self._stopped.is_set():
+            command = self._split_command()
+            while command is not None:
+                self._pending.append(command)
+                command = self._split_command()
+
+            if b'\x03' in self._pending:
+                self._pending.remove(b'\x03')
+                self.command_counts[b'\x03'] = self.command_counts.get(b'\x03', 0) + 1
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            readable, _, _ = select.select([self._master], [], [], remaining)
+            if readable:
+                data = os.read(self._master, 4096)
+                self.bytes_received += len(data)
+                self._buffer += data
+
+        return False
+
+    def _status_bytes(self) -> bytes:
+        flags = (1 << 5) if self.mode == Mode.ABSOLUTE else 0
+        flags_2 = 1 << 2 if self.velocity_word & (1 << 15) else 0
+
+        return _STATUS_STRUCT.pack(flags, 0, 0, 0,  # flags, udirx, udiry, udirz
+                                   0, 0, 0, 0, 0,  # roe_vari, uoffset, urange, pulse, uspeed
+                                   0, flags_2,  # indevice, flags_2
+                                   0, 0, 0, 0,  # jumpspd, highspd, dead, watch_dog
+                                   1, 1,  # step_div, step_mul
+                                   self.velocity_word, b'\x03\x10')
+
+
+if __name__ == '__main__':
+    with MP285Emulator() as emulator:
+        print('MP-285 emulator listening on %s (Ctrl-C to stop)' % emulator.port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
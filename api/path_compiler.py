@@ -0,0 +1,127 @@
+from typing import Tuple, List
+
+import numpy as np
+
+from api import math_parser
+from api.manipulator import _USTEPS_PER_UM_
+
+# Smallest move the manipulator can make in um
+STEP_UM = 1 / _USTEPS_PER_UM_
+
+_INITIAL_SAMPLES = 64
+_MAX_POINTS = 1 << 20
+
+
+def compile_path(x_equation: str, y_equation: str, z_equation: str, variable: str, var_range: Tuple[float, float],
+                 tolerance: float = STEP_UM, initial_samples: int = _INITIAL_SAMPLES) -> np.ndarray:
+    """
+    Compiles a parametric path into a minimal list of moves that stays within tolerance of the continuous path, plus
+    the rounding to the step grid.
+
+    The equations are evaluated over the whole parameter range at once. Intervals whose chord deviates from the
+    path by more than the tolerance are recursively split, then points on straight stretches are dropped again
+    and the result is snapped to the manipulator step grid. Snapping moves each point by up to half a step on every
+    axis, STEP_UM * sqrt(3) / 2 (about 0.035 um), on top of the tolerance. Jumps in the path, e.g. from step(), are
+    kept as single moves.
+
+    :param x_equation: String for the x coordinate in um as a function of variable
+    :param y_equation: String for the y coordinate in um as a function of variable
+    :param z_equation: String for the z coordinate in um as a function of variable
+    :param variable: String that represents the parameter
+    :param var_range: start <= variable <= end
+    :param tolerance: Maximum deviation from the continuous path in um before snapping to the step grid. Default is
+                      one manipulator step (0.04 um)
+    :param initial_samples: Number of uniform intervals to start refining from
+    :return: (N, 3) array of (x, y, z) coordinates in um
+    """
+
+    if var_range[1] <= var_range[0]:
+        raise ValueError('Path maximum must be greater than path minimum')
+
+    if tolerance <= 0:
+        raise ValueError('Tolerance must be positive')
+
+    equations = [math_parser.compile_equation(equation, variable) for equation in (x_equation, y_equation, z_equation)]
+
+    t = np.linspace(var_range[0], var_range[1], max(1, initial_samples) + 1)
+    points = _evaluate(equations, t)
+
+    # Refine intervals where the chord misses the path by more than the tolerance
+    while len(t) < _MAX_POINTS:
+        t_mid = (t[:-1] + t[1:]) / 2
+        mid_points = _evaluate(equations, t_mid)
+        error = np.linalg.norm(mid_points - (points[:-1] + points[1:]) / 2, axis=1)
+
+        # A jump, e.g. from step(), never meets the tolerance. Stop once its interval cannot be halved any more and
+        # keep the jump as a single move
+        split = (error > tolerance) & (t_mid > t[:-1]) & (t_mid < t[1:])
+        if not split.any():
+            break
+
+        t = np.insert(t, np.flatnonzero(split) + 1, t_mid[split])
+        points = np.insert(points, np.flatnonzero(split) + 1, mid_points[split], axis=0)
+
+    points = points[simplify(points, tolerance)]
+
+    # Snap to the step grid and drop moves that became empty
+    points = np.round(points / STEP_UM) * STEP_UM
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+
+    return points[keep]
+
+
+def simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Ramer-Douglas-Peucker polyline simplification
+
+    :param points: (N, D) array of points
+    :param tolerance: Maximum distance of a dropped point from the simplified polyline
+    :return: Boolean mask of the points to keep
+    """
+
+    keep = np.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return keep
+
+    keep[0] = keep[-1] = True
+
+    segments = [(0, len(points) - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+
+        distances = _distance_to_segment(points[first + 1:last], points[first], points[last])
+        farthest = int(np.argmax(distances))
+
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            segments.append((first, index))
+            segments.append((index, last))
+
+    return keep
+
+
+def _distance_to_segment(points: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    direction = end - start
+    length_squared = np.dot(direction, direction)
+
+    if length_squared == 0:
+        return np.linalg.norm(points - start, axis=1)
+
+    fraction = np.clip((points - start) @ direction / length_squared, 0, 1)
+    return np.linalg.norm(points - (start + fraction[:, np.newaxis] * direction), axis=1)
+
+
+def _evaluate(equations: List[math_parser.Equation], t: np.ndarray) -> np.ndarray:
+    points = np.empty((len(t), 3))
+    for axis, equation in enumerate(equations):
+        points[:, axis] = equation(t)
+
+    finite = np.isfinite(points).all(axis=1)
+    if not finite.all():
+        raise ValueError('Path is not finite at %s = %g' % (equations[0].variable, t[np.argmin(finite)]))
+
+    return points
@@ -0,0 +1,170 @@
+import threading
+import time
+from typing import Optional, Union
+
+import numpy as np
+
+from api.manipulator import Manipulator, Mode, MAX_PROGRAM_MOVES
+from api.path_compiler import simplify, STEP_UM
+from api.trajectory import TrajectoryStreamer
+
+_Num = Union[int, float]
+
+
+class PositionSampler(threading.Thread):
+    """
+    Polls the manipulator position in the background into a fixed size ring buffer of (time, x, y, z) rows.
+
+    Samples use Manipulator.poll_position, so a sample is skipped rather than delaying any other command that is
+    using the port. Times are time.monotonic() values taken when the reply arrived.
+    """
+
+    def __init__(self, manipulator: Manipulator, rate: _Num = 10, capacity: int = 36000):
+        """
+        :param manipulator: Manipulator to poll
+        :param rate: Samples per second
+        :param capacity: Number of samples kept, older samples are overwritten
+        """
+
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+
+        if capacity <= 0:
+            raise ValueError('Capacity must be positive')
+
+        self.manipulator = manipulator
+        self.period = 1 / rate
+
+        self.samples_taken = 0
+        self.samples_skipped = 0
+
+        self._buffer = np.zeros((capacity, 4))
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        super().__init__(daemon=True)
+
+    def stop(self, timeout: _Num = None):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        deadline = time.monotonic()
+
+        while not self._stopped.is_set():
+            position = self.manipulator.poll_position()
+
+            if position is None:
+                self.samples_skipped += 1
+            else:
+                with self._lock:
+                    row = self._buffer[self.samples_taken % len(self._buffer)]
+                    row[0] = time.monotonic()
+                    row[1:] = position
+                    self.samples_taken += 1
+
+            # Schedule against absolute deadlines so slow reads do not lower the rate
+            deadline = max(deadline + self.period, time.monotonic())
+            self._stopped.wait(deadline - time.monotonic())
+
+    def samples(self, since: float = None) -> np.ndarray:
+        """
+        :param since: Optional time.monotonic() value, only samples taken at or after it are returned
+        :return: (N, 4) array of (time, x, y, z) rows, oldest first
+        """
+        with self._lock:
+            capacity = len(self._buffer)
+            if self.samples_taken <= capacity:
+                samples = self._buffer[:self.samples_taken].copy()
+            else:
+                start = self.samples_taken % capacity
+                samples = np.concatenate((self._buffer[start:], self._buffer[:start]))
+
+        if since is not None:
+            samples = samples[samples[:, 0] >= since]
+
+        return samples
+
+    def latest(self) -> Optional[np.ndarray]:
+        """
+        :return: The most recent (time, x, y, z) sample, or None if nothing was sampled yet
+        """
+        with self._lock:
+            if self.samples_taken == 0:
+                return None
+            return self._buffer[(self.samples_taken - 1) % len(self._buffer)].copy()
+
+
+class TrajectoryRecorder:
+    """
+    Captures the motion seen by a PositionSampler, e.g. while the joystick is used, and replays its path.
+
+    Only the path is reproduced. The replay runs at the velocity currently set on the manipulator.
+    """
+
+    def __init__(self, sampler: PositionSampler):
+        self.sampler = sampler
+        self.samples = np.zeros((0, 4))
+
+        self._start = None
+
+    def start(self):
+        self._start = time.monotonic()
+
+    def stop(self) -> np.ndarray:
+        """
+        :return: (N, 4) array of (time, x, y, z) samples recorded since start()
+        """
+        if self._start is None:
+            raise RuntimeError('Recording was not started')
+
+        self.samples = self.sampler.samples(since=self._start)
+        self._start = None
+
+        return self.samples
+
+    def to_moves(self, tolerance: _Num = STEP_UM) -> np.ndarray:
+        """
+        :param tolerance: Maximum deviation in um from the recorded path
+        :return: The minimal (N, 3) move list following the recording
+        """
+        return compress_trajectory(self.samples, tolerance)
+
+    def replay(self, manipulator: Manipulator, tolerance: _Num = STEP_UM):
+        """
+        Moves the manipulator along the recorded path in absolute mode
+
+        :param manipulator: Manipulator to move
+        :param tolerance: Maximum deviation in um from the recorded path
+        """
+        moves = self.to_moves(tolerance)
+        if len(moves) == 0:
+            return
+
+        manipulator.set_mode(Mode.ABSOLUTE)
+        if len(moves) <= MAX_PROGRAM_MOVES:
+            manipulator.send_and_execute_moves(moves)
+        else:
+            TrajectoryStreamer(manipulator).stream(moves)
+        manipulator.wait_all()
+
+
+def compress_trajectory(samples: np.ndarray, tolerance: _Num = STEP_UM) -> np.ndarray:
+    """
+    Reduces sampled positions to the fewest moves that stay within tolerance of the sampled path
+
+    :param samples: (N, 4) array of (time, x, y, z) rows
+    :param tolerance: Maximum deviation in um from the sampled path
+    :return: (M, 3) array of (x, y, z) coordinates in um
+    """
+    positions = samples[:, 1:]
+    if len(positions) == 0:
+        return positions
+
+    # Drop samples taken while standing still
+    moving = np.ones(len(positions), dtype=bool)
+    moving[1:] = np.any(positions[1:] != positions[:-1], axis=1)
+    positions = positions[moving]
+
+    return positions[simplify(positions, tolerance)]
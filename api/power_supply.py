@@ -1,45 +1,231 @@
+import queue
 import threading
 import time
-from typing import Union, List, Tuple
+from contextlib import contextmanager
+from typing import Union, Dict, List, Tuple, Optional, Iterator, TYPE_CHECKING
 
 import serial
 
+from api.serial_broker import Priority, get_broker
+from api.journal import Journal, Opcode, DEVICE_POWER_SUPPLY, NAN, scpi_opcode
 from api import math_parser
-from api.relay import Relay
+from api.wave_table import WaveTable, CURRENT_RESOLUTION, MIN_STEP_PERIOD, CurrentSetpoint, wave_tables, \
+    compile_square, compile_ramp, compile_sine, stream_points, validate_square_wave, validate_ramp_wave, \
+    validate_sine_wave
+from api.wave_timing import LatenessHistogram, sleep_until
 
-MIN_STEP_PERIOD = 0.1
+# Relays are only passed in, importing them here would require RPi.GPIO just to drive the supply
+if TYPE_CHECKING:
+    from api.relay import Relay
+
+# Longest coalesced SCPI line sent at once
+_MAX_BATCH_LINE = 200
+
+# Commands whose absolute setting replaces an earlier queued command with the same header
+_SUPERSEDING_HEADERS = (b'CURR', b'VOLT', b'OUTP', b'CURR:STEP')
+
+# Fires the level armed with CURR:TRIG in trigger playback
+_TRIGGER_FRAME = b'*TRG\n'
+
+_OUTPUT_OFF_FRAME = b'OUTP OFF\n'
+
+# Time a stopped wave thread is given to finish after the output was turned off
+_WAVE_JOIN_TIMEOUT = 1.0
+
+# Samples evaluated at once by a streamed wave, and chunks computed ahead of playback
+_STREAM_CHUNK_SIZE = 1024
+_STREAM_PREFETCH = 4
 
 _Num = Union[int, float]
 
 
 class PowerSupply:
 
-    def __init__(self, comm_port: str, relay_1: Relay, relay_2: Relay):
+    def __init__(self, comm_port: str, relay_1: 'Relay', relay_2: 'Relay',
+                 current_resolution: _Num = CURRENT_RESOLUTION, stop_timeout: _Num = 0.005, journal: Journal = None,
+                 journal_device: int = DEVICE_POWER_SUPPLY):
+        """
+        :param comm_port: Serial port of the supply
+        :param relay_1: Relay switching the first output terminal
+        :param relay_2: Relay switching the second output terminal
+        :param current_resolution: Current programming resolution of the supply in A
+        :param stop_timeout: Time in seconds a stopping wave has to turn the output off, on top of sending the command
+        :param journal: Optional journal recording every line sent, wave steps included
+        :param journal_device: Device id of this supply in the journal
+        """
         self.serial_conn = serial.Serial(comm_port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
                                          stopbits=serial.STOPBITS_TWO)
+        # Shared with anything else using the port, wave setpoints take priority over queries
+        self.broker = get_broker(self.serial_conn)
 
         self.relay_1 = relay_1
         self.relay_2 = relay_2
 
-        self.serial_conn.write(b'*IDN?\n')
-        print(self.serial_conn.readline().decode('ascii'))
-        self.disable_output()
-        self.serial_conn.write(b'VOLT:RANG HIGH\n')  # Sets to 20V mode
-        self.serial_conn.write(b'APPL MAX, 0.0\n')  # Sets 20V, 0A
+        self.journal = journal
+        self.journal_device = journal_device
+
+        # bytes_saved counts superseded commands that were never sent, separator_bytes the extra byte each ';:' costs
+        # over sending the commands on their own lines
+        self.batch_stats = {'lines': 0, 'commands': 0, 'writes_saved': 0, 'bytes_saved': 0, 'separator_bytes': 0}
+        self._batch = threading.local()
+
+        self.current_resolution = current_resolution
+        self._setpoint = CurrentSetpoint()
+        # Current writes skipped because the supply was already set to the value
+        self.suppressed_writes = 0
+
+        print(self._query(b'*IDN?', Priority.CONTROL).decode('ascii'))
+        with self.batch():
+            self.disable_output()
+            self._write(b'VOLT:RANG HIGH')  # Sets to 20V mode
+            self._write(b'APPL MAX, 0.0')  # Sets 20V, 0A
+        self._setpoint.current = 0.0
 
         self.wave = None
+        self.stop_timeout = stop_timeout
+        # Lateness of every wave step against its deadline, reset when a wave starts
+        self.lateness = LatenessHistogram()
+        # Time from each step's deadline until its edge frame was transmitted
+        self.edge_latency = LatenessHistogram()
+        # Steps played, written and suppressed during the current or last wave, and steps merged when it was compiled
+        self.wave_stats = {'steps': 0, 'writes': 0, 'suppressed': 0, 'merged': 0}
 
     def __del__(self):
         self.serial_conn.close()
 
+    @contextmanager
+    def batch(self):
+        """
+        Queues the commands issued by this thread inside the block and sends them as one SCPI line joined with ';:'
+        when the block ends. A queued command is dropped if a later absolute setting with the same header replaces it
+        (e.g. two CURR values). Queries inside the block are sent in the same line as the queued commands.
+
+        Batching saves writes (and their syscalls and port acquisitions), not wire time. The supply still receives
+        every command at 9600 baud and each ';:' is a byte longer than the line break it replaces, so only superseded
+        commands make the line shorter. See batch_stats.
+
+            with ps.batch():
+                ps.set_current(1.0)
+                ps.enable_output()
+        """
+        batch = self._batch
+        batch.depth = getattr(batch, 'depth', 0) + 1
+        if batch.depth == 1:
+            batch.commands = []
+
+        try:
+            yield self
+        finally:
+            batch.depth -= 1
+            if batch.depth == 0:
+                self.flush()
+
+    def flush(self, priority: Priority = Priority.CONTROL):
+        """
+        Sends the commands queued by this thread's batch now
+
+        :param priority: Priority of the line on the port
+        """
+        commands = getattr(self._batch, 'commands', None)
+        if len(commands or ()) == 1:
+            self._send(self._take_batch(), priority=priority)
+        elif commands:
+            self._send(self._take_batch(), len(commands), Opcode.SCPI, priority)
+
+    def _send(self, line: bytes, value: float = NAN, opcode: int = None, priority: Priority = Priority.CONTROL):
+        """
+        Writes a terminated line through the port's broker and journals it. Coalesced lines are journaled as
+        Opcode.SCPI with the number of commands as value
+        """
+        if self.journal is None:
+            with self.broker.acquire(priority):
+                self.serial_conn.write(line)
+            return
+
+        start = time.monotonic()
+        with self.broker.acquire(priority):
+            self.serial_conn.write(line)
+        self.journal.record(self.journal_device, scpi_opcode(line) if opcode is None else opcode, value,
+                            time.monotonic() - start, start)
+
+    def _write(self, command: bytes, value: float = NAN, priority: Priority = Priority.CONTROL):
+        """
+        Sends a single SCPI command without its terminator, or queues it while this thread is batching
+
+        :param command: SCPI command
+        :param value: Value set by the command, for the journal
+        :param priority: Priority on the port when sent immediately
+        """
+        if getattr(self._batch, 'depth', 0) == 0:
+            self._send(command + b'\n', value, priority=priority)
+            return
+
+        commands = self._batch.commands
+        self.batch_stats['commands'] += 1
+
+        header, _, argument = command.partition(b' ')
+        if commands and header in _SUPERSEDING_HEADERS and argument not in (b'UP', b'DOWN') \
+                and commands[-1].partition(b' ')[0] == header:
+            # The earlier setting would be overwritten immediately
+            self.batch_stats['writes_saved'] += 1
+            self.batch_stats['bytes_saved'] += len(commands[-1]) + 1
+            commands[-1] = command
+            return
+
+        if sum(len(queued) + 2 for queued in commands) + len(command) > _MAX_BATCH_LINE:
+            self.flush()
+
+        commands.append(command)
+
+    def _query(self, command: bytes, priority: Priority = Priority.TELEMETRY) -> bytes:
+        """
+        Sends a query, together with anything queued by this thread's batch, and reads the response line. The port is
+        held until the response arrives, so no other traffic can get between them
+        """
+        start = time.monotonic()
+
+        with self.broker.acquire(priority):
+            if getattr(self._batch, 'depth', 0) > 0 and self._batch.commands:
+                self.batch_stats['commands'] += 1
+                self._batch.commands.append(command)
+                self.serial_conn.write(self._take_batch())
+            else:
+                self.serial_conn.write(command + b'\n')
+
+            response = self.serial_conn.readline()
+
+        if self.journal is not None:
+            try:
+                value = float(response)
+            except ValueError:
+                value = NAN
+            self.journal.record(self.journal_device, scpi_opcode(command), value, time.monotonic() - start, start)
+
+        return response
+
+    def _take_batch(self) -> bytes:
+        commands = self._batch.commands
+        self._batch.commands = []
+
+        line = b';:'.join(commands) + b'\n'
+
+        self.batch_stats['lines'] += 1
+        self.batch_stats['writes_saved'] += len(commands) - 1
+        self.batch_stats['separator_bytes'] += len(commands) - 1
+
+        return line
+
     def _toggle_output(self, on: bool):
         output_str = b'ON' if on else b'OFF'
 
-        self.serial_conn.write(b'OUTP ' + output_str + b'\n')
+        # Turning the output off goes ahead of everything else waiting for the port
+        self._write(b'OUTP ' + output_str, priority=Priority.CONTROL if on else Priority.REALTIME)
 
     def enable_output(self, relay_forward = True):
 
         if relay_forward is not None:
+            # Anything queued, e.g. an output off, must reach the supply before the relays switch
+            self.flush()
             if relay_forward:
                 self.relay_1.vcc()
                 self.relay_2.gnd()
@@ -54,184 +240,500 @@ class PowerSupply:
         self._toggle_output(False)
 
         if disable_relay:
+            # The output must be off before the relays open, even inside a batch
+            self.flush(Priority.REALTIME)
             self.relay_1.gnd()
             self.relay_2.gnd()
 
 
     def set_voltage(self, voltage: _Num):
-        self.serial_conn.write(b'VOLT %f\n' % voltage)
+        self._write(b'VOLT %f' % voltage, voltage)
 
     def get_voltage(self):
-        self.serial_conn.write(b'MEAS:VOLT?\n')
-        return float(self.serial_conn.readline())
+        return float(self._query(b'MEAS:VOLT?'))
 
     def get_current(self):
-        self.serial_conn.write(b'MEAS:CURR?\n')
-        return float(self.serial_conn.readline())
+        return float(self._query(b'MEAS:CURR?'))
 
     def set_current(self, current: _Num):
-        self.serial_conn.write(b'CURR %f\n' % current)
+        current = self._setpoint.set(current, self.current_resolution)
+        if current is None:
+            self.suppressed_writes += 1
+            return
+
+        self._write(b'CURR %f' % current, current)
 
     def set_current_step(self, current_step: _Num):
-        self.serial_conn.write(b'CURR:STEP %f\n' % current_step)
+        self._write(b'CURR:STEP %f' % current_step, current_step)
+        self._setpoint.set_step(current_step, self.current_resolution)
 
     def step_current(self, up: bool):
         up_or_down = b'UP' if up else b'DOWN'
-        self.serial_conn.write(b'CURR ' + up_or_down + b'\n')
+        self._write(b'CURR ' + up_or_down)
+        self._setpoint.stepped(up, self.current_resolution)
 
     def get_error(self):
-        self.serial_conn.write(b'SYST:ERR?\n')
-        return self.serial_conn.readline()
+        return self._query(b'SYST:ERR?')
 
-    def start_square_wave(self, amplitude: _Num, period: _Num, duty_cycle: float = 0.5):
+    def start_square_wave(self, amplitude: _Num, period: _Num, duty_cycle: float = 0.5, trigger: bool = False):
 
-        if not (0 < duty_cycle < 1):
-            raise ValueError('Duty Cycle must be between 0 and 1')
+        validate_square_wave(amplitude, period, duty_cycle)
 
-        if period < MIN_STEP_PERIOD:
-            raise ValueError('Period must be at least %d seconds' % MIN_STEP_PERIOD)
+        # The previous wave must be off before the new one programs the supply
+        self._stop_wave()
+        self._start_wave(_SquareWave(self, amplitude, period, duty_cycle, trigger))
 
-        if amplitude < 0:
-            raise ValueError('Amplitude must be positive')
+    def start_ramp_wave(self, amplitude: _Num, rise_time: _Num, steady_time: _Num, rest_time: _Num,
+                        trigger: bool = False):
 
-        self.wave = _SquareWave(self, amplitude, period, duty_cycle)
-        self.wave.start()
+        num_steps = validate_ramp_wave(amplitude, rise_time)
 
-    def start_ramp_wave(self, amplitude: _Num, rise_time: _Num, steady_time: _Num, rest_time: _Num):
+        self._stop_wave()
+        self._start_wave(_RampWave(self, amplitude, num_steps, steady_time, rest_time, trigger))
 
-        if rise_time < MIN_STEP_PERIOD:
-            raise ValueError('Period must be at least %d seconds' % MIN_STEP_PERIOD)
+    def start_sine_wave(self, amplitude: _Num, period: _Num, time_offset: _Num = None, dc_offset: _Num = None,
+                        trigger: bool = False):
 
-        if amplitude <= 0:
-            raise ValueError('Amplitude must be positive')
+        time_offset, dc_offset = validate_sine_wave(amplitude, period, time_offset, dc_offset)
 
-        self.wave = _RampWave(self, amplitude, rise_time, steady_time, rest_time)
-        self.wave.start()
+        self._stop_wave()
+        resolution = self.current_resolution
+        table = wave_tables.get(('sine', amplitude, period, time_offset, dc_offset, resolution),
+                                lambda: compile_sine(amplitude, period, time_offset, dc_offset, resolution))
 
-    def start_sine_wave(self, amplitude: _Num, period: _Num, time_offset: _Num = None, dc_offset: _Num = None):
+        self._start_wave(_ArbitraryWave(self, table, trigger))
 
-        if amplitude <= 0:
-            raise ValueError('Amplitude must be positive')
 
-        if dc_offset is None:
-            dc_offset = amplitude
-        elif dc_offset < amplitude:
-            raise ValueError('DC offset must be greater than amplitude')
+    def start_streamed_wave(self, equation_str: str, duration: _Num = None, variable: str = 't',
+                            var_step: _Num = MIN_STEP_PERIOD, trigger: bool = False,
+                            chunk_size: int = _STREAM_CHUNK_SIZE, prefetch: int = _STREAM_PREFETCH):
+        """
+        Plays an equation of time once, e.g. an hours long protocol that does not repeat. The equation is sampled and
+        compiled in chunks while the wave plays, so memory use does not grow with the duration and playback starts
+        once the first chunk is ready. The output turns off at the end
 
-        if time_offset is None:
-            time_offset = period / 4 # Default is to start the wave at minimum
+        :param equation_str: Current in A as a function of variable, see math_parser
+        :param duration: Length of the wave in seconds, None to play until stop_wave
+        :param variable: String that represents time in equation_str
+        :param var_step: Sampling interval in seconds
+        :param trigger: Play with CURR:TRIG and *TRG instead of writing each setpoint at its deadline
+        :param chunk_size: Number of samples compiled at once
+        :param prefetch: Number of compiled chunks kept ahead of playback
+        """
 
-        if period <= 0:
-            raise ValueError('Period must be greater than 0')
+        if var_step < MIN_STEP_PERIOD:
+            raise ValueError('Step must be at least %g seconds' % MIN_STEP_PERIOD)
 
-        equation = '%f * sin(6.28318530718 * (t - %f) / %f) + %f' % (amplitude, time_offset, period, dc_offset)
+        if duration is not None and duration <= 0:
+            raise ValueError('Duration must be positive')
 
-        wave_points = math_parser.parse_equation(equation, 't', (0, period), MIN_STEP_PERIOD)
+        if prefetch < 1:
+            raise ValueError('Prefetch must be at least 1 chunk')
 
-        self.wave = _ArbitraryWave(self, wave_points)
-        self.wave.start()
+        equation = math_parser.compile_equation(equation_str, variable)
 
+        self._stop_wave()
+        self._start_wave(_StreamedWave(self, equation, float('inf') if duration is None else duration, var_step,
+                                       chunk_size, prefetch, trigger))
 
-    def stop_wave(self):
-        if self.wave is None:
+    def _start_wave(self, wave: '_Wave'):
+        self.wave = wave
+        self.lateness.reset()
+        self.edge_latency.reset()
+        self.wave_stats.update(steps=0, writes=0, suppressed=0, merged=wave.merged)
+        self.wave.start()
+
+    def edge_timing(self) -> Dict[str, Union[str, float]]:
+        """
+        Reports how closely the output edges of the current or last wave followed their deadlines. Edge latency is the
+        time from a step's deadline until the frame causing the edge was transmitted: the whole 'CURR <value>' line
+        when writing setpoints, only '*TRG' in trigger mode
+
+        :return: Dict with the playback mode ('write' or 'trigger'), the edge latency summary in seconds and the
+                 transmit time of an edge frame at the port's baud rate
+        """
+        mode = 'trigger' if self.wave is not None and self.wave.trigger else 'write'
+        frames = [_TRIGGER_FRAME] if mode == 'trigger' else (self.wave.frames if self.wave is not None else [])
+
+        timing = {'mode': mode}
+        timing.update(self.edge_latency.summary())
+        timing['frame_time'] = (sum(self._transmit_time(len(frame)) for frame in frames) / len(frames)
+                                if frames else 0.0)
+
+        return timing
+
+    def _transmit_time(self, num_bytes: int) -> float:
+        bits_per_byte = 1 + self.serial_conn.bytesize + self.serial_conn.stopbits + \
+                        (self.serial_conn.parity != serial.PARITY_NONE)
+        return num_bytes * bits_per_byte / self.serial_conn.baudrate
+
+    def stop_bound(self) -> float:
+        """
+        :return: Longest time in seconds stop_wave takes to turn the output off. Includes a telemetry query already
+                 waiting for its response when the wave is stopped, as long as the supply answers it about as quickly
+                 as it answered recent queries
+        """
+        return self.stop_timeout + self.broker.telemetry_hold + self._transmit_time(len(_OUTPUT_OFF_FRAME))
+
+    def stop_wave(self) -> Optional[float]:
+        """
+        Stops the running wave and turns the output off within stop_bound()
+
+        :return: Time in seconds from the request until the output off command was sent, None if no wave was running
+        """
+        if self.wave is None or not self.wave.is_alive():
             print('No wave is running')
-            return
+            return None
 
-        self.wave.running = False
-        del self.wave
+        return self._stop_wave()
 
+    def _stop_wave(self) -> Optional[float]:
+        wave = self.wave
+        if wave is None or not wave.is_alive():
+            return None
 
-class _SquareWave(threading.Thread):
+        requested = time.monotonic()
+        # Queries that are not on the port yet wait until the output is off
+        self.broker.reserve(requested)
+        wave.stop()
+        wave.join(self.stop_bound())
 
-    def __init__(self, power_supply: PowerSupply, amplitude: _Num, period: _Num, duty_cycle: float):
-        self.power_supply = power_supply
-        self.amplitude = amplitude
+        output_off_at = wave.output_off_at
+        if output_off_at is None:
+            # The wave thread is stuck, e.g. in a slow write, so turn the output off from here
+            self.disable_output()
+            self.serial_conn.flush()
+            output_off_at = time.monotonic()
 
-        self.power_supply.disable_output()
-        self.power_supply.set_current(0)
-        self.power_supply.set_current_step(amplitude)
+        # The old wave must not write anything once the next wave starts
+        wave.join(_WAVE_JOIN_TIMEOUT)
+        if wave.is_alive():
+            raise RuntimeError('Wave thread did not stop')
 
-        self.period = period
-        self.duty_cycle = duty_cycle
+        return output_off_at - requested
+
+
+class _Wave(threading.Thread):
+    """
+    Plays a compiled wave table repeatedly. Every step is scheduled against an absolute deadline measured from the
+    start of the wave, so write latency and oversleep do not accumulate over the cycles.
 
-        self.running = False
+    In trigger mode the level of the next step is armed with CURR:TRIG and INIT during the current step, and only a
+    *TRG is sent at the deadline, so the edge no longer waits for a whole CURR line to be sent and parsed.
+    """
+
+    def __init__(self, power_supply: PowerSupply, table: WaveTable, trigger: bool = False):
+        self.power_supply = power_supply
+        self.table = table
+        self.trigger = trigger
+
+        # time.monotonic() when the output off command was sent after stopping
+        self.output_off_at = None
+
+        self._stopped = threading.Event()
 
         super().__init__()
 
     def __del__(self):
-        self.running = False
+        self._stopped.set()
+
+    @property
+    def running(self) -> bool:
+        return self.is_alive() and not self._stopped.is_set()
+
+    def stop(self):
+        """
+        Asks the wave to turn the output off and end. Wakes the wave thread immediately if it is waiting for a step
+        """
+        self._stopped.set()
+
+    @property
+    def frames(self) -> List[bytes]:
+        """
+        Frames the wave writes at its deadlines in write mode
+        """
+        return self.table.frames
+
+    @property
+    def merged(self) -> int:
+        """
+        Steps merged into the one before them because their setpoint was the same
+        """
+        return self.table.merged
+
+    def _prepare_output(self, current: Optional[_Num]):
+        """
+        Turns the output off and sets the current the wave starts at in one line, then opens the relays
+
+        :param current: Starting current in A, None to leave the current as it is
+        """
+        power_supply = self.power_supply
+        with power_supply.batch():
+            power_supply.disable_output(disable_relay=False)
+            if current is not None:
+                power_supply.set_current(current)
+
+        # The batch was sent when the block ended, so the output is off before the relays open
+        power_supply.relay_1.gnd()
+        power_supply.relay_2.gnd()
+
+    def _schedule(self) -> Iterator[Tuple[float, float, bytes, bytes, int]]:
+        """
+        :return: Iterator of (offset from the start of the wave, setpoint, frame setting it, frame arming it for a
+                 trigger, journal opcode of the frame), cycling through the table until the wave is stopped
+        """
+        # Plain floats so the playback loop does not box numpy scalars
+        steps = list(zip(self.table.offsets.tolist(), self.table.setpoints.tolist(), self.table.frames,
+                         self.table.arm_frames, self.table.opcodes))
+        if not steps:
+            return
+
+        cycle = 0
+        while True:
+            cycle_offset = cycle * self.table.cycle_time
+            for offset, setpoint, frame, arm_frame, opcode in steps:
+                yield cycle_offset + offset, setpoint, frame, arm_frame, opcode
+            cycle += 1
+
+    def _end_offset(self) -> Optional[float]:
+        """
+        :return: Offset from the start of the wave the last step is held until once the schedule runs out
+        """
+        return None
 
     def run(self):
-        self.running = True
+        lateness = self.power_supply.lateness
+        edge_latency = self.power_supply.edge_latency
+        stats = self.power_supply.wave_stats
+        write = self.power_supply.serial_conn.write
+        flush = self.power_supply.serial_conn.flush
+        broker = self.power_supply.broker
+        stopped = self._stopped
+        journal = self.power_supply.journal
+        device = self.power_supply.journal_device
+
+        schedule = self._schedule()
+        step = next(schedule, None)
+
+        if self.trigger and step is not None:
+            with self.power_supply.batch():
+                self.power_supply._write(b'TRIG:SOUR BUS')
+                self.power_supply._write(b'TRIG:DEL 0')
+            self.power_supply._send(step[3], step[1], Opcode.ARM)
+
         self.power_supply.enable_output()
-        while self.running:
-            self.power_supply.step_current(up=True)
-            time.sleep(self.duty_cycle * self.period)
-            self.power_supply.step_current(up=False)
-            time.sleep((1 - self.duty_cycle) * self.period)
 
+        wave_start = time.monotonic()
+        while step is not None and not stopped.is_set():
+            offset, setpoint, frame, _, opcode = step
+            # Looked up before the deadline, so a slow schedule delays this step rather than the edge after it
+            upcoming = next(schedule, None)
+            deadline = wave_start + offset
+            stats['steps'] += 1
+
+            if self.trigger:
+                # Each trigger arms the following step
+                frame, opcode = _TRIGGER_FRAME, Opcode.TRIGGER
+                arm_frame, arm_setpoint = (upcoming[3], upcoming[1]) if upcoming is not None else (None, NAN)
+            else:
+                arm_frame, arm_setpoint = None, NAN
+
+                # Already at this level, e.g. the first step of a cycle repeating the last one. Only an absolute
+                # setting can be skipped, CURR UP and DOWN move the output whatever the setpoint
+                if opcode == Opcode.CURR and setpoint == self.power_supply._setpoint.current:
+                    stats['suppressed'] += 1
+                    self.power_supply.suppressed_writes += 1
+                    sleep_until(deadline, 0, stopped)
+                    step = upcoming
+                    continue
+
+            # Queries that would still hold the port at the deadline wait until after it
+            broker.reserve(deadline)
+            step_lateness = sleep_until(deadline, stopped=stopped)
+            if stopped.is_set():
+                break
+
+            lateness.record(step_lateness)
+            sent_at = time.monotonic()
+            with broker.acquire(Priority.REALTIME):
+                write(frame)
+                flush()
+                transmitted_at = time.monotonic()
+
+                if arm_frame is not None:
+                    write(arm_frame)
+
+            edge_latency.record(transmitted_at - deadline)
+            stats['writes'] += 1
+            self.power_supply._setpoint.current = setpoint
+
+            if journal is not None:
+                journal.record(device, opcode, setpoint, transmitted_at - sent_at, sent_at)
+                if arm_frame is not None:
+                    journal.record(device, Opcode.ARM, arm_setpoint, 0.0, transmitted_at)
+
+            step = upcoming
+
+        end_offset = self._end_offset()
+        if end_offset is not None:
+            # Hold the last step for its full dwell before turning the output off
+            sleep_until(wave_start + end_offset, 0, stopped)
+
+        # Reserved again in case the loop replaced the reservation of stop_wave, output off clears it
+        broker.reserve(time.monotonic())
         self.power_supply.disable_output()
+        flush()
+        self.output_off_at = time.monotonic()
 
 
-class _RampWave(threading.Thread):
+class _SquareWave(_Wave):
 
-    # Total period is rise_time + steady_time + rest_time
-    def __init__(self, power_supply: PowerSupply, amplitude: _Num, rise_time: _Num, steady_time: _Num, rest_time: _Num):
-        self.power_supply = power_supply
+    def __init__(self, power_supply: PowerSupply, amplitude: _Num, period: _Num, duty_cycle: float,
+                 trigger: bool = False):
+        resolution = power_supply.current_resolution
+        super().__init__(power_supply, wave_tables.get(
+            ('square', amplitude, period, duty_cycle, resolution),
+            lambda: compile_square(amplitude, period, duty_cycle, resolution)), trigger)
+        self.amplitude = amplitude
+
+        self._prepare_output(0)
+
+        self.period = period
+        self.duty_cycle = duty_cycle
+
+
+class _RampWave(_Wave):
+
+    # Total period is num_steps * MIN_STEP_PERIOD + steady_time + rest_time
+    def __init__(self, power_supply: PowerSupply, amplitude: _Num, num_steps: int, steady_time: _Num, rest_time: _Num,
+                 trigger: bool = False):
+        self.num_steps = num_steps
+
+        resolution = power_supply.current_resolution
+        super().__init__(power_supply, wave_tables.get(
+            ('ramp', amplitude, self.num_steps, steady_time, rest_time, resolution),
+            lambda: compile_ramp(amplitude, self.num_steps, steady_time, rest_time, resolution)), trigger)
         self.amplitude = amplitude
 
-        self.num_steps = round(rise_time / MIN_STEP_PERIOD)
         self.steady_time = steady_time
         self.rest_time = rest_time
 
-        self.power_supply.disable_output()
-        self.power_supply.set_current(0)
-        self.power_supply.set_current_step(amplitude / self.num_steps)
+        self._prepare_output(0)
 
-        super().__init__()
 
-    def run(self):
-        self.running = True
-        self.power_supply.enable_output()
-        while self.running:
-            i = 0
-            while i < self.num_steps:
-                self.power_supply.step_current(up=True)
-                time.sleep(MIN_STEP_PERIOD)
-                i += 1
+class _ArbitraryWave(_Wave):
 
-            time.sleep(self.steady_time)
+    def __init__(self, power_supply: PowerSupply, table: WaveTable, trigger: bool = False):
+        super().__init__(power_supply, table, trigger)
 
-            self.power_supply.set_current(0.0)
+        self._prepare_output(table.setpoints[0])
 
-            time.sleep(self.rest_time)
 
-        self.power_supply.disable_output()
+class _StreamedWave(_Wave):
+    """
+    Plays an equation once, compiled chunk by chunk while it plays. A producer thread evaluates chunks into a bounded
+    queue ahead of playback, so only the chunks in the queue and the one playing are ever held in memory
+    """
 
+    def __init__(self, power_supply: PowerSupply, equation: math_parser.Equation, duration: float, var_step: float,
+                 chunk_size: int, prefetch: int, trigger: bool = False):
+        super().__init__(power_supply, None, trigger)
 
-class _ArbitraryWave(threading.Thread):
+        self.equation = equation
+        # Playback waited for a chunk that was not ready yet
+        self.underruns = 0
+        # Error that ended the wave early, if evaluating a later chunk failed
+        self.error = None
 
-    def __init__(self, power_supply: PowerSupply, coordinates: List[Tuple[float, float]]):
-        self.power_supply = power_supply
-        self.coordinates = coordinates
-        self.power_supply.disable_output()
-        self.power_supply.set_current(self.coordinates[0][1])
+        self._stream = stream_points(equation.chunks((0.0, duration), var_step, chunk_size),
+                                     power_supply.current_resolution)
+        self._chunks = queue.Queue(prefetch)
 
-        super().__init__()
+        # Compiled here, so errors in the equation reach the caller and the first level is known before the output is on
+        first = next(self._stream)
+        self._chunks.put(first)
+        self._frames = first.frames
+        self._merged = 0
+        self._end = None
 
-    def run(self):
-        self.running = True
-        self.power_supply.enable_output()
-        while self.running:
+        self._producer = threading.Thread(target=self._produce, daemon=True)
 
-            for coordinate, next_coordinate in zip(self.coordinates[:-1], self.coordinates[1:]):
-                if not self.running:
-                    break
-                self.power_supply.set_current(coordinate[1])
-                time.sleep(max(MIN_STEP_PERIOD, next_coordinate[0] - coordinate[0]))
+        self._prepare_output(first.setpoints[0] if first.setpoints else None)
 
-            if self.running:
-                self.power_supply.set_current(self.coordinates[-1][1])
-                time.sleep(max(MIN_STEP_PERIOD, self.coordinates[-1][0] - self.coordinates[-2][0]))
+    @property
+    def frames(self) -> List[bytes]:
+        return self._frames
+
+    @property
+    def merged(self) -> int:
+        return self._merged
+
+    def run(self):
+        self._producer.start()
+        super().run()
+
+    def _produce(self):
+        try:
+            for chunk in self._stream:
+                if not self._put(chunk):
+                    return
+        except ValueError as error:
+            self._put(error)
+            return
 
-        self.power_supply.disable_output()
\ No newline at end of file
+        self._put(None)
+
+    def _put(self, item) -> bool:
+        """
+        :return: False if the wave was stopped before there was room for the item
+        """
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _get(self):
+        while not self._stopped.is_set():
+            try:
+                return self._chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        return None
+
+    def _schedule(self) -> Iterator[Tuple[float, float, bytes, bytes, int]]:
+        """
+        :return: Iterator of (offset from the start of the wave, setpoint, frame, arm frame, opcode) until the equation
+                 ends
+        """
+        first = True
+        while True:
+            try:
+                chunk = self._chunks.get_nowait()
+            except queue.Empty:
+                if not first:
+                    self.underruns += 1
+                chunk = self._get()
+            first = False
+
+            if chunk is None:
+                return
+
+            if isinstance(chunk, ValueError):
+                self.error = chunk
+                print('Stopping streamed wave: %s' % chunk)
+                return
+
+            self._frames = chunk.frames or self._frames
+            self._merged += chunk.merged
+            self.power_supply.wave_stats['merged'] = self._merged
+            self._end = chunk.end
+
+            yield from zip(chunk.offsets, chunk.setpoints, chunk.frames, chunk.arm_frames, chunk.opcodes)
+
+    def _end_offset(self) -> Optional[float]:
+        return self._end if self.error is None else None
@@ -0,0 +1,419 @@
+import math
+import os
+import select
+import threading
+import time
+import tty
+from typing import Tuple, List, Optional, Union
+
+_Num = Union[int, float]
+
+_BITS_PER_BYTE = 11  # 8N2: start bit, 8 data bits, two stop bits
+
+_IDN = b'HEWLETT-PACKARD,E3632A,0,1.7-5.0-1.0'
+
+# Voltage and current limits of each output range
+_RANGES = {'LOW': (15.45, 7.21), 'HIGH': (30.9, 4.12)}
+_RANGE_NAMES = {b'LOW': 'LOW', b'P15V': 'LOW', b'HIGH': 'HIGH', b'P30V': 'HIGH'}
+
+# Long form of every keyword the emulator understands, headers are normalized to the short form
+_LONG_KEYWORDS = {b'OUTPUT': b'OUTP', b'VOLTAGE': b'VOLT', b'RANGE': b'RANG', b'APPLY': b'APPL', b'CURRENT': b'CURR',
+                  b'MEASURE': b'MEAS', b'SYSTEM': b'SYST', b'ERROR': b'ERR', b'TRIGGER': b'TRIG', b'SOURCE': b'SOUR',
+                  b'DELAY': b'DEL', b'INITIATE': b'INIT', b'IMMEDIATE': b'IMM'}
+
+_MAX_ERRORS = 20
+
+_NO_ERROR = b'+0,"No error"'
+_ERRORS = {-109: b'Missing parameter', -113: b'Undefined header', -211: b'Trigger ignored',
+           -222: b'Data out of range', -224: b'Illegal parameter value', -350: b'Queue overflow'}
+
+
+class _SCPIError(Exception):
+
+    def __init__(self, code: int):
+        self.code = code
+        super().__init__('%d, %s' % (code, _ERRORS[code].decode('ascii')))
+
+
+class SCPIEmulator(threading.Thread):
+    """
+    Emulates an E3632A supply driving a coil behind a pseudo terminal so a PowerSupply can be opened on it unmodified:
+
+        with SCPIEmulator() as emulator:
+            ps = PowerSupply(emulator.port, relay_1, relay_2)
+
+    Every line arrives once its bytes have been sent at the configured baud rate, every command then takes the parse
+    latency to execute and every response is delayed by its own byte time. The output feeds a coil of the given
+    inductance and resistance: the current rises towards the setpoint as fast as the voltage setting allows and decays
+    with the L/R time constant when the setpoint drops or the output turns off, since the supply cannot sink current.
+
+    time_scale multiplies the serial and parse delays, e.g. 0 for instant responses in regression runs. The coil always
+    follows real time.
+    """
+
+    def __init__(self, baudrate: int = 9600, time_scale: _Num = 1.0, parse_latency: _Num = 0.002,
+                 inductance: _Num = 0.01, resistance: _Num = 2.0):
+        """
+        :param baudrate: Simulated baud rate used for byte timing
+        :param time_scale: Factor applied to the serial and parse delays
+        :param parse_latency: Time in seconds to execute each command of a line
+        :param inductance: Coil inductance in H
+        :param resistance: Coil resistance in Ohm
+        """
+
+        if resistance <= 0:
+            raise ValueError('Resistance must be positive')
+
+        self.baudrate = baudrate
+        self.time_scale = time_scale
+        self.parse_latency = parse_latency
+        self.inductance = inductance
+        self.resistance = resistance
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self.command_counts = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # (time.monotonic(), current setpoint) every time the commanded output current changes, 0 while off
+        self.setpoint_log = []
+
+        self._stopped = threading.Event()
+        self._buffer = b''
+        # time.monotonic() the last byte of each complete line in the buffer has come off the wire
+        self._arrivals = []
+        self._wire_free_at = 0.0
+        self._reset_state()
+
+        super().__init__(daemon=True)
+
+    def __enter__(self) -> 'SCPIEmulator':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+        os.close(self._master)
+        os.close(self._slave)
+
+    @property
+    def time_constant(self) -> float:
+        """
+        L/R time constant of the coil in seconds
+        """
+        return self.inductance / self.resistance
+
+    def _reset_state(self):
+        self.output = False
+        self.range = 'LOW'
+        self.voltage = 0.0
+        self.current = _RANGES[self.range][1]
+        self.current_step = 0.001
+        self.trigger_source = b'IMM'
+        self.trigger_delay = 0.0
+        self.triggered_current = self.current
+        self.armed = False
+        self.errors = []
+
+        # Coil segment: (start time, current at the start), the setpoints in force are read from the attributes
+        self._coil = (time.monotonic(), 0.0)
+        self._log_setpoint()
+
+    def coil_current(self, at: float = None) -> float:
+        """
+        :param at: time.monotonic() to evaluate the coil current at, now if None. Only valid since the last change
+        :return: Current through the coil in A
+        """
+        if at is None:
+            at = time.monotonic()
+
+        start, current = self._coil
+        elapsed = max(0.0, at - start)
+        tau = self.time_constant
+        decay = math.exp(-elapsed / tau) if tau > 0 else 0.0
+
+        if not self.output:
+            return current * decay
+
+        ceiling = min(self.current, self.voltage / self.resistance)
+        if current >= ceiling:
+            # The supply cannot sink current, the coil discharges through its own resistance
+            return max(ceiling, current * decay)
+
+        # Voltage limited rise until the current limit takes over
+        asymptote = self.voltage / self.resistance
+        return min(ceiling, asymptote + (current - asymptote) * decay)
+
+    def coil_voltage(self, at: float = None) -> float:
+        """
+        :param at: time.monotonic() to evaluate the output voltage at, now if None
+        :return: Voltage across the output terminals in V
+        """
+        if not self.output:
+            return 0.0
+
+        current = self.coil_current(at)
+        ceiling = min(self.current, self.voltage / self.resistance)
+        if current < ceiling:
+            return self.voltage
+        if current > ceiling:
+            return 0.0
+        return current * self.resistance
+
+    def run(self):
+        while not self._stopped.is_set():
+            line = self._next_line()
+            if line is not None:
+                self._handle_line(line)
+
+    def _byte_time(self, num_bytes: int) -> float:
+        return num_bytes * _BITS_PER_BYTE / self.baudrate * self.time_scale
+
+    def _next_line(self) -> Optional[bytes]:
+        """
+        Reads until a complete line is buffered, or None once stopped
+        """
+        while not self._stopped.is_set():
+            end = self._buffer.find(b'\n')
+            if end >= 0:
+                line = self._buffer[:end + 1]
+                self._buffer = self._buffer[end + 1:]
+
+                # The line is only complete once its last byte has been transmitted
+                remaining = self._arrivals.pop(0) - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+                return line.rstrip(b'\r\n')
+
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if readable:
+                self._receive(os.read(self._master, 4096))
+
+        return None
+
+    def _receive(self, data: bytes):
+        """
+        Buffers data written by the host. The wire keeps transmitting while earlier lines are executed, so bytes queue
+        behind those still being sent rather than behind the commands being parsed
+        """
+        start = max(time.monotonic(), self._wire_free_at)
+
+        end = data.find(b'\n')
+        while end >= 0:
+            self._arrivals.append(start + self._byte_time(end + 1))
+            end = data.find(b'\n', end + 1)
+
+        self._wire_free_at = start + self._byte_time(len(data))
+        self.bytes_received += len(data)
+        self._buffer += data
+
+    def _respond(self, response: bytes):
+        response += b'\n'
+        time.sleep(self._byte_time(len(response)))
+        os.write(self._master, response)
+        self.bytes_sent += len(response)
+
+    def _handle_line(self, line: bytes):
+        """
+        Executes the commands of a line in order. Responses to several queries in one line are joined with ';'
+        """
+        responses = []
+
+        for command in line.split(b';'):
+            command = command.strip()
+            if not command:
+                continue
+
+            time.sleep(self.parse_latency * self.time_scale)
+            try:
+                response = self._handle(command)
+            except _SCPIError as error:
+                self._push_error(error.code)
+                continue
+
+            if response is not None:
+                responses.append(response)
+
+        if responses:
+            self._respond(b';'.join(responses))
+
+    def _handle(self, command: bytes) -> Optional[bytes]:
+        header, _, argument = command.partition(b' ')
+        header = _normalize(header)
+        argument = argument.strip().upper()
+        self.command_counts[header] = self.command_counts.get(header, 0) + 1
+
+        if header == b'*IDN?':
+            return _IDN
+        elif header == b'*RST':
+            self._reset_state()
+        elif header == b'*CLS':
+            self.errors = []
+        elif header == b'*TRG':
+            self._trigger(b'BUS')
+        elif header == b'SYST:ERR?':
+            return self._pop_error()
+        elif header == b'MEAS:CURR?':
+            return b'%+.8E' % self.coil_current()
+        elif header == b'MEAS:VOLT?':
+            return b'%+.8E' % self.coil_voltage()
+        elif header == b'OUTP':
+            self._set_output(_parse_bool(argument))
+        elif header == b'OUTP?':
+            return b'1' if self.output else b'0'
+        elif header == b'VOLT:RANG':
+            if argument not in _RANGE_NAMES:
+                raise _SCPIError(-224 if argument else -109)
+            self.range = _RANGE_NAMES[argument]
+            voltage_limit, current_limit = _RANGES[self.range]
+            self._set_levels(min(self.voltage, voltage_limit), min(self.current, current_limit))
+        elif header == b'VOLT':
+            self._set_levels(self._parse_level(argument, 0), self.current)
+        elif header == b'VOLT?':
+            return b'%+.8E' % self.voltage
+        elif header == b'APPL':
+            voltage, _, current = argument.partition(b',')
+            voltage = self._parse_level(voltage.strip(), 0)
+            current = self._parse_level(current.strip(), 1) if current.strip() else self.current
+            self._set_levels(voltage, current)
+        elif header == b'CURR':
+            if argument in (b'UP', b'DOWN'):
+                step = self.current_step if argument == b'UP' else -self.current_step
+                current = round(self.current + step, 6)
+                if not 0 <= current <= _RANGES[self.range][1]:
+                    raise _SCPIError(-222)
+                self._set_levels(self.voltage, current)
+            else:
+                self._set_levels(self.voltage, self._parse_level(argument, 1))
+        elif header == b'CURR?':
+            return b'%+.8E' % self.current
+        elif header == b'CURR:STEP':
+            self.current_step = self._parse_level(argument, 1, default=0.001)
+        elif header == b'CURR:TRIG':
+            self.triggered_current = self._parse_level(argument, 1)
+        elif header == b'TRIG:SOUR':
+            if argument not in (b'BUS', b'IMM'):
+                raise _SCPIError(-224 if argument else -109)
+            self.trigger_source = argument
+        elif header == b'TRIG:DEL':
+            self.trigger_delay = _parse_number(argument, 0.0, 3600.0, 0.0)
+        elif header == b'INIT':
+            self.armed = True
+            if self.trigger_source == b'IMM':
+                self._trigger(b'IMM')
+        else:
+            raise _SCPIError(-113)
+
+        return None
+
+    def _parse_level(self, argument: bytes, index: int, default: _Num = 0.0) -> float:
+        """
+        :param index: 0 for a voltage, 1 for a current of the present range
+        """
+        return _parse_number(argument, 0.0, _RANGES[self.range][index], default)
+
+    def _set_levels(self, voltage: float, current: float):
+        # Start a new coil segment from the current flowing right now
+        now = time.monotonic()
+        self._coil = (now, self.coil_current(now))
+        self.voltage = voltage
+        self.current = current
+        self._log_setpoint()
+
+    def _set_output(self, on: bool):
+        now = time.monotonic()
+        self._coil = (now, self.coil_current(now))
+        self.output = on
+        self._log_setpoint()
+
+    def _trigger(self, source: bytes):
+        if not self.armed or self.trigger_source != source:
+            raise _SCPIError(-211)
+
+        self.armed = False
+        if self.trigger_delay > 0:
+            time.sleep(self.trigger_delay)
+        self._set_levels(self.voltage, self.triggered_current)
+
+    def _log_setpoint(self):
+        setpoint = self.current if self.output else 0.0
+        if not self.setpoint_log or self.setpoint_log[-1][1] != setpoint:
+            self.setpoint_log.append((self._coil[0], setpoint))
+
+    def _push_error(self, code: int):
+        if len(self.errors) < _MAX_ERRORS - 1:
+            self.errors.append(code)
+        elif len(self.errors) == _MAX_ERRORS - 1:
+            self.errors.append(-350)
+
+    def _pop_error(self) -> bytes:
+        if not self.errors:
+            return _NO_ERROR
+
+        code = self.errors.pop(0)
+        return b'%+d,"%s"' % (code, _ERRORS[code])
+
+    def setpoint_edges(self, since: float = 0.0) -> List[Tuple[float, float]]:
+        """
+        :param since: Only return changes at or after this time.monotonic()
+        :return: List of (time.monotonic(), current setpoint) for every change of the commanded output current
+        """
+        return [(at, setpoint) for at, setpoint in self.setpoint_log if at >= since]
+
+
+def _normalize(header: bytes) -> bytes:
+    """
+    Upper cases a header and replaces long keywords with their short form, e.g. 'Measure:Current?' -> 'MEAS:CURR?'
+    """
+    header = header.upper().lstrip(b':')
+    query = header.endswith(b'?')
+    keywords = header.rstrip(b'?').split(b':')
+
+    normalized = b':'.join(_LONG_KEYWORDS.get(keyword, keyword) for keyword in keywords)
+    return normalized + b'?' if query else normalized
+
+
+def _parse_bool(argument: bytes) -> bool:
+    if argument in (b'ON', b'1'):
+        return True
+    if argument in (b'OFF', b'0'):
+        return False
+    raise _SCPIError(-224 if argument else -109)
+
+
+def _parse_number(argument: bytes, minimum: float, maximum: float, default: float) -> float:
+    if not argument:
+        raise _SCPIError(-109)
+    if argument in (b'MIN', b'MINIMUM'):
+        return minimum
+    if argument in (b'MAX', b'MAXIMUM'):
+        return maximum
+    if argument in (b'DEF', b'DEFAULT'):
+        return default
+
+    try:
+        value = float(argument)
+    except ValueError:
+        raise _SCPIError(-224)
+
+    if not minimum <= value <= maximum:
+        raise _SCPIError(-222)
+    return value
+
+
+if __name__ == '__main__':
+    with SCPIEmulator() as emulator:
+        print('E3632A emulator listening on %s (Ctrl-C to stop)' % emulator.port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,202 @@
+import threading
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Dict, Optional, Union
+
+import serial
+
+_Num = Union[int, float]
+
+# Decay applied to the longest telemetry hold time each time a shorter one is seen
+_HOLD_DECAY = 0.9
+
+# How long past a reserved deadline telemetry keeps waiting for the real-time write, in case it is late
+_RESERVATION_GRACE = 0.05
+
+
+class Priority(IntEnum):
+    REALTIME = 0  # Wave setpoints and output off
+    CONTROL = 1  # Settings and other commands
+    TELEMETRY = 2  # Measurements and status queries
+
+
+class SerialBroker:
+    """
+    Serializes all traffic on one serial port. A caller holds the port from writing a query until its response has
+    been read, so responses always match their queries. When the port is released the waiting caller with the highest
+    priority gets it next.
+
+    The port is handed over in the caller's own thread, so a real-time write is not delayed by a thread switch. A wave
+    reserves its next deadline with reserve(), and telemetry queries that would still hold the port at that deadline
+    wait until the next real-time write has taken the port.
+
+    Use get_broker to share one broker between all users of a port.
+    """
+
+    def __init__(self, serial_conn: serial.Serial):
+        self.serial_conn = serial_conn
+
+        self._condition = threading.Condition()
+        self._owner = None
+        self._depth = 0
+
+        self._waiting = [0] * len(Priority)
+        self._reserved = None
+        # Decaying maximum of how long a telemetry query holds the port
+        self._telemetry_hold = 0.0
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._condition:
+            # count, total wait, max wait, max queue depth, total hold
+            self._stats = [[0, 0.0, 0.0, 0, 0.0] for _ in Priority]
+
+    @contextmanager
+    def acquire(self, priority: Priority = Priority.CONTROL):
+        """
+        Holds the port for the block. Re-entrant within a thread
+
+        :param priority: Priority against other waiting callers
+        """
+        me = threading.get_ident()
+
+        with self._condition:
+            if self._owner == me:
+                self._depth += 1
+                reentered = True
+            else:
+                reentered = False
+                self._wait(priority, me)
+
+        try:
+            yield self.serial_conn
+        finally:
+            with self._condition:
+                if reentered:
+                    self._depth -= 1
+                else:
+                    self._release(priority)
+
+    def _wait(self, priority: Priority, me: int):
+        """
+        Waits for the port while holding the condition
+        """
+        stats = self._stats[priority]
+        self._waiting[priority] += 1
+        stats[3] = max(stats[3], self._waiting[priority])
+
+        start = time.monotonic()
+        while True:
+            timeout = None
+            if self._owner is None and not any(self._waiting[:priority]):
+                timeout = self._reservation_wait(priority)
+                if timeout is None:
+                    break
+            self._condition.wait(timeout)
+
+        self._waiting[priority] -= 1
+        self._owner = me
+        self._depth = 1
+        self._acquired_at = time.monotonic()
+
+        if priority == Priority.REALTIME:
+            self._reserved = None
+
+        wait = self._acquired_at - start
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+
+    def _reservation_wait(self, priority: Priority) -> Optional[float]:
+        """
+        :return: Time to wait for the reserved deadline to pass, None if the port can be taken now
+        """
+        if priority != Priority.TELEMETRY or self._reserved is None:
+            return None
+
+        now = time.monotonic()
+        if now + self._telemetry_hold > self._reserved and now < self._reserved + _RESERVATION_GRACE:
+            return self._reserved + _RESERVATION_GRACE - now
+
+        return None
+
+    def _release(self, priority: Priority):
+        hold = time.monotonic() - self._acquired_at
+        self._stats[priority][4] += hold
+
+        if priority == Priority.TELEMETRY:
+            self._telemetry_hold = max(hold, self._telemetry_hold * _HOLD_DECAY)
+
+        self._owner = None
+        self._depth = 0
+        self._condition.notify_all()
+
+    @property
+    def telemetry_hold(self) -> float:
+        """
+        Decaying maximum of how long a telemetry query holds the port, in seconds
+        """
+        with self._condition:
+            return self._telemetry_hold
+
+    def reserve(self, deadline: Optional[float]):
+        """
+        Keeps telemetry queries from holding the port at a coming real-time deadline
+
+        :param deadline: time.monotonic() of the next real-time write, None to clear
+        """
+        with self._condition:
+            self._reserved = deadline
+            self._condition.notify_all()
+
+    def write(self, data: bytes, priority: Priority = Priority.CONTROL):
+        with self.acquire(priority):
+            self.serial_conn.write(data)
+
+    def query(self, data: bytes, priority: Priority = Priority.TELEMETRY) -> bytes:
+        """
+        Writes a query and reads its response line while holding the port
+        """
+        with self.acquire(priority):
+            self.serial_conn.write(data)
+            return self.serial_conn.readline()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: Dict of priority name to the number of acquisitions, mean and max wait for the port and mean time
+                 holding it in seconds, and the current and highest number of waiting callers
+        """
+        with self._condition:
+            return {priority.name: {'count': count,
+                                    'mean_wait': total_wait / count if count else 0.0,
+                                    'max_wait': max_wait,
+                                    'mean_hold': total_hold / count if count else 0.0,
+                                    'queue_depth': self._waiting[priority],
+                                    'max_queue_depth': max_depth}
+                    for priority, (count, total_wait, max_wait, max_depth, total_hold) in zip(Priority, self._stats)}
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(serial_conn: serial.Serial) -> SerialBroker:
+    """
+    :return: The broker of the port serial_conn is open on, created on first use or once the connection it was
+             created for has been closed
+    :raises ValueError: If the port is still open through another connection. Either connection could read the
+                        other's responses, so share the open connection instead
+    """
+    with _brokers_lock:
+        broker = _brokers.get(serial_conn.port)
+
+        if broker is not None and broker.serial_conn is not serial_conn:
+            if broker.serial_conn.is_open:
+                raise ValueError('%s is already open through another connection' % serial_conn.port)
+            broker = None
+
+        if broker is None:
+            broker = _brokers[serial_conn.port] = SerialBroker(serial_conn)
+        return broker
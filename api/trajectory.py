@@ -0,0 +1,157 @@
+import time
+from typing import Sequence, Tuple, List, NamedTuple, Union
+
+import numpy as np
+import serial
+
+from api.manipulator import Manipulator, MAX_PROGRAM_MOVES, MAX_PROGRAM_NUM, pack_moves, _execute_frame, \
+    _program_target
+
+_Num = Union[int, float]
+_Moves = Union[np.ndarray, Sequence[Tuple[_Num, _Num, _Num]]]
+
+
+class ChunkStats(NamedTuple):
+    program_num: int
+    moves: int
+    pack_time: float  # Time spent building the program frame
+    upload_time: float  # Time from start of upload until it was acknowledged (or sent if overlapped)
+    execute_time: float  # Time from sending 'k' until the program completed
+    dead_time: float  # Idle time between the previous chunk completing and this chunk starting
+    overlapped: bool  # True if this chunk was uploaded while the previous chunk was executing
+
+
+class TrajectoryStreamer:
+    """
+    Plays a move sequence of any length by splitting it into programs and cycling through program slots.
+
+    The next chunk is always packed while the current chunk executes. With overlap_upload enabled the next
+    chunk is also uploaded into a different slot while the current one is running, and both acknowledgements
+    are collected after execution completes. Only enable it if the controller buffers commands received
+    during a move, otherwise the upload is lost and the stream stalls until the serial timeout.
+    """
+
+    def __init__(self, manipulator: Manipulator, program_slots: Sequence[int] = (1, 2),
+                 chunk_size: int = MAX_PROGRAM_MOVES, overlap_upload: bool = False):
+        """
+        :param manipulator: Manipulator to stream to
+        :param program_slots: Program numbers (1 to 10) to cycle through
+        :param chunk_size: Moves per program, at most 99
+        :param overlap_upload: Upload the next chunk while the current chunk executes
+        """
+
+        if len(program_slots) == 0 or not all(1 <= slot <= MAX_PROGRAM_NUM for slot in program_slots):
+            raise ValueError('Program slots must be between 1 and %d' % MAX_PROGRAM_NUM)
+
+        if overlap_upload and len(set(program_slots)) < 2:
+            raise ValueError('Overlapped uploads require at least 2 distinct program slots')
+
+        if not (1 <= chunk_size <= MAX_PROGRAM_MOVES):
+            raise ValueError('Chunk size must be between 1 and %d' % MAX_PROGRAM_MOVES)
+
+        self.manipulator = manipulator
+        self.program_slots = tuple(program_slots)
+        self.chunk_size = chunk_size
+        self.overlap_upload = overlap_upload
+
+        self.last_stats = []
+
+    def stream(self, moves: _Moves):
+        """
+        Uploads and executes all moves in order
+
+        :param moves: List or (N, 3) array of (x, y, z) coordinates in um
+        :return: List of ChunkStats, one per program executed (a Future of it if the manipulator is pipelined)
+        """
+
+        moves = np.asarray(moves, dtype=np.float64)
+        chunks = [moves[i:i + self.chunk_size] for i in range(0, len(moves), self.chunk_size)]
+
+        return self.manipulator._execute('stream', lambda serial_conn: self._stream(serial_conn, chunks))
+
+    def _stream(self, serial_conn: serial.Serial, chunks: List[np.ndarray]) -> List[ChunkStats]:
+        stats = []
+        if len(chunks) == 0:
+            self.last_stats = stats
+            return stats
+
+        slots = [self.program_slots[i % len(self.program_slots)] for i in range(len(chunks))]
+
+        # Keep the manipulator's mirrored position in step with the device, like send_and_execute_moves
+        state = self.manipulator._state
+        mode = state.mode
+
+        pack_start = time.perf_counter()
+        frame = pack_moves(chunks[0], slots[0])
+        pack_time = time.perf_counter() - pack_start
+
+        upload_start = time.perf_counter()
+        serial_conn.write(frame)
+        serial_conn.read()
+        upload_time = time.perf_counter() - upload_start
+        overlapped = False
+
+        last_completion = pack_start
+
+        for i, chunk in enumerate(chunks):
+            has_next = i + 1 < len(chunks)
+
+            execute_start = time.perf_counter()
+            serial_conn.write(_execute_frame(slots[i]))
+
+            # Prepare the next chunk while this one executes
+            if has_next:
+                next_pack_start = time.perf_counter()
+                next_frame = pack_moves(chunks[i + 1], slots[i + 1])
+                next_pack_time = time.perf_counter() - next_pack_start
+
+                if self.overlap_upload:
+                    next_upload_start = time.perf_counter()
+                    serial_conn.write(next_frame)
+                    serial_conn.flush()
+                    next_upload_time = time.perf_counter() - next_upload_start
+
+            # Wait for completion
+            serial_conn.read()
+            execute_end = time.perf_counter()
+            state.moved(_program_target(frame, mode), mode)
+
+            stats.append(ChunkStats(slots[i], len(chunk), pack_time, upload_time, execute_end - execute_start,
+                                    execute_start - last_completion, overlapped))
+            last_completion = execute_end
+
+            if has_next:
+                if self.overlap_upload:
+                    # Acknowledgement of the overlapped upload
+                    serial_conn.read()
+                else:
+                    next_upload_start = time.perf_counter()
+                    serial_conn.write(next_frame)
+                    serial_conn.read()
+                    next_upload_time = time.perf_counter() - next_upload_start
+
+                frame = next_frame
+                pack_time = next_pack_time
+                upload_time = next_upload_time
+                overlapped = self.overlap_upload
+
+        self.last_stats = stats
+        return stats
+
+
+def summarize(stats: Sequence[ChunkStats]) -> dict:
+    """
+    Totals per chunk statistics of a stream
+
+    :param stats: ChunkStats returned by TrajectoryStreamer.stream
+    :return: Dict of chunk and move counts and total pack, upload, execute and dead times in seconds
+    """
+    return {
+        'chunks': len(stats),
+        'moves': sum(chunk.moves for chunk in stats),
+        'pack_time': sum(chunk.pack_time for chunk in stats),
+        'upload_time': sum(chunk.upload_time for chunk in stats),
+        'execute_time': sum(chunk.execute_time for chunk in stats),
+        'dead_time': sum(chunk.dead_time for chunk in stats),
+        'overlapped_chunks': sum(1 for chunk in stats if chunk.overlapped)
+    }
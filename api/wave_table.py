@@ -0,0 +1,376 @@
+import sys
+import threading
+from collections import OrderedDict
+from typing import Sequence, Tuple, List, Union, Callable, Hashable, Dict, Iterable, Iterator, NamedTuple, Optional
+
+import numpy as np
+
+from api import math_parser
+from api.journal import scpi_opcode
+
+_Num = Union[int, float]
+
+# Shortest time a setpoint is held
+MIN_STEP_PERIOD = 0.1
+
+# Current programming resolution of the E3632A in A
+CURRENT_RESOLUTION = 0.001
+
+
+class WaveTable:
+    """
+    One cycle of a waveform compiled for playback: the offset of every step from the cycle start, the current the
+    output should have after the step and the SCPI frame that performs it, ready to write without formatting.
+    arm_frames hold the same setpoints as 'CURR:TRIG <value>;:INIT' frames for trigger playback, opcodes the journal
+    opcode of each frame
+    """
+
+    __slots__ = ('offsets', 'setpoints', 'frames', 'arm_frames', 'opcodes', 'cycle_time', 'merged', 'nbytes')
+
+    def __init__(self, offsets: np.ndarray, setpoints: np.ndarray, frames: List[bytes], cycle_time: float,
+                 merged: int = 0):
+        """
+        :param offsets: Step offsets from the cycle start in seconds, increasing
+        :param setpoints: Output current in A after each step
+        :param frames: Newline terminated SCPI frame of each step
+        :param cycle_time: Cycle length in seconds
+        :param merged: Number of steps merged into the previous step because their setpoint was the same
+        """
+
+        if not (len(offsets) == len(setpoints) == len(frames)):
+            raise ValueError('Offsets, setpoints and frames must have the same length')
+
+        self.offsets = np.asarray(offsets, dtype=np.float64)
+        self.setpoints = np.asarray(setpoints, dtype=np.float64)
+        self.frames = list(frames)
+        self.arm_frames = [arm_frame(setpoint) for setpoint in self.setpoints.tolist()]
+        self.opcodes = [scpi_opcode(frame) for frame in self.frames]
+        self.cycle_time = float(cycle_time)
+        self.merged = merged
+
+        self.nbytes = (self.offsets.nbytes + self.setpoints.nbytes + sys.getsizeof(self.frames)
+                       + sum(sys.getsizeof(frame) for frame in self.frames)
+                       + sys.getsizeof(self.arm_frames) + sum(sys.getsizeof(frame) for frame in self.arm_frames)
+                       + sys.getsizeof(self.opcodes))
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def current_frame(current: _Num) -> bytes:
+    """
+    :return: The frame setting the output current, formatted like PowerSupply.set_current
+    """
+    return b'CURR %f\n' % current
+
+
+def arm_frame(current: _Num) -> bytes:
+    """
+    :return: The frame arming the output current for the next trigger
+    """
+    return b'CURR:TRIG %f;:INIT\n' % current
+
+
+def quantize(currents: Union[_Num, np.ndarray], resolution: _Num = CURRENT_RESOLUTION) -> Union[float, np.ndarray]:
+    """
+    Rounds currents to the nearest value the supply can output
+    """
+    return np.round(np.asarray(currents, dtype=np.float64) / resolution) * resolution
+
+
+class CurrentSetpoint:
+    """
+    The current a supply was last commanded to and its CURR:STEP, quantized, or None while unknown. Shared by the
+    threaded and asyncio supply drivers to skip settings that would not change the output
+    """
+
+    __slots__ = ('current', 'step')
+
+    def __init__(self):
+        self.current = None
+        self.step = None
+
+    def set(self, current: _Num, resolution: _Num = CURRENT_RESOLUTION) -> Optional[float]:
+        """
+        Records an absolute setting
+
+        :return: The quantized current to write, None if the supply is already set to it
+        """
+        current = float(quantize(current, resolution))
+        if current == self.current:
+            return None
+
+        self.current = current
+        return current
+
+    def set_step(self, step: _Num, resolution: _Num = CURRENT_RESOLUTION):
+        self.step = float(quantize(step, resolution))
+
+    def stepped(self, up: bool, resolution: _Num = CURRENT_RESOLUTION):
+        """
+        Records a CURR UP or CURR DOWN, which moves the current by the step but not below 0
+        """
+        if self.current is None or self.step is None:
+            self.current = None
+            return
+
+        step = self.step if up else -self.step
+        self.current = max(0.0, float(quantize(self.current + step, resolution)))
+
+
+def validate_square_wave(amplitude: _Num, period: _Num, duty_cycle: float):
+    if not (0 < duty_cycle < 1):
+        raise ValueError('Duty Cycle must be between 0 and 1')
+
+    if period < MIN_STEP_PERIOD:
+        raise ValueError('Period must be at least %g seconds' % MIN_STEP_PERIOD)
+
+    if amplitude < 0:
+        raise ValueError('Amplitude must be positive')
+
+
+def validate_ramp_wave(amplitude: _Num, rise_time: _Num) -> int:
+    """
+    :return: Number of steps the ramp rises in
+    """
+    if rise_time < MIN_STEP_PERIOD:
+        raise ValueError('Rise time must be at least %g seconds' % MIN_STEP_PERIOD)
+
+    if amplitude <= 0:
+        raise ValueError('Amplitude must be positive')
+
+    return round(rise_time / MIN_STEP_PERIOD)
+
+
+def validate_sine_wave(amplitude: _Num, period: _Num, time_offset: Optional[_Num],
+                       dc_offset: Optional[_Num]) -> Tuple[_Num, _Num]:
+    """
+    :return: time_offset and dc_offset, defaulting to starting the wave at its minimum of 0
+    """
+    if amplitude <= 0:
+        raise ValueError('Amplitude must be positive')
+
+    if period <= 0:
+        raise ValueError('Period must be greater than 0')
+
+    if dc_offset is None:
+        dc_offset = amplitude
+    elif dc_offset < amplitude:
+        raise ValueError('DC offset must be greater than amplitude')
+
+    if time_offset is None:
+        time_offset = period / 4
+
+    return time_offset, dc_offset
+
+
+def compile_square(amplitude: _Num, period: _Num, duty_cycle: float,
+                   resolution: _Num = CURRENT_RESOLUTION) -> WaveTable:
+    """
+    Square wave stepping between 0 and amplitude
+    """
+    return _merged_table(np.array([0.0, duty_cycle * period]), quantize([amplitude, 0.0], resolution), period)
+
+
+def compile_ramp(amplitude: _Num, num_steps: int, steady_time: _Num, rest_time: _Num,
+                 resolution: _Num = CURRENT_RESOLUTION) -> WaveTable:
+    """
+    Ramp rising in num_steps steps, holding for steady_time and resting at 0 for rest_time. Steps too small for the
+    supply's resolution are merged into the step before them
+    """
+    top_time = num_steps * MIN_STEP_PERIOD + steady_time
+
+    offsets = np.append(np.arange(num_steps) * MIN_STEP_PERIOD, top_time)
+    setpoints = quantize(np.append(np.arange(1, num_steps + 1) * (amplitude / num_steps), 0.0), resolution)
+
+    return _merged_table(offsets, setpoints, top_time + rest_time)
+
+
+def compile_points(coordinates: Sequence[Tuple[float, float]], resolution: _Num = CURRENT_RESOLUTION) -> WaveTable:
+    """
+    Waveform through (time, current) points. Each point is held until the next one, but at least the minimum step
+    period, and the last point for as long as the one before it. Currents are quantized to the supply's resolution
+    and consecutive points with the same quantized current are merged into one longer step
+    """
+
+    if len(coordinates) < 2:
+        raise ValueError('At least 2 points are required')
+
+    points = np.asarray(coordinates, dtype=np.float64)
+
+    dwells = np.maximum(MIN_STEP_PERIOD, np.diff(points[:, 0]))
+    dwells = np.append(dwells, dwells[-1])
+    offsets = np.concatenate(([0.0], np.cumsum(dwells[:-1])))
+    cycle_time = offsets[-1] + dwells[-1]
+
+    return _merged_table(offsets, quantize(points[:, 1], resolution), cycle_time)
+
+
+def _merged_table(offsets: np.ndarray, setpoints: np.ndarray, cycle_time: float) -> WaveTable:
+    """
+    :param setpoints: Quantized setpoint of each step
+    :return: Table setting every setpoint with an absolute CURR frame, with steps repeating the setpoint before them
+             merged into that step
+    """
+    keep = np.ones(len(setpoints), dtype=bool)
+    keep[1:] = setpoints[1:] != setpoints[:-1]
+
+    offsets = offsets[keep]
+    setpoints = setpoints[keep]
+
+    return WaveTable(offsets, setpoints, [current_frame(current) for current in setpoints.tolist()], cycle_time,
+                     int(len(keep) - keep.sum()))
+
+
+class WaveChunk(NamedTuple):
+    """
+    Consecutive steps of a streamed waveform, as plain lists ready for playback
+    """
+    offsets: List[float]  # Step offsets from the start of the wave in seconds
+    setpoints: List[float]
+    frames: List[bytes]
+    arm_frames: List[bytes]
+    opcodes: List[int]  # Journal opcode of each frame
+    end: float  # Offset the last step is held until, where the next chunk or the wave ends
+    merged: int
+
+
+def stream_points(chunks: Iterable[Tuple[np.ndarray, np.ndarray]],
+                  resolution: _Num = CURRENT_RESOLUTION) -> Iterator[WaveChunk]:
+    """
+    Compiles (time, current) points arriving in chunks, e.g. from math_parser.Equation.chunks, into WaveChunks timed
+    and merged like compile_points would the whole waveform. A point's dwell depends on the next point, so the last
+    point of each chunk is carried over into the next one
+
+    :param chunks: Iterable of (times, currents) array pairs
+    :param resolution: Current programming resolution in A
+    :return: Iterator of WaveChunks, empty ones included when every step was merged
+    """
+    offset = 0.0
+    dwell = None
+    carried = None  # (time, current) of the point waiting for the next chunk
+    previous = None  # Last setpoint emitted
+
+    for times, currents in chunks:
+        times = np.asarray(times, dtype=np.float64)
+        currents = np.asarray(currents, dtype=np.float64)
+        if carried is not None:
+            times = np.concatenate(([carried[0]], times))
+            currents = np.concatenate(([carried[1]], currents))
+
+        if len(times) == 0:
+            continue
+        carried = (times[-1], currents[-1])
+        if len(times) < 2:
+            continue
+
+        ends = offset + np.cumsum(np.maximum(MIN_STEP_PERIOD, np.diff(times)))
+        offsets = np.concatenate(([offset], ends[:-1]))
+        dwell = float(ends[-1] - offsets[-1])
+
+        chunk, previous = _wave_chunk(offsets, quantize(currents[:-1], resolution), float(ends[-1]), previous)
+        offset = chunk.end
+        yield chunk
+
+    if dwell is None:
+        raise ValueError('At least 2 points are required')
+
+    # The last point is held for as long as the one before it
+    chunk, _ = _wave_chunk(np.array([offset]), quantize(carried[1:], resolution), offset + dwell, previous)
+    yield chunk
+
+
+def _wave_chunk(offsets: np.ndarray, setpoints: np.ndarray, end: float,
+                previous: float) -> Tuple[WaveChunk, float]:
+    """
+    :param previous: Setpoint of the step before the chunk, None if it is the first
+    :return: The chunk without steps repeating the setpoint before them, and its last setpoint
+    """
+    keep = np.ones(len(setpoints), dtype=bool)
+    keep[1:] = setpoints[1:] != setpoints[:-1]
+    if previous is not None:
+        keep[0] = setpoints[0] != previous
+
+    setpoint_list = setpoints[keep].tolist()
+    frames = [current_frame(current) for current in setpoint_list]
+    chunk = WaveChunk(offsets[keep].tolist(), setpoint_list, frames, [arm_frame(current) for current in setpoint_list],
+                      [scpi_opcode(frame) for frame in frames], end, int(len(keep) - keep.sum()))
+
+    return chunk, float(setpoints[-1])
+
+
+def compile_sine(amplitude: _Num, period: _Num, time_offset: _Num, dc_offset: _Num,
+                 resolution: _Num = CURRENT_RESOLUTION) -> WaveTable:
+    """
+    Sine wave sampled every minimum step period
+    """
+    equation = '%f * sin(6.28318530718 * (t - %f) / %f) + %f' % (amplitude, time_offset, period, dc_offset)
+    return compile_points(np.column_stack(math_parser.evaluate_equation(equation, 't', (0, period), MIN_STEP_PERIOD)),
+                          resolution)
+
+
+class WaveTableCache:
+    """
+    Least recently used cache of compiled wave tables, bounded by the memory the tables take up
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        """
+        :param max_bytes: Total table size kept before the least recently used tables are evicted
+        """
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._tables = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def get(self, key: Hashable, compile_table: Callable[[], WaveTable]) -> WaveTable:
+        """
+        :param key: Wave type and parameters identifying the table
+        :param compile_table: Called to compile the table if it is not cached
+        :return: The cached or newly compiled table
+        """
+
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return table
+            self.misses += 1
+
+        table = compile_table()
+
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = table
+                self._nbytes += table.nbytes
+
+            # Always keep the newest table, even if it alone exceeds the limit
+            while self._nbytes > self.max_bytes and len(self._tables) > 1:
+                _, evicted = self._tables.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self.evictions += 1
+
+        return table
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'tables': len(self._tables), 'bytes': self._nbytes, 'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+# Shared by all power supplies so restarting a wave with the same parameters reuses its table
+wave_tables = WaveTableCache()
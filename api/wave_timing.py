@@ -0,0 +1,102 @@
+import threading
+import time
+from typing import Union, Dict, List, Tuple
+
+_Num = Union[int, float]
+
+# Time before a deadline that is busy waited instead of slept, sleep alone can overshoot by around a millisecond
+SPIN_TIME = 0.001
+
+# Upper bin edges of the lateness histogram in seconds, the last bin holds everything later
+_LATENESS_EDGES = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+
+def sleep_until(deadline: float, spin: _Num = SPIN_TIME, stopped: threading.Event = None) -> float:
+    """
+    Sleeps until an absolute time.monotonic() deadline, spinning for the final part to wake up on time
+
+    :param deadline: time.monotonic() value to wake up at
+    :param spin: Time in seconds before the deadline to stop sleeping and busy wait
+    :param stopped: Optional event that ends the wait early when set
+    :return: Lateness in seconds, i.e. how long after the deadline this returned. Negative if stopped early
+    """
+
+    remaining = deadline - time.monotonic() - spin
+    if remaining > 0:
+        if stopped is None:
+            time.sleep(remaining)
+        elif stopped.wait(remaining):
+            return time.monotonic() - deadline
+
+    now = time.monotonic()
+    while now < deadline:
+        now = time.monotonic()
+
+    return now - deadline
+
+
+class LatenessHistogram:
+    """
+    Histogram of how late scheduled steps ran. Safe to read from another thread while it is being recorded into
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(_LATENESS_EDGES) + 1)
+            self._total = 0.0
+            self._max = 0.0
+
+    def record(self, lateness: float):
+        with self._lock:
+            index = 0
+            while index < len(_LATENESS_EDGES) and lateness > _LATENESS_EDGES[index]:
+                index += 1
+
+            self._counts[index] += 1
+            self._total += lateness
+            self._max = max(self._max, lateness)
+
+    def bins(self) -> List[Tuple[float, int]]:
+        """
+        :return: List of (upper edge in seconds, count), the last edge is infinity
+        """
+        with self._lock:
+            return list(zip(_LATENESS_EDGES + (float('inf'),), self._counts))
+
+    def percentile(self, percent: _Num) -> float:
+        """
+        :param percent: Percentile between 0 and 100
+        :return: Upper edge of the bin containing the percentile in seconds, or the maximum if that is lower
+        """
+        with self._lock:
+            count = sum(self._counts)
+            if count == 0:
+                return 0.0
+
+            target = percent / 100 * count
+            seen = 0
+            for edge, bin_count in zip(_LATENESS_EDGES, self._counts):
+                seen += bin_count
+                if seen >= target:
+                    return min(edge, self._max)
+
+            return self._max
+
+    def summary(self) -> Dict[str, float]:
+        """
+        :return: Dict with the count, mean and max lateness, the approximate 99th percentile, all in seconds, and the
+                 number of steps more than a millisecond late
+        """
+        p99 = self.percentile(99)
+
+        with self._lock:
+            count = sum(self._counts)
+            late = sum(bin_count for edge, bin_count in zip(_LATENESS_EDGES + (float('inf'),), self._counts)
+                       if edge > 0.001)
+
+            return {'count': count, 'mean': self._total / count if count else 0.0, 'max': self._max, 'p99': p99,
+                    'late': late}
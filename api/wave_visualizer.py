@@ -3,16 +3,7 @@ from typing import Tuple
 import matplotlib.pyplot as plt
 import numpy as np
 
-from asteval import Interpreter, make_symbol_table
-
-
-def step(x):
-    return np.heaviside(x, 0)
-
-
-syms = make_symbol_table(use_numpy=True, step=step)
-
-aeval = Interpreter(syms)
+from api import math_parser
 
 
 _CONTINUOUS_STEPS = 1000
@@ -33,11 +24,12 @@ def visualize_wave(equation_str: str, variable: str, var_range: Tuple[float, flo
     if wave_title is None:
         wave_title = 'Visualization of %s' % equation_str
 
+    # Compiled once for both plots, and shared with the supply if it plays the same equation
+    equation = math_parser.compile_equation(equation_str, variable)
+
     # Continuous first
-    aeval.symtable[variable] = np.arange(var_range[0], var_range[1], (var_range[1]-var_range[0])/_CONTINUOUS_STEPS)
-    cont_var = aeval.symtable[variable]
-    aeval('cont_func = %s' % equation_str)
-    cont_func = aeval.symtable['cont_func']
+    cont_var = np.arange(var_range[0], var_range[1], (var_range[1]-var_range[0])/_CONTINUOUS_STEPS)
+    cont_func = equation(cont_var)
 
     fig, ax = plt.subplots()
     ax.plot(cont_var, cont_func, label='Desired')
@@ -46,10 +38,7 @@ def visualize_wave(equation_str: str, variable: str, var_range: Tuple[float, flo
 
     if discretization_step is not None:
         # Discrete next
-        aeval.symtable[variable] = np.arange(var_range[0], var_range[1], discretization_step)
-        disc_var = aeval.symtable[variable]
-        aeval('disc_func = %s' % equation_str)
-        disc_func = aeval.symtable['disc_func']
+        disc_var, disc_func = equation.sample(var_range, discretization_step)
         plt.step(disc_var, disc_func, where='post', label='Actual')
         plt.legend()
 
@@ -0,0 +1,81 @@
+"""
+Compares sampling an equation string with the original asteval loop, which steps the variable one sample at a time
+inside the interpreter, against math_parser.evaluate_equation, which compiles the equation once and evaluates it over
+a NumPy array of the variable.
+
+The loop is only timed up to _MAX_LOOP_SAMPLES, beyond that it takes minutes.
+
+Run from the repository root with: python -m benchmarks.equation_eval
+"""
+import time
+
+from asteval import Interpreter
+
+from api import math_parser
+
+_EQUATION = '0.5 * sin(6.28318530718 * t / 10) + 0.5 + 0.1 * step(t - 5)'
+_END = 10.0
+_MAX_LOOP_SAMPLES = 10 ** 5
+
+
+def _loop_interpreter() -> Interpreter:
+    aeval = Interpreter()
+    aeval('''
+def heaviside(x):
+    return int(x >= 0)
+''')
+    return aeval
+
+
+def _loop(aeval: Interpreter, num_samples: int) -> list:
+    # The original parse_equation, with step renamed since the step size overwrote it
+    aeval.symtable['start'] = 0.0
+    aeval.symtable['end'] = _END
+    aeval.symtable['computed_values'] = []
+    aeval.symtable['increment'] = _END / num_samples
+    aeval.symtable['t'] = 0.0
+
+    aeval('''
+while t < end:
+    computed_values.append((t, %s))
+    t += increment
+''' % _EQUATION.replace('step(', 'heaviside('))
+
+    return aeval.symtable['computed_values']
+
+
+def _time(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    aeval = _loop_interpreter()
+
+    print('%10s %12s %12s %9s %14s' % ('Samples', 'Loop', 'Vectorized', 'Speedup', 'Loop t error'))
+    for exponent in range(3, 8):
+        num_samples = 10 ** exponent
+        var_step = _END / num_samples
+
+        vectorized = _time(lambda: math_parser.evaluate_equation(_EQUATION, 't', (0, _END), var_step))
+
+        if num_samples > _MAX_LOOP_SAMPLES:
+            print('%10d %12s %10.3f ms %9s %14s' % (num_samples, '-', vectorized * 1e3, '-', '-'))
+            continue
+
+        values = []
+        loop = _time(lambda: values.extend(_loop(aeval, num_samples)))
+
+        # How far the accumulated t drifted from start + i * step by the last sample
+        drift = abs(values[-1][0] - (len(values) - 1) * var_step)
+        print('%10d %10.3f ms %10.3f ms %8.1fx %14.3g' % (num_samples, loop * 1e3, vectorized * 1e3,
+                                                          loop / vectorized, drift))
+
+    equation = math_parser.compile_equation(_EQUATION, 't')
+    t = math_parser.sample_range((0, _END), _END / 10 ** 7)
+    print('Evaluating a compiled equation over 10^7 samples: %.3f ms' % (_time(lambda: equation(t)) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Compares the cost of decoding the 33 byte manipulator status reply into a ManipulatorStatus against the legacy decode
+that get_status used before, which sliced every field with int.from_bytes into a nested dict and copied it for the
+caller.
+
+Run from the repository root with: python -m benchmarks.status_decode
+"""
+import os
+import timeit
+
+from api.manipulator import ManipulatorStatus, _USTEPS_PER_UM_
+
+_REPEAT = 5
+_NUMBER = 100000
+
+
+def _legacy_decode(status_bytes: bytes) -> dict:
+    """
+    The status decode get_status used before ManipulatorStatus, kept here as the baseline
+    """
+    flag_byte = status_bytes[0]
+    flag_2_byte = status_bytes[15]
+
+    status = {
+        'FLAGS': {
+            'SETUP': flag_byte & 0b00001111,
+            'ROE_DIR': 'Negative' if (flag_byte & (1 << 4)) == (1 << 4) else 'Positive',
+            'REL_ABS_F': 'Absolute' if (flag_byte & (1 << 5)) == (1 << 5) else 'Relative',
+            'MODE_F': 'Continuous' if (flag_byte & (1 << 6)) == (1 << 6) else 'Pulse',
+            'STORE_F': 'Stored' if (flag_byte & (1 << 7)) == (1 << 7) else 'Erased'
+        },
+        'UDIRX': status_bytes[1],
+        'UDIRY': status_bytes[2],
+        'UDIRZ': status_bytes[3],
+        'ROE_VARI': int.from_bytes(status_bytes[4:6], byteorder='little'),
+        'UOFFSET': int.from_bytes(status_bytes[6:8], byteorder='little'),
+        'URANGE': int.from_bytes(status_bytes[8:10], byteorder='little'),
+        'PULSE': int.from_bytes(status_bytes[10:12], byteorder='little'),
+        'USPEED': int.from_bytes(status_bytes[12:14], byteorder='little'),
+        'INDEVICE': status_bytes[14],
+        'FLAGS_2': {
+            'LOOP_MODE': 'Loop' if (flag_2_byte & (1 << 0)) == (1 << 0) else 'Execute Once',
+            'LEARN_MODE': 'Learning' if (flag_2_byte & (1 << 1)) == (1 << 1) else 'Not Learning',
+            'STEP_MODE': '50 usteps/step' if (flag_2_byte & (1 << 2)) == (1 << 2) else '10 usteps/step',
+            'JOYSTICK_SIDE': 'Enabled' if (flag_2_byte & (1 << 3)) == (1 << 3) else 'Disabled',
+            'ENABLE_JOYSTICK': 'Enabled' if (flag_2_byte & (1 << 4)) == (1 << 4) else 'Keypad',
+            'ENABLE_ROE_SWITCH': 'Enabled' if (flag_2_byte & (1 << 5)) == (1 << 5) else 'Disabled',
+            '4_AND_5_SWITCHES': 'Enabled' if (flag_2_byte & (1 << 6)) == (1 << 6) else 'Disabled',
+            'REVERSE_IT': 'Reversed' if (flag_2_byte & (1 << 7)) == (1 << 7) else 'Normal Sequence'
+        },
+        'JUMPSPD': int.from_bytes(status_bytes[16:18], byteorder='little'),
+        'HIGHSPD': int.from_bytes(status_bytes[18:20], byteorder='little'),
+        'DEAD': int.from_bytes(status_bytes[20:22], byteorder='little'),
+        'WATCH_DOG': int.from_bytes(status_bytes[22:24], byteorder='little'),
+        'STEP_DIV': int.from_bytes(status_bytes[24:26], byteorder='little'),
+        'STEP_MUL': int.from_bytes(status_bytes[26:28], byteorder='little'),
+        'VERSION': status_bytes[30:32]
+    }
+
+    velocity_word = int.from_bytes(status_bytes[28:30], byteorder='little')
+    if (velocity_word & (1 << 15)) == (1 << 15):
+        status['XSPEED_RES'] = 'High Resolution'
+        status['XSPEED'] = (velocity_word & ~(1 << 15)) * 50 / _USTEPS_PER_UM_
+    else:
+        status['XSPEED_RES'] = 'Low Resolution'
+        status['XSPEED'] = (velocity_word & ~(1 << 15)) * 10 / _USTEPS_PER_UM_
+
+    # get_status handed the caller a copy of the mirrored dict
+    return {key: dict(value) if isinstance(value, dict) else value for key, value in status.items()}
+
+
+def _best(statement) -> float:
+    return min(timeit.repeat(statement, repeat=_REPEAT, number=_NUMBER)) / _NUMBER
+
+
+def main():
+    status_bytes = os.urandom(32) + b'\r'
+
+    cases = [
+        ('ManipulatorStatus', lambda: ManipulatorStatus(status_bytes)),
+        ('ManipulatorStatus + xspeed', lambda: ManipulatorStatus(status_bytes).xspeed),
+        ('ManipulatorStatus + flags', lambda: ManipulatorStatus(status_bytes).flags_2),
+        ('ManipulatorStatus.to_dict', lambda: ManipulatorStatus(status_bytes).to_dict()),
+        ('Legacy get_status decode', lambda: _legacy_decode(status_bytes)),
+    ]
+
+    baseline = _best(cases[-1][1])
+    for name, statement in cases:
+        seconds = _best(statement)
+        print('%-30s %8.3f us  (%.1fx)' % (name, seconds * 1e6, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Runs PowerSupply against the SCPI emulator to measure command throughput and how faithfully wave edges reach the
+supply, in write and trigger playback.
+
+Throughput is the number of setting commands the emulated supply executes per second when sent one per line and when
+coalesced with batch(). Voltage and current settings alternate so the batch cannot drop any as superseded. Expect
+both to be about the same: batching saves writes, not wire time, and the joined line is a byte longer per command.
+
+Edge error is the difference between the interval of consecutive output edges, taken when the emulator executed them,
+and the interval the wave asked for.
+
+Run from the repository root with: python -m benchmarks.supply_emulated
+"""
+import statistics
+import time
+
+from api.power_supply import PowerSupply
+from api.scpi_emulator import SCPIEmulator
+
+_COMMANDS = 100
+_WAVE_TIME = 3.0
+_SETTLE_TIME = 0.5
+
+
+class _NoRelay:
+
+    def vcc(self):
+        pass
+
+    def gnd(self):
+        pass
+
+
+def _send_settings(power_supply: PowerSupply):
+    for i in range(_COMMANDS // 2):
+        power_supply.set_voltage(10.0 + 0.01 * i)
+        power_supply.set_current(0.001 * (i + 1))
+
+
+def _throughput(power_supply: PowerSupply, batched: bool) -> float:
+    power_supply.set_current(0)
+    start = time.monotonic()
+
+    if batched:
+        with power_supply.batch():
+            _send_settings(power_supply)
+    else:
+        _send_settings(power_supply)
+
+    # The reply only comes once everything before it was executed
+    power_supply.get_error()
+    return _COMMANDS / (time.monotonic() - start)
+
+
+def _edge_errors(emulator: SCPIEmulator, start_wave, period: float, duty_cycle: float) -> list:
+    start = time.monotonic()
+    start_wave()
+    time.sleep(_WAVE_TIME)
+
+    edges = emulator.setpoint_edges(start + _SETTLE_TIME)
+    errors = []
+    for (previous, level), (edge, _) in zip(edges, edges[1:]):
+        expected = duty_cycle * period if level > 0 else (1 - duty_cycle) * period
+        errors.append(abs(edge - previous - expected))
+
+    return errors
+
+
+def main():
+    with SCPIEmulator() as emulator:
+        power_supply = PowerSupply(emulator.port, _NoRelay(), _NoRelay())
+
+        for name, batched in [('One command per line', False), ('Batched', True)]:
+            print('%-22s %7.1f commands/s' % (name, _throughput(power_supply, batched)))
+
+        period, duty_cycle = 0.2, 0.5
+        for trigger in (False, True):
+            errors = _edge_errors(emulator, lambda: power_supply.start_square_wave(1.0, period, duty_cycle, trigger),
+                                  period, duty_cycle)
+            power_supply.stop_wave()
+
+            print('%-22s edge error mean %6.3f ms  max %6.3f ms  (%d edges)'
+                  % ('Square, %s' % ('trigger' if trigger else 'write'), statistics.mean(errors) * 1e3,
+                     max(errors) * 1e3, len(errors)))
+
+        print('Coil time constant %.1f ms' % (emulator.time_constant * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Measures the time from PowerSupply.stop_wave until the supply receives OUTP OFF, for waves stopped at random points
+while waiting out a long step, and for the same square wave while another thread keeps reading the current the way
+the GUI's status refresh does, so a query is often waiting for its response when the wave is stopped.
+
+A pseudo terminal stands in for the supply and timestamps every line as it arrives. It answers queries after about the
+time a MEAS:CURR? round trip takes at 9600 baud. Relays are not switched.
+
+Run from the repository root with: python -m benchmarks.wave_stop
+"""
+import os
+import random
+import statistics
+import threading
+import time
+import tty
+
+from api.power_supply import PowerSupply
+
+_TRIALS = 20
+
+# Delay before the peer answers a query
+_QUERY_TIME = 0.02
+
+
+class _NoRelay:
+
+    def vcc(self):
+        pass
+
+    def gnd(self):
+        pass
+
+
+class _SupplyPeer(threading.Thread):
+    """
+    Answers queries and records the time.monotonic() each OUTP OFF line arrived
+    """
+
+    def __init__(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self.output_off_times = []
+
+        super().__init__(daemon=True)
+
+    def run(self):
+        buffer = b''
+        while True:
+            buffer += os.read(self._master, 4096)
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                received = time.monotonic()
+
+                for command in line.split(b';:'):
+                    if command == b'OUTP OFF':
+                        self.output_off_times.append(received)
+                    elif command.endswith(b'?'):
+                        threading.Timer(_QUERY_TIME, os.write, (self._master, b'0\n')).start()
+
+
+def _poll(power_supply: PowerSupply, stopped: threading.Event):
+    while not stopped.is_set():
+        power_supply.get_current()
+
+
+def _measure(power_supply: PowerSupply, peer: _SupplyPeer, start_wave, polled: bool = False) -> tuple:
+    """
+    :param polled: Keep a thread reading the current while the waves play
+    :return: Latencies in seconds and the longest stop_bound() seen
+    """
+    latencies = []
+    bound = 0.0
+
+    stopped = threading.Event()
+    poller = threading.Thread(target=_poll, args=(power_supply, stopped), daemon=True)
+    if polled:
+        poller.start()
+
+    for _ in range(_TRIALS):
+        start_wave()
+        time.sleep(random.uniform(0.2, 0.5))
+
+        received = len(peer.output_off_times)
+        bound = max(bound, power_supply.stop_bound())
+        requested = time.monotonic()
+        power_supply.stop_wave()
+
+        # The peer thread may see the line a moment after stop_wave returns
+        while len(peer.output_off_times) == received:
+            time.sleep(0.0001)
+        latencies.append(peer.output_off_times[received] - requested)
+
+    stopped.set()
+    if polled:
+        poller.join()
+
+    return latencies, bound
+
+
+def main():
+    peer = _SupplyPeer()
+    peer.start()
+
+    power_supply = PowerSupply(peer.port, _NoRelay(), _NoRelay())
+
+    cases = [
+        ('Square, 10 s period', lambda: power_supply.start_square_wave(1.0, 10.0), False),
+        ('Ramp, 10 s rest', lambda: power_supply.start_ramp_wave(1.0, 0.1, 0.0, 10.0), False),
+        ('Sine, 10 s period', lambda: power_supply.start_sine_wave(1.0, 10.0), False),
+        ('Square, polled', lambda: power_supply.start_square_wave(1.0, 10.0), True),
+    ]
+
+    print('Bound: stop_timeout + longest recent query + one command at %d baud; a pty delivers faster'
+          % power_supply.serial_conn.baudrate)
+    for name, start_wave, polled in cases:
+        latencies, bound = _measure(power_supply, peer, start_wave, polled)
+        print('%-20s mean %6.3f ms  max %6.3f ms  bound %6.3f ms'
+              % (name, statistics.mean(latencies) * 1e3, max(latencies) * 1e3, bound * 1e3))
+
+
+if __name__ == '__main__':
+    main()
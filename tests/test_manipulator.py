@@ -0,0 +1,67 @@
+"""
+Checks of the manipulator command encoding and state mirror against MP285Emulator
+
+Run from the repository root with: python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from api.manipulator import Manipulator, Mode, pack_moves, unpack_moves, _USTEPS_PER_UM_
+from api.mp285_emulator import MP285Emulator
+
+
+@pytest.fixture
+def manipulator():
+    with MP285Emulator(time_scale=0) as emulator:
+        manipulator = Manipulator(emulator.port, max_state_age=60)
+        manipulator.emulator = emulator
+        yield manipulator
+        manipulator.close()
+
+
+def test_pack_moves_round_trip():
+    moves = np.random.default_rng(0).uniform(-20000, 20000, (99, 3))
+
+    program_num, unpacked = unpack_moves(pack_moves(moves, 7))
+
+    assert program_num == 7
+    # Coordinates are truncated to whole uSteps
+    np.testing.assert_array_equal(unpacked, np.trunc(moves * _USTEPS_PER_UM_) / _USTEPS_PER_UM_)
+
+
+@pytest.mark.parametrize('bad_value', [np.nan, np.inf, -np.inf])
+def test_pack_moves_rejects_non_finite_coordinates(bad_value):
+    with pytest.raises(ValueError):
+        pack_moves([(0, 0, 0), (0, bad_value, 0)])
+
+
+def test_pack_moves_rejects_out_of_range_coordinates():
+    with pytest.raises(OverflowError):
+        pack_moves([(0, 0, 0), (0, 1e9, 0)])
+
+
+def test_mirror_skips_repeated_commands(manipulator):
+    counts = manipulator.emulator.command_counts
+
+    manipulator.set_mode(Mode.ABSOLUTE)
+    manipulator.set_mode(Mode.ABSOLUTE)
+    assert counts[b'a'] == 1
+    assert manipulator.saved_round_trips['mode'] == 1
+
+    manipulator.go_to_position(10, 20, 30)
+    assert manipulator.get_current_position() == (10.0, 20.0, 30.0)
+    assert counts.get(b'c', 0) == 0
+    assert manipulator.saved_round_trips['position'] == 1
+
+
+def test_interrupt_forgets_position(manipulator):
+    counts = manipulator.emulator.command_counts
+
+    manipulator.set_mode(Mode.ABSOLUTE)
+    manipulator.go_to_position(10, 20, 30)
+    manipulator.interrupt()
+
+    # The position is read from the device again, and the interrupt's CR is not taken for the reply
+    assert manipulator.get_current_position() == (10.0, 20.0, 30.0)
+    assert counts[b'c'] == 1
+    assert counts[b'\x03'] == 1
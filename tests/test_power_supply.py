@@ -0,0 +1,81 @@
+"""
+Checks of PowerSupply batching and wave playback against SCPIEmulator
+
+Run from the repository root with: python -m pytest tests
+"""
+import time
+
+import pytest
+
+from api.power_supply import PowerSupply
+from api.scpi_emulator import SCPIEmulator
+
+
+class _NoRelay:
+
+    def vcc(self):
+        pass
+
+    def gnd(self):
+        pass
+
+
+@pytest.fixture
+def power_supply():
+    with SCPIEmulator(time_scale=0) as emulator:
+        power_supply = PowerSupply(emulator.port, _NoRelay(), _NoRelay())
+        power_supply.emulator = emulator
+        yield power_supply
+        power_supply.serial_conn.close()
+
+
+def _sync(power_supply: PowerSupply):
+    """
+    Waits until the emulator has executed everything sent so far
+    """
+    assert power_supply.get_error().startswith(b'+0')
+
+
+def test_batch_drops_superseded_settings(power_supply):
+    counts = power_supply.emulator.command_counts
+    before = counts.get(b'CURR', 0)
+
+    with power_supply.batch():
+        power_supply.set_current(0.1)
+        power_supply.set_current(0.2)
+        power_supply.set_voltage(5.0)
+    _sync(power_supply)
+
+    assert counts[b'CURR'] == before + 1
+    assert power_supply.emulator.current == pytest.approx(0.2)
+    assert power_supply.emulator.voltage == pytest.approx(5.0)
+    assert power_supply.batch_stats['bytes_saved'] > 0
+
+
+def test_batch_splits_long_lines(power_supply):
+    counts = power_supply.emulator.command_counts
+    lines = power_supply.batch_stats['lines']
+
+    with power_supply.batch():
+        for i in range(40):
+            # Alternating headers, so nothing is superseded
+            power_supply.set_voltage(1.0 + 0.1 * i)
+            power_supply.set_current(0.01 * (i + 1))
+    _sync(power_supply)
+
+    assert power_supply.batch_stats['lines'] - lines > 1
+    assert counts[b'VOLT'] == 40
+    assert power_supply.emulator.current == pytest.approx(0.4)
+    assert power_supply.emulator.errors == []
+
+
+def test_stop_wave_turns_output_off(power_supply):
+    power_supply.start_square_wave(0.5, 0.2)
+    time.sleep(0.3)
+    assert power_supply.emulator.output
+
+    assert power_supply.stop_wave() is not None
+    _sync(power_supply)
+
+    assert not power_supply.emulator.output
+    assert power_supply.wave_stats['writes'] > 0
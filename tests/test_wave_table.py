@@ -0,0 +1,29 @@
+"""
+Checks that streamed wave compilation matches compiling the whole waveform at once
+
+Run from the repository root with: python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from api import math_parser
+from api.wave_table import compile_points, stream_points, MIN_STEP_PERIOD
+
+# Flat stretches, so steps are merged within and across chunk boundaries
+_EQUATION = '0.5 * step(t - 3) + 0.002 * sin(t)'
+_RANGE = (0.0, 10.0)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 1000])
+def test_stream_points_matches_compile_points(chunk_size):
+    equation = math_parser.compile_equation(_EQUATION, 't')
+    table = compile_points(np.column_stack(equation.sample(_RANGE, MIN_STEP_PERIOD)))
+
+    chunks = list(stream_points(equation.chunks(_RANGE, MIN_STEP_PERIOD, chunk_size)))
+
+    np.testing.assert_allclose(sum((chunk.offsets for chunk in chunks), []), table.offsets)
+    assert sum((chunk.setpoints for chunk in chunks), []) == table.setpoints.tolist()
+    assert sum((chunk.frames for chunk in chunks), []) == table.frames
+    assert sum((chunk.opcodes for chunk in chunks), []) == table.opcodes
+    assert sum(chunk.merged for chunk in chunks) == table.merged
+    assert chunks[-1].end == pytest.approx(table.cycle_time)